@@ -25,6 +25,7 @@ from bakula.services import (healthcheck,
                              images,
                              metrics)
 from bakula.models import initialize_models
+from bakula.events.routing import routing_table
 from bakula.bottle import configuration
 
 app = Bottle()
@@ -54,4 +55,5 @@ if __name__ == '__main__':
 
     configuration.bootstrap_app_config(app)
     initialize_models(app.config)
+    routing_table.load()
     run(app, host=args.host, port=args.port, server='cherrypy')
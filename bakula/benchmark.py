@@ -0,0 +1,259 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+# End-to-end throughput benchmark. Runs the event service in this process
+# against a simulated Docker daemon (docker.client = 'fake'), posts events
+# to one topic at a set rate and reports the event rate achieved, the
+# latency of the ingest requests and the latency from an event being sent
+# to a container starting on it. For example:
+#
+#    python -m bakula.benchmark --rate 500 --duration 20 --threshold 50
+#
+# Any other setting can be given with --set, e.g.
+# --set inbox.backend=segment or --set orchestrator.max_containers=8.
+import argparse
+import atexit
+import json
+import os
+import shutil
+import simplejson
+import sys
+import tempfile
+import threading
+import time
+
+TOPIC = 'benchmark'
+IMAGE = 'bakula/benchmark'
+
+# Value at percentile (0-100) of a sorted list, by nearest rank
+def percentile(values, pct):
+    if len(values) == 0:
+        return None
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+def parse_settings(pairs):
+    settings = {}
+    for pair in pairs:
+        key, value = pair.split('=', 1)
+        try:
+            settings[key] = json.loads(value)
+        except ValueError:
+            settings[key] = value
+    return settings
+
+# Writes the configuration the event service reads at import, and points it
+# there
+def write_config(args, work_dir):
+    config = {
+        'database.type': 'sqlite',
+        'database.name': os.path.join(work_dir, 'bakula.db'),
+        'inbox.master': os.path.join(work_dir, 'master_inbox'),
+        'inbox.containers': os.path.join(work_dir, 'container_inboxes'),
+        'docker.client': 'fake',
+        'docker.fake.run_time': args.run_time,
+        'docker.fake.latency': args.latency
+    }
+    config.update(parse_settings(args.set))
+    path = os.path.join(work_dir, 'bakula_config.json')
+    with open(path, 'w') as fout:
+        simplejson.dump(config, fout)
+    os.environ['BAKULA_CFG_FILE'] = path
+    return config
+
+# class Recorder collects what each sender and the fake daemon observe
+class Recorder(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ingest_latencies = []
+        self.accepted = 0
+        self.rejected = 0
+        self.starts = [] # (inbox, time started) of every container
+
+    def request(self, latency, events, ok):
+        with self.lock:
+            self.ingest_latencies.append(latency)
+            if ok:
+                self.accepted += events
+            else:
+                self.rejected += events
+
+    def container_started(self, container, started):
+        with self.lock:
+            self.starts.append((container['inbox'], started))
+
+    # Seconds from each event being sent to its container starting, read
+    # from the send times the events carry
+    def start_latencies(self):
+        latencies = []
+        for inbox, started in self.starts:
+            if inbox is None or not os.path.isdir(inbox):
+                continue
+            for name in os.listdir(inbox):
+                try:
+                    with open(os.path.join(inbox, name)) as fin:
+                        sent = float(fin.read())
+                except (IOError, ValueError):
+                    # Not one of ours, e.g. a segment log
+                    continue
+                latencies.append(started - sent)
+        return latencies
+
+# Posts events from one client at rate requests per second until deadline
+def send(test_app, headers, args, rate, deadline, recorder):
+    interval = 1.0 / rate
+    next_send = time.time()
+    while next_send < deadline:
+        delay = next_send - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        sent = time.time()
+        payloads = ['%r' % sent] * args.events_per_request
+        if args.endpoint == 'batch':
+            response = test_app.post('/events/batch?topic=%s' % TOPIC,
+                                     '\n'.join(payloads),
+                                     headers=headers, expect_errors=True)
+        else:
+            response = test_app.post('/event', {'topic': TOPIC},
+                                     upload_files=[('data[]', str(i), payload)
+                                                   for i, payload
+                                                   in enumerate(payloads)],
+                                     headers=headers, expect_errors=True)
+        recorder.request(time.time() - sent, len(payloads),
+                         response.status_int in (200, 201, 202))
+        next_send += interval
+
+# Waits until every accepted event has been handed to a container, or
+# timeout seconds
+def drain(event, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        queued = event.ingest_queue.depth() if event.ingest_queue else 0
+        if (queued == 0 and event.inbox.get_inbox_count(TOPIC) == 0 and
+                event.orchestrator.launch_queue.depth() == 0):
+            return True
+        time.sleep(0.05)
+    return False
+
+def milliseconds(seconds):
+    if seconds is None:
+        return 'n/a'
+    return '%.1fms' % (seconds * 1000)
+
+def report(args, recorder, elapsed, drained):
+    ingest = sorted(recorder.ingest_latencies)
+    starts = sorted(recorder.start_latencies())
+    print "Sent %d events in %d requests over %.1fs (%d rejected)" % (
+        recorder.accepted + recorder.rejected, len(ingest), elapsed,
+        recorder.rejected)
+    print "Throughput:           %.1f events/sec" % (recorder.accepted / elapsed)
+    print "Ingest latency:       p50 %s, p99 %s" % (
+        milliseconds(percentile(ingest, 50)), milliseconds(percentile(ingest, 99)))
+    print "Event to start:       p50 %s, p99 %s (%d events)" % (
+        milliseconds(percentile(starts, 50)), milliseconds(percentile(starts, 99)),
+        len(starts))
+    print "Containers started:   %d" % len(recorder.starts)
+    if not drained:
+        print "Not every event reached a container within %ds" % args.drain
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Bakula throughput benchmark against a fake Docker daemon')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='requests per second across all clients')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to send events for')
+    parser.add_argument('--clients', type=int, default=1,
+                        help='threads sending requests')
+    parser.add_argument('--events-per-request', type=int, default=1)
+    parser.add_argument('--endpoint', choices=['event', 'batch'],
+                        default='event',
+                        help="post multipart uploads to /event or "
+                             "newline-delimited batches to /events/batch")
+    parser.add_argument('--threshold', type=int, default=10,
+                        help="the registration's threshold")
+    parser.add_argument('--timeout', type=int, default=1,
+                        help="the registration's timeout in seconds")
+    parser.add_argument('--max-batch-size', type=int, default=0)
+    parser.add_argument('--run-time', type=float, default=0.1,
+                        help='seconds each fake container runs')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds each fake Docker API call takes')
+    parser.add_argument('--drain', type=int, default=30,
+                        help='seconds to wait for the last events to start')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='any other configuration setting')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bakula-benchmark-')
+    # Registered before the services are imported so that it runs after
+    # their own exit handlers, such as the bulk writer's last flush
+    atexit.register(shutil.rmtree, work_dir, True)
+    config = write_config(args, work_dir)
+
+    # The services configure themselves when imported
+    from webtest import TestApp
+    from bakula import models
+    from bakula.events.routing import routing_table
+    from bakula.security import tokenutils
+    from bakula.services import event
+
+    models.initialize_models(event.app.config)
+    registration = models.Registration.create(
+        topic=TOPIC, container=IMAGE, creator='admin',
+        threshold=args.threshold, timeout=args.timeout,
+        max_batch_size=args.max_batch_size)
+    routing_table.load()
+    routing_table.added(dict(registration._data))
+
+    recorder = Recorder()
+    event.docker_client.on_start = recorder.container_started
+    headers = {'Authorization': tokenutils.generate_auth_token(
+        config.get('token_secret', 'password'), 'admin',
+        int(args.duration + args.drain + 60))}
+    test_app = TestApp(event.app)
+
+    started = time.time()
+    deadline = started + args.duration
+    senders = [threading.Thread(target=send,
+                                args=(test_app, headers, args,
+                                      args.rate / args.clients, deadline,
+                                      recorder))
+               for i in range(args.clients)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    elapsed = time.time() - started
+    drained = drain(event, args.drain)
+    report(args, recorder, elapsed, drained)
+
+    # Stop the pools' containers and the agent's and writer's threads
+    # before the work directory goes, then exit without waiting on the
+    # service threads that have no stop of their own. Left to interpreter
+    # shutdown they can wake up after the modules they use are torn down.
+    event.orchestrator.precreated_pool.close()
+    event.docker_agent.stop()
+    event.writer.stop()
+    shutil.rmtree(work_dir, True)
+    sys.stdout.flush()
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
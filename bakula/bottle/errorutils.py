@@ -18,7 +18,8 @@
 from bottle import HTTPResponse, HTTP_CODES
 import json
 
-def create_error(status_code=500, message=None, error=None):
+def create_error(status_code=500, message=None, error=None, headers=None,
+                 fields=None):
     """Simple helper method create a error which matches boomjs
 
     Args:
@@ -26,6 +27,9 @@ def create_error(status_code=500, message=None, error=None):
         error: The error message to send with the code, defaults to HTTP
                standard messages
         message: A detailed error message from the application
+        headers: Extra headers to set on the response (e.g. Retry-After)
+        fields: Extra fields to add to the body (e.g. how much of a request
+                was done before it failed)
 
     Returns:
         A HTTPResponse object with the body set to a json dump of the message,
@@ -42,9 +46,15 @@ def create_error(status_code=500, message=None, error=None):
                   'error': error,
                   'message': message
                   }
+    if fields:
+        error_dict.update(fields)
+
+    response_headers = {'Content-Type': 'applicaton/json'}
+    if headers:
+        response_headers.update(headers)
 
     ret_val = HTTPResponse(status=status_code,
-                           headers={'Content-Type': 'applicaton/json'},
+                           headers=response_headers,
                            body=json.dumps(error_dict))
     return ret_val
 
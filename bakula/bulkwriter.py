@@ -0,0 +1,154 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import atexit
+import threading
+from bakula.models import db
+
+# Buffered rows that trigger a flush
+DEFAULT_FLUSH_ROWS = 500
+
+# Seconds a row may wait in the buffer before it is flushed
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# Most rows held in memory; rows added beyond this are dropped
+DEFAULT_MAX_ROWS = 10000
+
+# SQLite allows at most this many bound values in one statement
+SQLITE_MAX_VARIABLES = 999
+
+# Writers that haven't been stopped; whatever they buffer is flushed at
+# exit by the one hook below
+_running = set()
+_running_lock = threading.Lock()
+
+def _flush_running():
+    with _running_lock:
+        writers = list(_running)
+    for writer in writers:
+        writer.flush()
+
+atexit.register(_flush_running)
+
+# class BulkWriter takes rows off the threads producing them. Rows are
+# buffered in memory and written by a background thread with one multi-row
+# insert per model (chunked to fit SQLite's limits) inside a single
+# transaction, once flush_rows are waiting or flush_interval seconds have
+# passed. The buffer holds at most max_rows; rows arriving while it's full
+# are dropped and counted. Whatever is buffered is flushed at exit, or by
+# stop().
+class BulkWriter(object):
+
+    def __init__(self, database=db, flush_rows=DEFAULT_FLUSH_ROWS,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_rows=DEFAULT_MAX_ROWS):
+        self.database = database
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.rows = [] # (model, row dict) in the order they were added
+        self.written = 0
+        self.dropped = 0
+        self.listeners = {} # model -> callbacks run after its rows are written
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock() # Keeps flushes in order
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+        with _running_lock:
+            _running.add(self)
+
+    # Buffers a row of model with the given field values. Returns False if
+    # the row was dropped because the buffer is full.
+    def add(self, model, **row):
+        with self.condition:
+            if len(self.rows) >= self.max_rows:
+                self.dropped += 1
+                return False
+            self.rows.append((model, row))
+            if len(self.rows) >= self.flush_rows:
+                self.condition.notify()
+            return True
+
+    # Calls callback() on the writer's thread each time rows of model have
+    # been written
+    def on_flush(self, model, callback):
+        self.listeners.setdefault(model, []).append(callback)
+
+    # Writes everything buffered so far
+    def flush(self):
+        with self.flush_lock:
+            with self.condition:
+                rows = self.rows
+                self.rows = []
+            if len(rows) == 0:
+                return
+
+            by_model = {}
+            for model, row in rows:
+                by_model.setdefault(model, []).append(row)
+            try:
+                with self.database.atomic():
+                    for model, model_rows in by_model.items():
+                        fields = max(len(row) for row in model_rows)
+                        chunk = max(1, SQLITE_MAX_VARIABLES // fields)
+                        for i in range(0, len(model_rows), chunk):
+                            model.insert_many(model_rows[i:i + chunk]).execute()
+                self.written += len(rows)
+            except Exception as ex:
+                print "Writing %d buffered rows failed due to %s" % (len(rows), ex)
+                with self.condition:
+                    self.dropped += len(rows)
+                return
+
+            for model in by_model:
+                for callback in self.listeners.get(model, []):
+                    try:
+                        callback()
+                    except Exception as ex:
+                        print "Running flush listener failed due to %s" % ex
+
+    # Stops the writer's thread after a last flush, waiting up to timeout
+    # seconds for it
+    def stop(self, timeout=5):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join(timeout)
+        with _running_lock:
+            _running.discard(self)
+
+    # Rows written, buffered and dropped so far
+    def status(self):
+        with self.condition:
+            return {
+                'written': self.written,
+                'buffered': len(self.rows),
+                'dropped': self.dropped
+            }
+
+    def __run(self):
+        while True:
+            with self.condition:
+                if len(self.rows) < self.flush_rows and not self.stopped:
+                    self.condition.wait(self.flush_interval)
+                stopped = self.stopped
+            self.flush()
+            if stopped:
+                return
@@ -0,0 +1,97 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import os
+import tempfile
+from peewee import Model, CharField, IntegerField, Proxy
+from bakula.bottle import peeweeutils
+from bakula import bulkwriter
+from bakula.bulkwriter import BulkWriter
+
+test_db = Proxy()
+class TestRow(Model):
+    name = CharField()
+    value = IntegerField()
+
+    class Meta:
+        database = test_db
+
+class BulkWriterTest(unittest.TestCase):
+
+    # A file, rather than memory, so the writer thread sees the same tables
+    TEST_DB = os.path.join(tempfile.gettempdir(), 'bulkwriter_test.db')
+
+    @classmethod
+    def setUpClass(self):
+        peeweeutils.get_db_from_config({'database.name': self.TEST_DB,
+                                        'database.type': 'sqlite'}, test_db)
+        TestRow.create_table(True)
+
+    @classmethod
+    def tearDownClass(self):
+        test_db.close()
+        os.remove(self.TEST_DB)
+
+    def setUp(self):
+        TestRow.delete().execute()
+
+    def test_flush(self):
+        writer = BulkWriter(test_db, flush_rows=10000, flush_interval=60)
+        # Enough rows to need several statements on SQLite
+        for i in range(1200):
+            writer.add(TestRow, name='row', value=i)
+        self.assertEqual(TestRow.select().count(), 0)
+
+        writer.flush()
+        self.assertEqual(TestRow.select().count(), 1200)
+        self.assertEqual(writer.status(), {'written': 1200, 'buffered': 0,
+                                           'dropped': 0})
+
+    def test_flush_on_size(self):
+        writer = BulkWriter(test_db, flush_rows=5, flush_interval=60)
+        for i in range(5):
+            writer.add(TestRow, name='row', value=i)
+
+        for i in range(50):
+            if writer.status()['written'] == 5:
+                break
+            writer.thread.join(0.1)
+        self.assertEqual(TestRow.select().count(), 5)
+
+    def test_drops_when_full(self):
+        writer = BulkWriter(test_db, flush_rows=10000, flush_interval=60,
+                            max_rows=2)
+        self.assertTrue(writer.add(TestRow, name='row', value=1))
+        self.assertTrue(writer.add(TestRow, name='row', value=2))
+        self.assertFalse(writer.add(TestRow, name='row', value=3))
+        self.assertEqual(writer.status()['dropped'], 1)
+        writer.flush()
+
+    def test_stop_flushes(self):
+        writer = BulkWriter(test_db, flush_rows=10000, flush_interval=60)
+        writer.add(TestRow, name='row', value=1)
+
+        # Doesn't wait out the interval
+        writer.stop(timeout=5)
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(TestRow.select().count(), 1)
+        # Nothing is left for the exit hook
+        self.assertNotIn(writer, bulkwriter._running)
+
+if __name__ == '__main__':
+    unittest.main()
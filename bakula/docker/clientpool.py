@@ -0,0 +1,148 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import threading
+import time
+from Queue import Queue, Empty
+
+# Lanes of the pool: container launches get connections of their own, so
+# they never wait behind stats, listing or removal calls
+LANE_LAUNCH = 'launch'
+LANE_BACKGROUND = 'background'
+
+# Most connections open at once in each lane
+DEFAULT_LAUNCH_SIZE = 4
+DEFAULT_BACKGROUND_SIZE = 8
+
+# class ClientPool hands out docker clients, made by factory() as needed, so
+# that no client is used by two threads at once. Clients are kept in lanes
+# of bounded size; a thread wanting a client when every one in its lane is
+# busy waits for one to be returned. The time taken by every call made
+# through lane() is recorded by lane and method.
+class ClientPool(object):
+
+    def __init__(self, factory, sizes=None):
+        self.factory = factory
+        if sizes is None:
+            sizes = {LANE_LAUNCH: DEFAULT_LAUNCH_SIZE,
+                     LANE_BACKGROUND: DEFAULT_BACKGROUND_SIZE}
+        self.lock = threading.Lock()
+        self.lanes = {}
+        for lane, size in sizes.items():
+            self.lanes[lane] = {
+                'size': size,
+                'created': 0,
+                'idle': Queue(),
+                'waits': 0, # Checkouts that found every client busy
+                'wait_time': 0.0,
+                'calls': {} # method -> [count, errors, total time, max time]
+            }
+
+    # Takes a client from lane, creating one if the lane isn't full and
+    # waiting for one to be returned otherwise
+    def checkout(self, lane):
+        state = self.lanes[lane]
+        try:
+            return state['idle'].get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            create = state['created'] < state['size']
+            if create:
+                state['created'] += 1
+        if create:
+            try:
+                return self.factory()
+            except:
+                with self.lock:
+                    state['created'] -= 1
+                raise
+        started = time.time()
+        client = state['idle'].get()
+        with self.lock:
+            state['waits'] += 1
+            state['wait_time'] += time.time() - started
+        return client
+
+    def checkin(self, lane, client):
+        self.lanes[lane]['idle'].put(client)
+
+    # Returns an object with the methods of a docker client, each call of
+    # which is made on a client checked out of lane
+    def lane(self, lane):
+        return PooledClient(self, lane)
+
+    def record(self, lane, method, elapsed, failed):
+        with self.lock:
+            calls = self.lanes[lane]['calls']
+            stats = calls.setdefault(method, [0, 0, 0.0, 0.0])
+            stats[0] += 1
+            if failed:
+                stats[1] += 1
+            stats[2] += elapsed
+            stats[3] = max(stats[3], elapsed)
+
+    # Each lane's size and use, with the number, failures and average and
+    # longest time in seconds of the calls made to each method
+    def status(self):
+        with self.lock:
+            status = {}
+            for lane, state in self.lanes.items():
+                calls = {}
+                for method, stats in state['calls'].items():
+                    calls[method] = {'count': stats[0],
+                                     'errors': stats[1],
+                                     'average': stats[2] / stats[0],
+                                     'max': stats[3]}
+                status[lane] = {'size': state['size'],
+                                'created': state['created'],
+                                'idle': state['idle'].qsize(),
+                                'waits': state['waits'],
+                                'wait_time': state['wait_time'],
+                                'calls': calls}
+            return status
+
+# class PooledClient stands in for a docker client, making each call on a
+# client checked out of one lane of a ClientPool for just that call
+class PooledClient(object):
+
+    def __init__(self, pool, lane):
+        self._pool = pool
+        self._lane = lane
+
+    def __getattr__(self, name):
+        client = self._pool.checkout(self._lane)
+        try:
+            attribute = getattr(client, name)
+        finally:
+            self._pool.checkin(self._lane, client)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            client = self._pool.checkout(self._lane)
+            started = time.time()
+            failed = True
+            try:
+                result = getattr(client, name)(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self._pool.checkin(self._lane, client)
+                self._pool.record(self._lane, name, time.time() - started,
+                                  failed)
+        return call
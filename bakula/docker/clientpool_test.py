@@ -0,0 +1,107 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import threading
+from clientpool import ClientPool, LANE_LAUNCH, LANE_BACKGROUND
+from testclient import RecordingClient, TEST_RUN_TIME
+
+class ClientPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        self.listing = [] # Set as each client's first images() is held
+
+    # Makes clients whose images() calls are held until released
+    def __factory(self):
+        client = RecordingClient()
+        self.listing.append(client.hold('images'))
+        self.created.append(client)
+        return client
+
+    # Waits until the first client created is inside images()
+    def __wait_for_listing(self):
+        for i in range(500):
+            if self.listing:
+                break
+            threading.Event().wait(0.01)
+        self.assertTrue(self.listing[0].wait(5))
+
+    def test_clients_are_reused(self):
+        pool = ClientPool(self.__factory, sizes={LANE_LAUNCH: 2})
+        client = pool.lane(LANE_LAUNCH)
+
+        self.assertEqual(client.containers(), [])
+        self.assertEqual(client.containers(), [])
+        self.assertEqual(client.run_time, TEST_RUN_TIME)
+        self.assertEqual(len(self.created), 1)
+
+    def test_lane_is_bounded(self):
+        pool = ClientPool(self.__factory, sizes={LANE_BACKGROUND: 1})
+        client = pool.lane(LANE_BACKGROUND)
+
+        thread = threading.Thread(target=client.images)
+        thread.start()
+        self.__wait_for_listing()
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(client.containers()))
+        waiter.start()
+        waiter.join(0.1)
+        # The second call waits for the only client
+        self.assertEqual(results, [])
+
+        self.created[0].release('images')
+        thread.join(5)
+        waiter.join(5)
+        self.assertEqual(results, [[]])
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual(pool.status()[LANE_BACKGROUND]['waits'], 1)
+
+    def test_lanes_are_independent(self):
+        pool = ClientPool(self.__factory, sizes={LANE_LAUNCH: 1,
+                                                 LANE_BACKGROUND: 1})
+        background = pool.lane(LANE_BACKGROUND)
+
+        thread = threading.Thread(target=background.images)
+        thread.start()
+        self.__wait_for_listing()
+
+        # A launch doesn't wait for the busy background client
+        self.assertEqual(pool.lane(LANE_LAUNCH).containers(), [])
+
+        self.created[0].release('images')
+        thread.join(5)
+
+    def test_latency_is_recorded(self):
+        pool = ClientPool(self.__factory, sizes={LANE_LAUNCH: 1})
+        client = pool.lane(LANE_LAUNCH)
+
+        client.containers()
+        self.assertRaises(Exception, client.inspect_image, 'missing')
+
+        calls = pool.status()[LANE_LAUNCH]['calls']
+        self.assertEqual(calls['containers']['count'], 1)
+        self.assertEqual(calls['containers']['errors'], 0)
+        self.assertEqual(calls['inspect_image']['errors'], 1)
+        self.assertTrue(calls['containers']['max'] >=
+                        calls['containers']['average'])
+        # The failed call gave its client back
+        self.assertEqual(pool.status()[LANE_LAUNCH]['idle'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
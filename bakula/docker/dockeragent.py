@@ -19,18 +19,42 @@ import docker
 import time
 import threading
 from sets import Set
-import copy
 
-# The requests library seems to import the urllib library completely
-# into their codebase before distributing (not sure if it's a fork or
-# what), which is why this exceptions module is imported weirdly.
-from requests.packages.urllib3.exceptions import ReadTimeoutError
 from requests.exceptions import ReadTimeout
+from docker.errors import NotFound
+
+from bakula.docker.clientpool import (ClientPool, LANE_LAUNCH,
+    LANE_BACKGROUND, DEFAULT_LAUNCH_SIZE, DEFAULT_BACKGROUND_SIZE)
+from bakula.docker.imageindex import (ImageIndex, IMAGE_EVENTS,
+    DEFAULT_MAX_AGE as DEFAULT_IMAGE_INDEX_MAX_AGE)
+from bakula.docker.remover import (ContainerRemover,
+    DEFAULT_WORKERS as DEFAULT_REMOVE_WORKERS,
+    DEFAULT_RETRIES as DEFAULT_REMOVE_RETRIES)
+from bakula.runtime.runtime import Runtime
+from bakula.docker.statscollector import (StatsCollector,
+    DEFAULT_INTERVAL as DEFAULT_STATS_INTERVAL,
+    DEFAULT_WORKERS as DEFAULT_STATS_WORKERS)
+
+# Seconds to wait for the daemon to answer a request. One-shot stats calls
+# alone take a second or two, and a loaded daemon can be slower still.
+DEFAULT_DOCKER_TIMEOUT = 30
+
+# Seconds a pulled image is trusted before it is pulled again
+DEFAULT_IMAGE_TTL = 300
+
+# How exited containers are noticed: by following Docker's event stream, or
+# by listing exited containers every monitor_interval seconds
+MONITOR_EVENTS = 'events'
+MONITOR_POLL = 'poll'
+
+# Container events that mean a container has stopped running
+TERMINATE_EVENTS = ['die', 'destroy']
 
 class ContainerStartException(Exception):
     pass
 
-class DockerAgent(object):
+# class DockerAgent is the runtime running handlers as Docker containers
+class DockerAgent(Runtime):
     CONTAINER_INBOX = '/inbox'
     NAME_CHARS_TO_REPLACE = ['/', '-', ':']
 
@@ -41,124 +65,262 @@ class DockerAgent(object):
                  registry_protocol='https',
                  tls_config=False,
                  monitor_interval=2,
-                 docker_timeout=2,
+                 docker_timeout=DEFAULT_DOCKER_TIMEOUT,
                  monitor_thread=True,
-                 start_retries=3):
+                 start_retries=3,
+                 image_ttl=DEFAULT_IMAGE_TTL,
+                 monitor=MONITOR_EVENTS,
+                 docker_client=None,
+                 stats_interval=DEFAULT_STATS_INTERVAL,
+                 stats_workers=DEFAULT_STATS_WORKERS,
+                 remove_workers=DEFAULT_REMOVE_WORKERS,
+                 remove_retries=DEFAULT_REMOVE_RETRIES,
+                 auto_remove=False,
+                 image_index_max_age=DEFAULT_IMAGE_INDEX_MAX_AGE,
+                 launch_connections=DEFAULT_LAUNCH_SIZE,
+                 background_connections=DEFAULT_BACKGROUND_SIZE):
+        if monitor not in (MONITOR_EVENTS, MONITOR_POLL):
+            raise ValueError("Unknown monitor %s" % monitor)
         self._start_retries = start_retries
-        self._containers_to_remove = Set()
+        # Local image ids by image name, with when they were pulled, so an
+        # image is only pulled again once image_ttl has passed
+        self._image_ttl = image_ttl
+        self._image_cache = {}
+        self._image_locks = {}
+        self._image_lock = threading.Lock()
+        # Containers created with auto_remove are removed by the daemon as
+        # soon as they exit; the others are removed by a pool of threads
+        self._auto_remove = auto_remove
         self._terminate_callbacks = {}
-        self._docker_client = docker.Client(base_url=docker_base_url,
-                                            tls=tls_config,
-                                            timeout=docker_timeout)
-        if registry_host and registry_protocol and username and password:
-            registry_url = "%s://%s" % (registry_protocol, registry_host)
-            self._docker_client.login(username,
-                                      password,
-                                      registry=registry_url)
+        self._terminate_lock = threading.Lock()
+        self._events_client = docker_client
+        if docker_client is None:
+            # Auto-remove needs a newer API than docker-py asks for by default
+            version = 'auto' if auto_remove else None
+
+            def create_client():
+                client = docker.Client(base_url=docker_base_url,
+                                       tls=tls_config,
+                                       timeout=docker_timeout,
+                                       version=version)
+                if (registry_host and registry_protocol and username and
+                        password):
+                    registry_url = "%s://%s" % (registry_protocol,
+                                                registry_host)
+                    client.login(username, password, registry=registry_url)
+                return client
+
+            # The event stream sits idle between events, so it mustn't time
+            # out the way other requests do
+            self._events_client = docker.Client(base_url=docker_base_url,
+                                                tls=tls_config,
+                                                timeout=None,
+                                                version=version)
+        else:
+            create_client = lambda: docker_client
+
+        # Each thread making a call gets a client of its own from the pool.
+        # Launches have their own lane so they never queue behind stats,
+        # listing or removal calls in the background lane.
+        self._client_pool = ClientPool(create_client, sizes={
+            LANE_LAUNCH: launch_connections,
+            LANE_BACKGROUND: background_connections
+        })
+        self._docker_client = self._client_pool.lane(LANE_BACKGROUND)
+        self._launch_client = self._client_pool.lane(LANE_LAUNCH)
+
+        # Local images by tag, kept fresh by image events
+        self._image_index = ImageIndex(self._docker_client,
+                                       max_age=image_index_max_age)
 
+        self._remover = ContainerRemover(self._docker_client,
+                                         workers=remove_workers,
+                                         retries=remove_retries)
+
+        # One collector samples the stats of every running container
+        self._stats_collector = StatsCollector(self._docker_client,
+                                               interval=stats_interval,
+                                               workers=stats_workers)
+
+        self._stopping = threading.Event()
         self._monitor_thread = None
         if monitor_thread:
             self._monitor_interval = monitor_interval
-            self._monitor_thread = threading.Thread(target=self.__monitor)
+            monitor_target = self.__monitor
+            if monitor == MONITOR_EVENTS:
+                monitor_target = self.__follow_events
+            self._monitor_thread = threading.Thread(target=monitor_target)
             self._monitor_thread.daemon = True
             self._monitor_thread.start()
 
-            self._removal_thread = threading.Thread(target=self.__remove)
-            self._removal_thread.daemon = True
-            self._removal_thread.start()
+    # Hands a container that has stopped running to its terminate callback
+    # and queues it for removal. Safe to call more than once per container.
+    def __terminated(self, container_id, remove=True):
+        with self._terminate_lock:
+            callback = self._terminate_callbacks.pop(container_id, None)
+        self._stats_collector.unwatch(container_id)
+        if remove and not self._auto_remove:
+            self._remover.remove(container_id)
+        if callback is not None:
+            callback(container_id)
+
+    # Lists exited containers and treats them as terminated
+    def __poll_exited(self):
+        exited = self._docker_client.containers(
+            all=True,
+            filters={'status': 'exited'}
+        )
+        for container in exited:
+            self.__terminated(container['Id'])
+
+    # Catches up on containers that stopped while the event stream wasn't
+    # being followed: exited ones, and ones with callbacks that no longer
+    # exist at all. Images may have changed too, so the image index is read
+    # again on its next lookup.
+    def __resync(self):
+        self._image_index.invalidate()
+        self.__poll_exited()
+        with self._terminate_lock:
+            tracked = self._terminate_callbacks.keys()
+        if len(tracked) > 0:
+            existing = Set(container['Id'] for container in
+                           self._docker_client.containers(all=True))
+            for container_id in tracked:
+                if container_id not in existing:
+                    self.__terminated(container_id, remove=False)
 
-    def __remove(self):
-        while True:
+    # Follows Docker's event stream, calling terminate callbacks as soon as
+    # containers die and marking the image index stale when images change.
+    # Whenever the stream is (re)opened the exited containers are listed
+    # too, so nothing that happened while disconnected is missed.
+    def __follow_events(self):
+        while not self._stopping.is_set():
             try:
-                time.sleep(self._monitor_interval)
+                # Ask for events from just before the resync so there's no
+                # gap between the two
+                since = int(time.time()) - 1
+                self.__resync()
+                events = self._events_client.events(
+                    since=since,
+                    filters={'type': ['container', 'image'],
+                             'event': TERMINATE_EVENTS + IMAGE_EVENTS},
+                    decode=True
+                )
+                for event in events:
+                    if event.get('Type') == 'image':
+                        self._image_index.invalidate()
+                        continue
+                    container_id = (event.get('id') or
+                                    event.get('Actor', {}).get('ID'))
+                    action = event.get('status') or event.get('Action')
+                    if container_id is None or action not in TERMINATE_EVENTS:
+                        continue
+                    # A destroyed container is already gone
+                    self.__terminated(container_id, remove=(action == 'die'))
+            except Exception as ex:
+                if self._stopping.is_set():
+                    return
+                print "Following docker events failed due to %s" % ex
+            try:
+                self._stopping.wait(self._monitor_interval)
             except KeyboardInterrupt:
-                self._removal_thread.stop()
-            to_clear = []
-
-            # Make a deep copy of the containers_to_remove so that we can
-            # iterate over the containers without blocking the monitor thread
-            removing = copy.deepcopy(self._containers_to_remove)
-            for container_id in removing:
-                try:
-                    self._docker_client.remove_container(container_id)
-                    to_clear.append(container_id)
-                except:
-                    # If there's a timeout just bail out of the loop
-                    # and we'll remove the containers on the next run
-                    break
-            for container_id in to_clear:
-                self._containers_to_remove.remove(container_id)
+                self._monitor_thread.stop()
 
     def __monitor(self):
-        while True:
+        while not self._stopping.is_set():
             try:
-                time.sleep(self._monitor_interval)
+                self._stopping.wait(self._monitor_interval)
             except KeyboardInterrupt:
                 self._monitor_thread.stop()
+            if self._stopping.is_set():
+                return
             try:
-                exited = self._docker_client.containers(
-                    filters={'status': 'exited'}
-                )
-                update_indices = False
-                containers_to_remove = []
-                for container in exited:
-                    image = container['Image']
-                    name = container['Names'][0]
-                    container_id = container['Id']
-                    if name.startswith('/'):
-                        name = name[1:]
-                    update_indices = True
-                    if container_id in self._terminate_callbacks:
-                        self._terminate_callbacks[container_id](container_id)
-                        del self._terminate_callbacks[container_id]
-                    self._containers_to_remove.add(container_id)
+                # Auto-removed containers never show up as exited, so look
+                # for vanished ones too
+                self.__resync()
             except:
                 # Not too worried about if there is an exception, just want
                 # to make sure this thread stays alive
                 pass
 
+    # Stops following the daemon, sampling stats and removing containers,
+    # waiting up to timeout seconds for each of their threads. Closing the
+    # event stream's client ends a stream that is waiting for events.
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._monitor_thread is not None:
+            try:
+                self._events_client.close()
+            except Exception as ex:
+                print "Closing the docker event stream failed due to %s" % ex
+            self._monitor_thread.join(timeout)
+        self._stats_collector.stop(timeout)
+        self._remover.stop(timeout)
+
     def build_image(self, path, image_name,
                     dockerfile='Dockerfile'):
         build_generator = self._docker_client.build(path=path, tag=image_name)
 
-    def pull(self, image_name, tag='latest'):
-        return self._docker_client.pull(image_name, tag=tag)
+    # Pulls image_name on the launch lane, or on the background lane when
+    # nothing is waiting for it
+    def pull(self, image_name, tag='latest', background=False):
+        client = self._docker_client if background else self._launch_client
+        return client.pull(image_name, tag=tag)
+
+    # Makes sure image_name is available locally, pulling it only if it
+    # hasn't been pulled within the image TTL. Returns the local image id.
+    # Set background when no launch is waiting on it, so a slow pull doesn't
+    # hold a launch lane connection.
+    def ensure_image(self, image_name, tag='latest', background=False):
+        with self._image_lock:
+            lock = self._image_locks.setdefault(image_name, threading.Lock())
+        # Concurrent callers for the same image wait for one pull
+        with lock:
+            cached = self._image_cache.get(image_name)
+            if cached is not None and time.time() - cached[1] < self._image_ttl:
+                return cached[0]
+            self.pull(image_name, tag=tag, background=background)
+            client = self._docker_client if background else self._launch_client
+            image_id = client.inspect_image(image_name)['Id']
+            self._image_cache[image_name] = (image_id, time.time())
+            self._image_index.add(image_name, image_id, tag=tag)
+            return image_id
+
+    # Forgets when image_name (or, without one, every image) was pulled, so
+    # the next ensure_image pulls it again
+    def invalidate_image(self, image_name=None):
+        with self._image_lock:
+            if image_name is None:
+                self._image_cache.clear()
+            else:
+                self._image_cache.pop(image_name, None)
+
+    # Ensures image_name on a background thread, over the background lane
+    def prepull(self, image_name):
+        def pull():
+            try:
+                self.ensure_image(image_name, background=True)
+            except Exception as ex:
+                print "Pre-pulling %s failed due to %s" % (image_name, ex)
+        thread = threading.Thread(target=pull)
+        thread.daemon = True
+        thread.start()
+        return thread
 
+    # True if an image tagged exactly image_name (":latest" unless it gives
+    # a tag) is available locally. Answered from the image index.
     def check_if_image_exists(self, image_name):
-        for image in self._docker_client.images():
-            repo_tags = image.get('RepoTags', [])
-            if any(image_name in x for x in repo_tags):
-                return True
-            if 'RepoTags' in image and image_name in image['RepoTags']:
-                return True
-        return False
-
-    def __process_stats(self,
-                       container_id,
-                       topic,
-                       container_name,
-                       stat_generator,
-                       stat_processor):
-        try:
-            for stat in stat_generator:
-                stat_processor(stat, container_id, topic, container_name)
-        except ReadTimeoutError:
-            # When the container is terminated, the connection stays open
-            # briefly before timing out. Nothing to do here.
-            pass
+        return self._image_index.contains(image_name)
 
+    # Samples the container's stats until it terminates, handing each
+    # sample to stat_processor(stat, container_id, topic, container_name)
     def stats(self,
               container_id,
               topic,
               container_name,
               stat_processor):
-        stats = self._docker_client.stats(container_id, decode=True)
-        thread = threading.Thread(
-            target=self.__process_stats,
-            args=(container_id, topic, container_name, stats, stat_processor)
-        )
-        thread.daemon = True
-        thread.start()
+        self._stats_collector.watch(container_id, topic, container_name,
+                                    stat_processor)
 
     def start_container(self,
                         image_name,
@@ -167,51 +329,107 @@ class DockerAgent(object):
                         run_privileged=False,
                         command=None,
                         on_terminate=None,
-                        topic=None):
+                        topic=None,
+                        environment=None,
+                        working_dir=None):
+        container_id = self.create_container(image_name,
+                                             host_inbox,
+                                             ports=ports,
+                                             run_privileged=run_privileged,
+                                             command=command,
+                                             topic=topic,
+                                             environment=environment,
+                                             working_dir=working_dir)
+        return self.start_created_container(container_id,
+                                            on_terminate=on_terminate)
+
+    # Creates, but doesn't start, a container of image_name with host_inbox
+    # mounted as its inbox. The inbox is only bound when the container
+    # starts, so its contents may be replaced until then. Returns the
+    # container's id.
+    def create_container(self,
+                         image_name,
+                         host_inbox,
+                         ports=None,
+                         run_privileged=False,
+                         command=None,
+                         topic=None,
+                         environment=None,
+                         working_dir=None):
         # Create inbox volume for container
         container_volumes_str = '%s:%s:rw' % (host_inbox,
                                               DockerAgent.CONTAINER_INBOX)
 
-        host_config_obj = self._docker_client.create_host_config(
+        host_config_obj = self._launch_client.create_host_config(
             privileged=run_privileged,
             binds=[container_volumes_str],
             port_bindings=ports
         )
+        if self._auto_remove:
+            # Not known to this version of docker-py's create_host_config
+            host_config_obj['AutoRemove'] = True
         tries = 0
-        created = False
-        container = None
         while tries < self._start_retries:
             try:
-                container = self._docker_client.create_container(
+                container = self._launch_client.create_container(
                     image=image_name,
                     host_config=host_config_obj,
                     volumes=[DockerAgent.CONTAINER_INBOX],
                     command=command,
+                    environment=environment,
+                    working_dir=working_dir,
                     labels={
                         'topic': topic
                     }
                 )
-                created = True
-                break
+                return container['Id']
             except ReadTimeout:
                 tries += 1
-        if not created:
-            raise ContainerStartException('Could not create container')
-        container_id = container['Id']
+        raise ContainerStartException('Could not create container')
+
+    # Starts a container made by create_container, calling
+    # on_terminate(container_id) once it stops. Returns the container's id.
+    def start_created_container(self, container_id, on_terminate=None):
         tries = 0
         while tries < self._start_retries:
             try:
-                res = self._docker_client.start(container['Id'])
+                # Register the callback first so a container that exits
+                # straight away isn't missed
                 if on_terminate is not None:
-                    self._terminate_callbacks[container_id] = on_terminate
+                    with self._terminate_lock:
+                        self._terminate_callbacks[container_id] = on_terminate
+                res = self._launch_client.start(container_id)
                 return container_id
             except ReadTimeout:
                 tries += 1
 
         # We weren't able to start the container, remove it and throw an
         # error
-        self._containers_to_remove.add(container_id)
-        raise ContainerStartException('Could not start container "%s%' % container_id)
+        with self._terminate_lock:
+            self._terminate_callbacks.pop(container_id, None)
+        self._remover.remove(container_id)
+        raise ContainerStartException('Could not start container "%s"' % container_id)
+
+    # Removes a container on the remover's workers, or straight away when
+    # wait is set
+    def remove_container(self, container_id, wait=False):
+        if not wait:
+            self._remover.remove(container_id)
+            return
+        try:
+            self._docker_client.remove_container(container_id)
+        except NotFound:
+            pass
+
+    # Asks a running container to stop, killing it after timeout seconds.
+    # The monitor removes it once it has exited.
+    def stop_container(self, container_id, timeout=10):
+        self._docker_client.stop(container_id, timeout=timeout)
+
+    # How many connections each lane of the client pool has open, and how
+    # long the calls made through them took
+    def client_status(self):
+        return self._client_pool.status()
 
     def container_count(self, topic, image_name):
         containers = self._docker_client.containers(filters={
@@ -0,0 +1,154 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import threading
+from dockeragent import DockerAgent, MONITOR_EVENTS
+from clientpool import LANE_LAUNCH, LANE_BACKGROUND
+from testclient import RecordingClient
+
+class DockerAgentTest(unittest.TestCase):
+
+    TEST_DIR = os.path.join(tempfile.gettempdir(), 'dockeragent_test')
+
+    def setUp(self):
+        self.client = RecordingClient()
+        self.agents = []
+
+    def tearDown(self):
+        for agent in self.agents:
+            agent.stop()
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    def __agent(self, **kwargs):
+        agent = DockerAgent(docker_client=self.client, **kwargs)
+        self.agents.append(agent)
+        return agent
+
+    def test_ensure_image_is_cached(self):
+        agent = self.__agent(monitor_thread=False, image_ttl=300)
+
+        image_id = agent.ensure_image('busybox')
+        self.assertEqual(agent.ensure_image('busybox'), image_id)
+        self.assertEqual(len(self.client.calls_to('pull')), 1)
+
+        # A new version is only seen once the image is pulled again
+        self.client.push('busybox')
+        self.assertEqual(agent.ensure_image('busybox'), image_id)
+        agent.invalidate_image('busybox')
+        self.assertNotEqual(agent.ensure_image('busybox'), image_id)
+
+    def test_ensure_image_after_ttl(self):
+        agent = self.__agent(monitor_thread=False, image_ttl=0)
+
+        agent.ensure_image('busybox')
+        agent.ensure_image('busybox')
+        self.assertEqual(len(self.client.calls_to('pull')), 2)
+
+    def test_prepull(self):
+        agent = self.__agent(monitor_thread=False, image_ttl=300)
+
+        agent.prepull('busybox').join(5)
+        agent.ensure_image('busybox')
+        self.assertEqual(len(self.client.calls_to('pull')), 1)
+        # The pull didn't hold a launch connection
+        status = agent.client_status()
+        self.assertIn('pull', status[LANE_BACKGROUND]['calls'])
+        self.assertNotIn('pull', status[LANE_LAUNCH]['calls'])
+
+    def test_pulled_image_exists(self):
+        agent = self.__agent(monitor_thread=False, image_ttl=300)
+
+        self.assertFalse(agent.check_if_image_exists('busybox'))
+        agent.ensure_image('busybox')
+        self.assertTrue(agent.check_if_image_exists('busybox:latest'))
+        self.assertFalse(agent.check_if_image_exists('busy'))
+
+    def test_image_events_refresh_index(self):
+        agent = self.__agent(monitor=MONITOR_EVENTS, monitor_interval=0.1)
+        self.assertFalse(agent.check_if_image_exists('busybox'))
+
+        # Pulled behind the agent's back
+        self.client.pull('busybox')
+        self.assertTrue(self.client.send_event(
+            {'Type': 'image', 'Action': 'tag', 'Actor': {'ID': 'sha256:1'}}))
+        deadline = time.time() + 5
+        while (not agent.check_if_image_exists('busybox') and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertTrue(agent.check_if_image_exists('busybox'))
+
+    def test_terminate_from_events(self):
+        # Resyncs are too far apart to notice the container exiting
+        agent = self.__agent(monitor=MONITOR_EVENTS, monitor_interval=60)
+        os.makedirs(self.TEST_DIR)
+        terminated = threading.Event()
+        agent.ensure_image('busybox')
+        container_id = agent.start_container(
+            image_name='busybox', host_inbox=self.TEST_DIR,
+            on_terminate=lambda id: terminated.set())
+        self.assertTrue(self.client.wait_for_stream())
+
+        self.client.stop(container_id)
+        self.assertTrue(terminated.wait(5))
+
+    def test_terminate_on_resync(self):
+        # One container exited and another vanished while nobody listened
+        exited = self.client.run()
+        self.client.stop(exited)
+        terminated = []
+        agent = self.__agent(monitor_thread=False)
+        agent._terminate_callbacks[exited] = terminated.append
+        agent._terminate_callbacks['vanished'] = terminated.append
+
+        agent._DockerAgent__resync()
+
+        self.assertEqual(sorted(terminated), sorted([exited, 'vanished']))
+        # Only the container still around is removed
+        self.assertTrue(self.client.wait_for_calls('remove_container', 1))
+        self.assertEqual(self.client.calls_to('remove_container'), [exited])
+
+    def test_auto_remove(self):
+        exited = self.client.run()
+        self.client.stop(exited)
+        agent = self.__agent(monitor_thread=False, auto_remove=True)
+        agent._terminate_callbacks[exited] = lambda id: None
+
+        agent._DockerAgent__resync()
+
+        # The daemon removes it; nothing is queued
+        self.assertEqual(agent._remover.depth(), 0)
+
+    def test_stop(self):
+        agent = self.__agent(monitor=MONITOR_EVENTS, monitor_interval=0.1)
+        self.assertTrue(self.client.wait_for_stream())
+
+        agent.stop()
+
+        # The event stream was closed and every thread has finished
+        self.assertFalse(agent._monitor_thread.is_alive())
+        self.assertFalse(agent._stats_collector.thread.is_alive())
+        for thread in agent._remover.threads:
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(self.client.subscribers, [])
+
+if __name__ == '__main__':
+    unittest.main()
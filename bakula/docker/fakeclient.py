@@ -0,0 +1,238 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import hashlib
+import threading
+import time
+from datetime import datetime
+from Queue import Queue
+
+from docker.errors import NotFound
+from bakula.docker.imageindex import normalize_tag
+from bakula.events.scheduler import Scheduler
+
+# Seconds a fake container runs for once started
+DEFAULT_RUN_TIME = 0.1
+
+# Memory every fake container reports using, and the host's total
+MEMORY_USAGE = 64 * 1024 * 1024
+MEMORY_LIMIT = 8 * 1024 * 1024 * 1024
+
+# class FakeDockerClient stands in for docker.Client with a simulated daemon
+# held in memory, so Bakula can be run and measured without Docker. It
+# answers the calls DockerAgent makes: images are "pulled" on request,
+# containers are created and started without running anything and exit
+# run_time seconds after starting, and the die and destroy events a daemon
+# would send are streamed from events(). Each call first sleeps for its
+# entry in latencies, or default_latency, to stand in for the daemon's
+# response time.
+#
+# on_start(container, started), if given, is called as each container
+# starts with its state, including the host path mounted as its "inbox",
+# and the time it started.
+class FakeDockerClient(object):
+
+    def __init__(self, run_time=DEFAULT_RUN_TIME, default_latency=0.0,
+                 latencies=None, on_start=None):
+        self.run_time = run_time
+        self.default_latency = default_latency
+        self.latencies = latencies or {}
+        self.on_start = on_start
+        self.lock = threading.Lock()
+        self.image_ids = {} # "repository:tag" -> image id
+        self.fake_containers = {} # id -> state of each container
+        self.created = 0
+        self.subscribers = [] # A queue per events() stream
+        self.closed = False
+        self.exits = Scheduler(self.__exit)
+
+    def __wait(self, method):
+        latency = self.latencies.get(method, self.default_latency)
+        if latency > 0:
+            time.sleep(latency)
+
+    def __container(self, container_id):
+        container = self.fake_containers.get(container_id)
+        if container is None:
+            raise NotFound("Not found", None,
+                           explanation="No such container: %s" % container_id)
+        return container
+
+    # Sends an event to every events() stream; expects the lock to be held
+    def __publish(self, action, container):
+        event = {'Type': 'container', 'Action': action, 'status': action,
+                 'id': container['Id'], 'Actor': {'ID': container['Id']},
+                 'time': int(time.time())}
+        for subscriber in self.subscribers:
+            subscriber.put(event)
+
+    def __exit(self, container_id):
+        with self.lock:
+            container = self.fake_containers.get(container_id)
+            if container is None or container['State'] != 'running':
+                return
+            container['State'] = 'exited'
+            self.__publish('die', container)
+            if container['AutoRemove']:
+                del self.fake_containers[container_id]
+                self.__publish('destroy', container)
+
+    def login(self, username, password, registry=None):
+        self.__wait('login')
+        return {'Status': 'Login Succeeded'}
+
+    def pull(self, repository, tag='latest', stream=False):
+        self.__wait('pull')
+        name = normalize_tag(repository, tag)
+        with self.lock:
+            self.image_ids[name] = 'sha256:%s' % hashlib.sha256(name).hexdigest()
+        return '{"status": "Downloaded newer image for %s"}' % name
+
+    def inspect_image(self, image):
+        self.__wait('inspect_image')
+        with self.lock:
+            image_id = self.image_ids.get(normalize_tag(image))
+        if image_id is None:
+            raise NotFound("Not found", None,
+                           explanation="No such image: %s" % image)
+        return {'Id': image_id, 'RepoTags': [normalize_tag(image)]}
+
+    def images(self):
+        self.__wait('images')
+        with self.lock:
+            tags = {}
+            for name, image_id in self.image_ids.items():
+                tags.setdefault(image_id, []).append(name)
+        return [{'Id': image_id, 'RepoTags': names}
+                for image_id, names in tags.items()]
+
+    def create_host_config(self, privileged=False, binds=None,
+                           port_bindings=None, **kwargs):
+        return {'Privileged': privileged, 'Binds': binds or [],
+                'PortBindings': port_bindings}
+
+    def create_container(self, image, command=None, host_config=None,
+                         volumes=None, environment=None, labels=None,
+                         **kwargs):
+        self.__wait('create_container')
+        host_config = host_config or {}
+        with self.lock:
+            if normalize_tag(image) not in self.image_ids:
+                raise NotFound("Not found", None,
+                               explanation="No such image: %s" % image)
+            self.created += 1
+            container_id = '%064x' % self.created
+            binds = host_config.get('Binds') or []
+            self.fake_containers[container_id] = {
+                'Id': container_id,
+                'Image': image,
+                'Labels': labels or {},
+                'State': 'created',
+                'AutoRemove': host_config.get('AutoRemove', False),
+                'inbox': binds[0].split(':')[0] if binds else None,
+                'started': None
+            }
+        return {'Id': container_id, 'Warnings': None}
+
+    def start(self, container, **kwargs):
+        self.__wait('start')
+        with self.lock:
+            state = self.__container(container)
+            if state['State'] == 'running':
+                return
+            state['State'] = 'running'
+            state['started'] = time.time()
+        self.exits.schedule(container, state['started'] + self.run_time)
+        if self.on_start is not None:
+            self.on_start(dict(state), state['started'])
+
+    def stop(self, container, timeout=10):
+        self.__wait('stop')
+        self.exits.cancel(container)
+        self.__exit(container)
+
+    def remove_container(self, container, v=False, link=False, force=False):
+        self.__wait('remove_container')
+        with self.lock:
+            state = self.__container(container)
+            if state['State'] == 'running' and not force:
+                raise Exception("Cannot remove a running container")
+            del self.fake_containers[container]
+            self.__publish('destroy', state)
+
+    def containers(self, quiet=False, all=False, filters=None, **kwargs):
+        self.__wait('containers')
+        filters = filters or {}
+        with self.lock:
+            listed = []
+            for state in self.fake_containers.values():
+                if not all and state['State'] != 'running':
+                    continue
+                if 'status' in filters and state['State'] != filters['status']:
+                    continue
+                if 'label' in filters:
+                    key, value = filters['label'].split('=', 1)
+                    if state['Labels'].get(key) != value:
+                        continue
+                listed.append({'Id': state['Id'], 'Image': state['Image'],
+                               'Labels': state['Labels'],
+                               'State': state['State']})
+            return listed
+
+    def stats(self, container, decode=None, stream=True):
+        self.__wait('stats')
+        with self.lock:
+            state = self.__container(container)
+            running_for = time.time() - (state['started'] or time.time())
+        now = time.time()
+        # Pretend the container keeps a quarter of one CPU busy
+        return {
+            'read': datetime.utcfromtimestamp(now).isoformat() + 'Z',
+            'memory_stats': {'usage': MEMORY_USAGE, 'limit': MEMORY_LIMIT},
+            'cpu_stats': {
+                'cpu_usage': {'total_usage': int(running_for * 0.25 * 1e9)},
+                'system_cpu_usage': int(now * 1e9)
+            }
+        }
+
+    # Ends every events() stream and stops running containers' clocks
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for subscriber in self.subscribers:
+                subscriber.put(None)
+        self.exits.stop()
+
+    # Streams container events until the caller stops reading or the client
+    # is closed
+    def events(self, since=None, until=None, filters=None, decode=None):
+        subscriber = Queue()
+        with self.lock:
+            if self.closed:
+                return
+            self.subscribers.append(subscriber)
+        wanted = (filters or {}).get('event')
+        try:
+            while True:
+                event = subscriber.get()
+                if event is None:
+                    return
+                if wanted is None or event['Action'] in wanted:
+                    yield event
+        finally:
+            with self.lock:
+                self.subscribers.remove(subscriber)
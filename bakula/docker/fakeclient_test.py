@@ -0,0 +1,102 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import threading
+import time
+from docker.errors import NotFound
+from fakeclient import FakeDockerClient
+from dockeragent import DockerAgent, MONITOR_EVENTS
+
+class FakeDockerClientTest(unittest.TestCase):
+
+    def test_images(self):
+        client = FakeDockerClient()
+
+        self.assertRaises(NotFound, client.inspect_image, 'busybox')
+        client.pull('busybox')
+        image_id = client.inspect_image('busybox:latest')['Id']
+        self.assertEqual(client.images(), [{'Id': image_id,
+                                            'RepoTags': ['busybox:latest']}])
+
+    def test_container_lifecycle(self):
+        started = []
+        client = FakeDockerClient(run_time=0.05,
+                                  on_start=lambda state, at: started.append(state))
+        events = client.events(filters={'event': ['die']})
+        client.pull('busybox')
+        host_config = client.create_host_config(binds=['/tmp/inbox:/inbox:rw'])
+        container_id = client.create_container('busybox',
+                                               host_config=host_config)['Id']
+
+        client.start(container_id)
+        self.assertEqual(started[0]['inbox'], '/tmp/inbox')
+        self.assertEqual(len(client.containers()), 1)
+
+        event = next(events)
+        self.assertEqual((event['Action'], event['id']), ('die', container_id))
+        self.assertEqual(client.containers(all=True,
+                                           filters={'status': 'exited'})[0]['Id'],
+                         container_id)
+        client.remove_container(container_id)
+        self.assertEqual(client.containers(all=True), [])
+        self.assertRaises(NotFound, client.remove_container, container_id)
+
+    def test_latency(self):
+        client = FakeDockerClient(latencies={'images': 0.1})
+
+        started = time.time()
+        client.images()
+        self.assertTrue(time.time() - started >= 0.1)
+
+    def test_close_ends_events(self):
+        client = FakeDockerClient()
+        events = client.events()
+        ended = []
+        thread = threading.Thread(target=lambda: ended.append(list(events)))
+        thread.start()
+        for i in range(500):
+            if len(client.subscribers) > 0:
+                break
+            time.sleep(0.01)
+
+        client.close()
+        thread.join(5)
+        self.assertEqual(ended, [[]])
+        self.assertEqual(list(client.events()), [])
+
+    def test_docker_agent(self):
+        client = FakeDockerClient(run_time=0.05)
+        agent = DockerAgent(docker_client=client, monitor=MONITOR_EVENTS,
+                            monitor_interval=0.1)
+        terminated = threading.Event()
+
+        agent.ensure_image('busybox')
+        agent.start_container('busybox', '/tmp/inbox',
+                              on_terminate=lambda id: terminated.set())
+
+        self.assertTrue(terminated.wait(5))
+        # The exited container is removed
+        for i in range(500):
+            if len(client.containers(all=True)) == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(client.containers(all=True), [])
+        agent.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import threading
+import time
+
+# Seconds the index is trusted before the daemon's image list is read again
+DEFAULT_MAX_AGE = 60.0
+
+# Image events after which the index may be out of date
+IMAGE_EVENTS = ['delete', 'import', 'load', 'pull', 'tag', 'untag']
+
+# Tag docker assumes when an image name doesn't give one
+DEFAULT_TAG = 'latest'
+
+# Adds tag to image_name unless it names one already. A colon before the
+# last slash belongs to a registry's port, not a tag.
+def normalize_tag(image_name, tag=DEFAULT_TAG):
+    if ':' in image_name.rsplit('/', 1)[-1]:
+        return image_name
+    return '%s:%s' % (image_name, tag)
+
+# class ImageIndex keeps the daemon's local images as a map from each
+# repository tag to its image id, so checking for an image doesn't list
+# every image on the host. The map is rebuilt from the daemon when a lookup
+# finds it older than max_age seconds or after invalidate() is called, such
+# as when the daemon reports an image event.
+class ImageIndex(object):
+
+    def __init__(self, docker_client, max_age=DEFAULT_MAX_AGE):
+        self.docker_client = docker_client
+        self.max_age = max_age
+        self.tags = {} # "repository:tag" -> image id
+        self.loaded = None # When tags was last read from the daemon
+        self.lock = threading.Lock()
+
+    # Reads every local image from the daemon and replaces the index
+    def refresh(self):
+        started = time.time()
+        tags = {}
+        for image in self.docker_client.images():
+            for tag in image.get('RepoTags') or []:
+                if tag != '<none>:<none>':
+                    tags[tag] = image['Id']
+        with self.lock:
+            self.tags = tags
+            self.loaded = started
+
+    # Marks the index out of date; the next lookup reads it again
+    def invalidate(self):
+        with self.lock:
+            self.loaded = None
+
+    # Records that image_name is now image_id, such as after a pull
+    def add(self, image_name, image_id, tag=DEFAULT_TAG):
+        with self.lock:
+            self.tags[normalize_tag(image_name, tag)] = image_id
+
+    # Returns the id of the local image tagged image_name, or None
+    def lookup(self, image_name):
+        with self.lock:
+            stale = (self.loaded is None or
+                     time.time() - self.loaded >= self.max_age)
+        if stale:
+            self.refresh()
+        with self.lock:
+            return self.tags.get(normalize_tag(image_name))
+
+    def contains(self, image_name):
+        return self.lookup(image_name) is not None
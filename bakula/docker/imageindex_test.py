@@ -0,0 +1,85 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+from imageindex import ImageIndex, normalize_tag
+from testclient import RecordingClient
+
+class ImageIndexTest(unittest.TestCase):
+
+    IMAGES = [
+        ('sha256:1', ['busybox:latest', 'busybox:1.25']),
+        ('sha256:2', ['registry:5000/team/app:latest']),
+        ('sha256:3', ['<none>:<none>']),
+        ('sha256:4', None),
+    ]
+
+    def __client(self, images=IMAGES):
+        client = RecordingClient()
+        for image_id, tags in images:
+            client.add_image(image_id, tags)
+        return client
+
+    def test_normalize_tag(self):
+        self.assertEqual(normalize_tag('busybox'), 'busybox:latest')
+        self.assertEqual(normalize_tag('busybox:1.25'), 'busybox:1.25')
+        self.assertEqual(normalize_tag('registry:5000/app'),
+                         'registry:5000/app:latest')
+
+    def test_exact_match(self):
+        index = ImageIndex(self.__client())
+
+        self.assertEqual(index.lookup('busybox'), 'sha256:1')
+        self.assertEqual(index.lookup('busybox:1.25'), 'sha256:1')
+        self.assertEqual(index.lookup('registry:5000/team/app'), 'sha256:2')
+        # Substrings of a tag don't count
+        self.assertFalse(index.contains('busy'))
+        self.assertFalse(index.contains('team/app'))
+        self.assertFalse(index.contains('<none>'))
+
+    def test_lookups_are_cached(self):
+        client = self.__client()
+        index = ImageIndex(client)
+
+        index.contains('busybox')
+        index.contains('other')
+        self.assertEqual(len(client.calls_to('images')), 1)
+
+        client.remove_image('sha256:1')
+        index.invalidate()
+        self.assertFalse(index.contains('busybox'))
+        self.assertEqual(len(client.calls_to('images')), 2)
+
+    def test_max_age(self):
+        client = self.__client()
+        index = ImageIndex(client, max_age=0)
+
+        index.contains('busybox')
+        index.contains('busybox')
+        self.assertEqual(len(client.calls_to('images')), 2)
+
+    def test_add(self):
+        client = self.__client([])
+        index = ImageIndex(client)
+        index.refresh()
+
+        index.add('busybox', 'sha256:1')
+        self.assertEqual(index.lookup('busybox:latest'), 'sha256:1')
+        self.assertEqual(len(client.calls_to('images')), 1)
+
+if __name__ == '__main__':
+    unittest.main()
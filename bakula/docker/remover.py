@@ -0,0 +1,105 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import threading
+from time import time
+from Queue import Queue
+from docker.errors import NotFound
+from bakula.events.scheduler import Scheduler
+
+# Threads removing containers at once
+DEFAULT_WORKERS = 4
+
+# Attempts at removing a container before giving up on it
+DEFAULT_RETRIES = 5
+
+# Seconds before the first retry; each further retry waits twice as long
+DEFAULT_BACKOFF = 1.0
+
+# class ContainerRemover removes exited containers on a pool of worker
+# threads. Removals are queued once per container; a removal that fails is
+# retried after a growing delay, up to a number of retries, without holding
+# up the others.
+class ContainerRemover(object):
+
+    def __init__(self, docker_client, workers=DEFAULT_WORKERS,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.docker_client = docker_client
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.attempts = {} # container id -> failed attempts, while queued
+        self.queue = Queue()
+        self.retry_scheduler = Scheduler(self.queue.put)
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.__work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    # Queues container_id for removal, unless it's already queued
+    def remove(self, container_id):
+        with self.lock:
+            if container_id in self.attempts:
+                return
+            self.attempts[container_id] = 0
+        self.queue.put(container_id)
+
+    # Number of containers waiting to be removed, including those waiting
+    # to be retried
+    def depth(self):
+        with self.lock:
+            return len(self.attempts)
+
+    # Stops the workers once the removals already queued are done, waiting
+    # up to timeout seconds for them. Removals waiting to be retried are
+    # dropped.
+    def stop(self, timeout=5):
+        self.retry_scheduler.stop(timeout)
+        for thread in self.threads:
+            self.queue.put(None)
+        deadline = time() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time()))
+
+    def __work(self):
+        while True:
+            container_id = self.queue.get()
+            if container_id is None:
+                return
+            try:
+                self.docker_client.remove_container(container_id)
+                self.__forget(container_id)
+            except NotFound:
+                # Already gone, most likely removed by the daemon itself
+                self.__forget(container_id)
+            except Exception as ex:
+                with self.lock:
+                    self.attempts[container_id] += 1
+                    attempts = self.attempts[container_id]
+                if attempts > self.retries:
+                    print "Giving up removing container %s: %s" % (container_id, ex)
+                    self.__forget(container_id)
+                else:
+                    delay = self.backoff * (2 ** (attempts - 1))
+                    self.retry_scheduler.schedule(container_id, time() + delay)
+
+    def __forget(self, container_id):
+        with self.lock:
+            self.attempts.pop(container_id, None)
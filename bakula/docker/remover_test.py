@@ -0,0 +1,86 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import threading
+from remover import ContainerRemover
+from testclient import RecordingClient
+
+class ContainerRemoverTest(unittest.TestCase):
+
+    def __wait_for_calls(self, remover, client, calls):
+        self.assertTrue(client.wait_for_calls('remove_container', calls))
+        for i in range(500):
+            if remover.depth() == 0:
+                break
+            threading.Event().wait(0.01)
+
+    def test_remove(self):
+        client = RecordingClient()
+        one = client.create()
+        remover = ContainerRemover(client, workers=2)
+
+        remover.remove(one)
+        # Already gone
+        remover.remove('gone')
+        self.__wait_for_calls(remover, client, 2)
+
+        self.assertEqual(sorted(client.calls_to('remove_container')),
+                         sorted([one, 'gone']))
+        self.assertEqual(remover.depth(), 0)
+
+    def test_retry_with_backoff(self):
+        client = RecordingClient()
+        one = client.create()
+        client.fail('remove_container', times=2, argument=one)
+        remover = ContainerRemover(client, workers=1, backoff=0.01)
+
+        remover.remove(one)
+        # Queuing it again while it's waiting to retry changes nothing
+        remover.remove(one)
+        self.__wait_for_calls(remover, client, 3)
+
+        self.assertEqual(client.calls_to('remove_container'), [one] * 3)
+        self.assertEqual(remover.depth(), 0)
+
+    def test_give_up(self):
+        client = RecordingClient()
+        one = client.create()
+        client.fail('remove_container', times=10, argument=one)
+        remover = ContainerRemover(client, workers=1, retries=1, backoff=0.01)
+
+        remover.remove(one)
+        self.__wait_for_calls(remover, client, 2)
+
+        self.assertEqual(client.calls_to('remove_container'), [one] * 2)
+        self.assertEqual(remover.depth(), 0)
+
+    def test_stop(self):
+        client = RecordingClient()
+        one = client.create()
+        remover = ContainerRemover(client, workers=2)
+
+        remover.remove(one)
+        remover.stop()
+
+        # Removals already queued are done first
+        self.assertEqual(client.calls_to('remove_container'), [one])
+        for thread in remover.threads:
+            self.assertFalse(thread.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import threading
+import time
+from Queue import Queue
+
+# Seconds between samples of a container while few are running
+DEFAULT_INTERVAL = 1.0
+
+# Threads taking samples; a one-shot stats call blocks for about a second
+# while the daemon measures CPU usage, so several run at once
+DEFAULT_WORKERS = 4
+
+# Most stats calls per second across all containers. Once more containers
+# are running than this allows at the base interval, each is sampled less
+# often. The workers are usually the tighter limit: each makes about one
+# call a second, so 4 workers manage 2 to 4 calls a second.
+DEFAULT_MAX_RATE = 20.0
+
+# class StatsCollector samples the stats of every watched container with
+# one-shot stats calls, instead of holding open a stream and a thread per
+# container. Every round samples each watched container once, spread over a
+# small pool of threads, and rounds start at most every interval seconds;
+# the interval stretches as containers are added so the calls made per
+# second stay under max_rate. A round doesn't start before the last one has
+# finished, so the rate never goes beyond what the workers can make either.
+class StatsCollector(object):
+
+    def __init__(self, docker_client, interval=DEFAULT_INTERVAL,
+                 workers=DEFAULT_WORKERS, max_rate=DEFAULT_MAX_RATE):
+        self.docker_client = docker_client
+        self.interval = interval
+        self.max_rate = max_rate
+        self.watched = {} # container id -> (topic, container name, processor)
+        self.condition = threading.Condition()
+        self.samples = Queue()
+        self.stopped = False
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.__sample)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.thread = threading.Thread(target=self.__collect)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Starts sampling container_id, handing each sample to
+    # stat_processor(stat, container_id, topic, container_name)
+    def watch(self, container_id, topic, container_name, stat_processor):
+        with self.condition:
+            self.watched[container_id] = (topic, container_name, stat_processor)
+            self.condition.notify()
+
+    # Stops sampling container_id
+    def unwatch(self, container_id):
+        with self.condition:
+            self.watched.pop(container_id, None)
+
+    # Stops sampling once the round in progress has finished, waiting up to
+    # timeout seconds for the threads
+    def stop(self, timeout=5):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        deadline = time.time() + timeout
+        self.thread.join(timeout)
+        for thread in self.threads:
+            self.samples.put(None)
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+
+    # Seconds between rounds with count containers watched
+    def current_interval(self, count):
+        if self.max_rate <= 0:
+            return self.interval
+        return max(self.interval, count / self.max_rate)
+
+    def __collect(self):
+        while True:
+            with self.condition:
+                while len(self.watched) == 0 and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                watched = self.watched.items()
+            started = time.time()
+            for container_id, watch in watched:
+                self.samples.put((container_id,) + watch)
+            # Don't start a round before the last one has finished
+            self.samples.join()
+            remaining = self.current_interval(len(watched)) - (time.time() - started)
+            if remaining > 0:
+                with self.condition:
+                    if not self.stopped:
+                        self.condition.wait(remaining)
+
+    def __sample(self):
+        while True:
+            sample = self.samples.get()
+            if sample is None:
+                return
+            container_id, topic, container_name, stat_processor = sample
+            try:
+                stat = self.docker_client.stats(container_id, decode=True,
+                                                stream=False)
+                if container_id in self.watched:
+                    stat_processor(stat, container_id, topic, container_name)
+            except Exception:
+                # The container has most likely gone; the terminate callback
+                # will stop us watching it
+                pass
+            finally:
+                self.samples.task_done()
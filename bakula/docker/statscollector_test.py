@@ -0,0 +1,72 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import threading
+from statscollector import StatsCollector
+from testclient import RecordingClient
+
+class StatsCollectorTest(unittest.TestCase):
+
+    def test_samples_every_watched_container(self):
+        client = RecordingClient()
+        collector = StatsCollector(client, interval=0.05)
+        containers = [client.run(), client.run()]
+        samples = dict((container_id, threading.Event())
+                       for container_id in containers)
+
+        def processor(stat, container_id, topic, container_name):
+            self.assertEqual(topic, "MyTopic")
+            samples[container_id].set()
+
+        for container_id in containers:
+            collector.watch(container_id, "MyTopic", "image", processor)
+        for container_id in containers:
+            self.assertTrue(samples[container_id].wait(5))
+
+        for container_id in containers:
+            collector.unwatch(container_id)
+        # Let a round in progress finish
+        threading.Event().wait(0.2)
+        calls = len(client.calls_to('stats'))
+        threading.Event().wait(0.2)
+        self.assertEqual(len(client.calls_to('stats')), calls)
+        collector.stop()
+
+    def test_interval_adapts_to_containers(self):
+        collector = StatsCollector(RecordingClient(), interval=1.0,
+                                   max_rate=10.0)
+        self.assertEqual(collector.current_interval(5), 1.0)
+        self.assertEqual(collector.current_interval(40), 4.0)
+        collector.stop()
+
+    def test_stop(self):
+        client = RecordingClient()
+        collector = StatsCollector(client, interval=60)
+        sampled = threading.Event()
+        collector.watch(client.run(), "MyTopic", "image",
+                        lambda *args: sampled.set())
+        self.assertTrue(sampled.wait(5))
+
+        # Doesn't wait out the interval
+        collector.stop(timeout=5)
+        self.assertFalse(collector.thread.is_alive())
+        for thread in collector.threads:
+            self.assertFalse(thread.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import hashlib
+import os
+import threading
+import time
+
+from bakula.docker.dockeragent import DockerAgent
+from bakula.docker.fakeclient import FakeDockerClient
+from bakula.docker.imageindex import normalize_tag
+
+# Seconds a test's containers run for; in effect until they're stopped
+TEST_RUN_TIME = 3600
+
+# class RecordingClient is the FakeDockerClient the unit tests share. On top
+# of the simulated daemon it
+#   - records the first argument of every call made to it (calls_to,
+#     wait_for_calls), the containers created and each started container's
+#     inbox listing as it starts,
+#   - fails calls to a method a number of times (fail), or holds them until
+#     they're released (hold, release),
+#   - sends events a test makes up to the open events() streams
+#     (wait_for_stream, send_event),
+#   - lists images the test adds (add_image, remove_image) and gives an
+#     image a new id when it's pulled after a new version was pushed (push).
+class RecordingClient(FakeDockerClient):
+
+    def __init__(self, run_time=TEST_RUN_TIME, **kwargs):
+        FakeDockerClient.__init__(self, run_time=run_time, **kwargs)
+        self.condition = threading.Condition()
+        self.calls = [] # (method, first argument) of every call made
+        self.failures = {} # (method, argument or None) -> calls left to fail
+        self.held = {} # method -> (entered, released) events
+        self.versions = {} # "repository:tag" -> versions pushed
+        self.untagged = [] # Ids of images listed without tags
+        self.created_containers = [] # id, image, inbox, environment, ...
+        self.started = [] # (container id, sorted listing of its inbox)
+
+    # Records a call, then holds or fails it as the test asked
+    def __call(self, method, argument=None):
+        with self.condition:
+            self.calls.append((method, argument))
+            self.condition.notify_all()
+            failing = None
+            for key in [(method, argument), (method, None)]:
+                if self.failures.get(key, 0) > 0:
+                    self.failures[key] -= 1
+                    failing = key
+                    break
+            held = self.held.get(method)
+        if held is not None:
+            entered, released = held
+            entered.set()
+            released.wait(5)
+        if failing is not None:
+            raise Exception("Timed out")
+
+    # The first arguments of the calls made to method so far
+    def calls_to(self, method):
+        with self.condition:
+            return [argument for called, argument in self.calls
+                    if called == method]
+
+    # Waits up to timeout seconds for method to have been called count
+    # times. Returns False if it wasn't.
+    def wait_for_calls(self, method, count, timeout=5):
+        deadline = time.time() + timeout
+        with self.condition:
+            while len([called for called, argument in self.calls
+                       if called == method]) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    # Fails the next times calls to method, only those for argument if
+    # it's given
+    def fail(self, method, times=1, argument=None):
+        with self.condition:
+            self.failures[(method, argument)] = times
+
+    # Holds calls to method until release(method). Returns an event set
+    # once a call is being held.
+    def hold(self, method):
+        entered = threading.Event()
+        with self.condition:
+            self.held[method] = (entered, threading.Event())
+        return entered
+
+    def release(self, method):
+        with self.condition:
+            self.held[method][1].set()
+
+    # Waits up to timeout seconds for an events() stream to be open.
+    # Returns False if none was opened.
+    def wait_for_stream(self, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if len(self.subscribers) > 0:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    # Sends event to the open events() streams once there is one. Returns
+    # False if no stream was opened within timeout seconds.
+    def send_event(self, event, timeout=5):
+        if not self.wait_for_stream(timeout):
+            return False
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.put(event)
+        return True
+
+    # Lists image_id under tags, or without any when tags is None
+    def add_image(self, image_id, tags):
+        with self.lock:
+            if tags is None:
+                self.untagged.append(image_id)
+            for tag in tags or []:
+                self.image_ids[tag] = image_id
+
+    # Removes an image by id, or one of its tags
+    def remove_image(self, image):
+        self.__call('remove_image', image)
+        with self.lock:
+            for name, image_id in self.image_ids.items():
+                if image in (image_id, name):
+                    del self.image_ids[name]
+            if image in self.untagged:
+                self.untagged.remove(image)
+
+    # Stands in for a new version of an image being pushed to the registry;
+    # the next pull gives it a new id
+    def push(self, repository, tag='latest'):
+        name = normalize_tag(repository, tag)
+        with self.lock:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+    # Pulls image and creates a container of it. Returns its id.
+    def create(self, image='busybox', **kwargs):
+        self.pull(image)
+        return self.create_container(image, **kwargs)['Id']
+
+    # Pulls image, then creates and starts a container of it. Returns its id.
+    def run(self, image='busybox', **kwargs):
+        container_id = self.create(image, **kwargs)
+        self.start(container_id)
+        return container_id
+
+    def pull(self, repository, tag='latest', stream=False):
+        self.__call('pull', repository)
+        pulled = FakeDockerClient.pull(self, repository, tag=tag,
+                                       stream=stream)
+        name = normalize_tag(repository, tag)
+        with self.lock:
+            version = self.versions.get(name, 0)
+            if version > 0:
+                self.image_ids[name] = 'sha256:%s' % hashlib.sha256(
+                    '%s#%d' % (name, version)).hexdigest()
+        return pulled
+
+    def inspect_image(self, image):
+        self.__call('inspect_image', image)
+        return FakeDockerClient.inspect_image(self, image)
+
+    def images(self):
+        self.__call('images')
+        listed = FakeDockerClient.images(self)
+        with self.lock:
+            return listed + [{'Id': image_id, 'RepoTags': None}
+                             for image_id in self.untagged]
+
+    def create_container(self, image, command=None, host_config=None,
+                         volumes=None, environment=None, labels=None,
+                         working_dir=None, **kwargs):
+        self.__call('create_container', image)
+        container = FakeDockerClient.create_container(
+            self, image, command=command, host_config=host_config,
+            volumes=volumes, environment=environment, labels=labels,
+            **kwargs)
+        binds = (host_config or {}).get('Binds') or []
+        with self.condition:
+            self.created_containers.append({
+                'id': container['Id'],
+                'image': image,
+                'inbox': binds[0].split(':')[0] if binds else None,
+                'command': command,
+                'environment': environment,
+                'working_dir': working_dir
+            })
+        return container
+
+    def start(self, container, **kwargs):
+        self.__call('start', container)
+        FakeDockerClient.start(self, container, **kwargs)
+        with self.lock:
+            inbox = self.fake_containers.get(container, {}).get('inbox')
+        listing = []
+        if inbox is not None and os.path.isdir(inbox):
+            listing = sorted(os.listdir(inbox))
+        with self.condition:
+            self.started.append((container, listing))
+
+    def stop(self, container, timeout=10):
+        self.__call('stop', container)
+        FakeDockerClient.stop(self, container, timeout=timeout)
+
+    def remove_container(self, container, v=False, link=False, force=False):
+        self.__call('remove_container', container)
+        FakeDockerClient.remove_container(self, container, v=v, link=link,
+                                          force=force)
+
+    def containers(self, quiet=False, all=False, filters=None, **kwargs):
+        self.__call('containers')
+        return FakeDockerClient.containers(self, quiet=quiet, all=all,
+                                           filters=filters, **kwargs)
+
+    def stats(self, container, decode=None, stream=True):
+        if stream:
+            raise ValueError("Only one-shot stats are expected")
+        self.__call('stats', container)
+        return FakeDockerClient.stats(self, container, decode=decode,
+                                      stream=stream)
+
+# Makes a DockerAgent following a new RecordingClient's events, and returns
+# both. The client's containers run for run_time seconds.
+def recording_agent(run_time=TEST_RUN_TIME, **kwargs):
+    client = RecordingClient(run_time=run_time)
+    kwargs.setdefault('monitor_interval', 0.1)
+    return DockerAgent(docker_client=client, **kwargs), client
@@ -0,0 +1,161 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import errno
+import os
+import threading
+from time import time
+
+# Durability modes for inbox writes
+DURABILITY_NONE = "none"
+DURABILITY_FSYNC = "fsync"
+DURABILITY_GROUP = "group"
+
+DEFAULT_INTERVAL = 0.005
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+class CommitException(Exception):
+    pass
+
+# A set of writes that will be made durable together
+class _Batch(object):
+    def __init__(self):
+        self.fds = []
+        self.directories = set()
+        self.size = 0
+        self.done = False
+        self.error = None
+
+    def empty(self):
+        return len(self.fds) == 0 and len(self.directories) == 0
+
+# class GroupCommitter makes inbox writes durable. Writers hand over a file
+# descriptor for what they just wrote and block until it has been fsynced.
+# With an interval of zero every commit is fsynced on the spot; otherwise a
+# committer thread gathers the commits arriving within the interval (or until
+# max_bytes are pending) and fsyncs them as one batch, so concurrent writers
+# share the cost of a single flush.
+class GroupCommitter(object):
+
+    def __init__(self, interval=DEFAULT_INTERVAL, max_bytes=DEFAULT_MAX_BYTES):
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # The committer waits on 'pending' for work, writers wait on
+        # 'committed' for their batch to finish
+        self.pending = threading.Condition(self.lock)
+        self.committed = threading.Condition(self.lock)
+        self.batch = _Batch()
+        self.commit_thread = None
+        if self.interval > 0:
+            self.commit_thread = threading.Thread(target=self.__run)
+            self.commit_thread.daemon = True
+            self.commit_thread.start()
+
+    # Fsyncs and closes the given descriptors, then fsyncs the directories
+    # they were created in so the new names are durable too
+    def __sync(self, fds, directories):
+        error = None
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            except OSError as ex:
+                error = ex
+            finally:
+                os.close(fd)
+        for directory in directories:
+            try:
+                dir_fd = os.open(directory, os.O_RDONLY)
+            except OSError as ex:
+                # The directory may have been promoted away in the meantime
+                if ex.errno != errno.ENOENT:
+                    error = ex
+                continue
+            try:
+                os.fsync(dir_fd)
+            except OSError as ex:
+                error = ex
+            finally:
+                os.close(dir_fd)
+        if error is not None:
+            raise CommitException("Could not fsync inbox write: %s" % error)
+
+    def __run(self):
+        while True:
+            with self.lock:
+                while self.batch.empty():
+                    self.pending.wait()
+
+                # Give concurrent writers a chance to join this batch
+                deadline = time() + self.interval
+                while self.batch.size < self.max_bytes:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    self.pending.wait(remaining)
+
+                batch = self.batch
+                self.batch = _Batch()
+
+            try:
+                self.__sync(batch.fds, batch.directories)
+            except Exception as ex:
+                batch.error = ex
+
+            with self.lock:
+                batch.done = True
+                self.committed.notify_all()
+
+    # Blocks until the writes behind fds (and their entries in directory) are
+    # durable. Takes ownership of the descriptors, which are closed once
+    # synced. Raises a CommitException if the fsync failed. Returns straight
+    # away when given neither descriptors nor a directory.
+    def commit(self, fds, size=0, directory=None):
+        directories = [directory] if directory is not None else []
+        if len(fds) == 0 and len(directories) == 0:
+            return
+        if self.commit_thread is None:
+            self.__sync(fds, directories)
+            return
+
+        with self.lock:
+            batch = self.batch
+            first = batch.empty()
+            batch.fds.extend(fds)
+            batch.directories.update(directories)
+            batch.size += size
+            # Wake the committer for the first write of a batch, and again if
+            # this write fills the byte budget
+            if first or batch.size >= self.max_bytes:
+                self.pending.notify()
+            while not batch.done:
+                self.committed.wait()
+
+        if batch.error is not None:
+            raise batch.error
+
+# Creates the committer for a durability mode, or None when writes do not
+# need to be made durable
+def create_committer(durability, interval=DEFAULT_INTERVAL,
+                     max_bytes=DEFAULT_MAX_BYTES):
+    if durability == DURABILITY_NONE:
+        return None
+    elif durability == DURABILITY_FSYNC:
+        return GroupCommitter(interval=0)
+    elif durability == DURABILITY_GROUP:
+        return GroupCommitter(interval=interval, max_bytes=max_bytes)
+    raise ValueError("Unknown durability mode %s" % durability)
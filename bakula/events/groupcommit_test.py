@@ -0,0 +1,108 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from groupcommit import (GroupCommitter, create_committer, DURABILITY_NONE,
+                         DURABILITY_FSYNC, DURABILITY_GROUP)
+from inboxer import Inboxer
+from segmentinboxer import SegmentInboxer
+
+class GroupCommitterTest(unittest.TestCase):
+
+    TEST_DIR = os.path.join(tempfile.gettempdir(), 'groupcommit_test')
+
+    def setUp(self):
+        os.makedirs(self.TEST_DIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    def __open_file(self, name):
+        path = os.path.join(self.TEST_DIR, name)
+        with open(path, "w") as fout:
+            fout.write(name)
+        return os.open(path, os.O_RDONLY)
+
+    def __assert_closed(self, fd):
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+    def test_create_committer(self):
+        self.assertIsNone(create_committer(DURABILITY_NONE))
+        self.assertIsNone(create_committer(DURABILITY_FSYNC).commit_thread)
+        self.assertIsNotNone(create_committer(DURABILITY_GROUP).commit_thread)
+        with self.assertRaises(ValueError):
+            create_committer("sometimes")
+
+    def test_commit_immediately(self):
+        committer = GroupCommitter(interval=0)
+        fd = self.__open_file("immediate")
+        committer.commit([fd], 9, self.TEST_DIR)
+        self.__assert_closed(fd)
+
+    def test_group_commit(self):
+        committer = GroupCommitter(interval=0.05)
+        fds = [self.__open_file("file%d" % i) for i in range(10)]
+
+        threads = [threading.Thread(target=committer.commit,
+                                    args=([fd], 5, self.TEST_DIR))
+                   for fd in fds]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+        for fd in fds:
+            self.__assert_closed(fd)
+
+    def test_group_commit_byte_budget(self):
+        # With a huge interval, only the byte budget can release the writer
+        committer = GroupCommitter(interval=60, max_bytes=10)
+        fd = self.__open_file("big")
+        thread = threading.Thread(target=committer.commit,
+                                  args=([fd], 100, self.TEST_DIR))
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_group_commit_without_files(self):
+        committer = GroupCommitter(interval=0.05)
+
+        # Neither call may wait for a batch that never comes
+        for args in [([],), ([], 0, self.TEST_DIR)]:
+            thread = threading.Thread(target=committer.commit, args=args)
+            thread.daemon = True
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_durable_inboxers(self):
+        for inboxer_class in [Inboxer, SegmentInboxer]:
+            inboxer = inboxer_class(
+                os.path.join(self.TEST_DIR, inboxer_class.__name__, "master"),
+                os.path.join(self.TEST_DIR, inboxer_class.__name__, "inboxes"),
+                committer=GroupCommitter(interval=0.01))
+            self.assertIsNotNone(inboxer.add_file_by_bytes("MyTopic", "data"))
+            self.assertEqual(inboxer.get_inbox_count("MyTopic"), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,11 +16,39 @@
 #   under the License.
 
 import os
+import shutil
+import tempfile
+import threading
 from atomiclong import AtomicLong
+from uuid import uuid4
 
 DEFAULT_MASTER_INBOX="master_inbox"
 DEFAULT_CONTAINER_INBOXES="container_inboxes"
 
+# Uploads are spooled here before being renamed into a topic; it lives inside
+# the master inbox so the rename never crosses a filesystem boundary. Spools
+# that have been accepted for a topic, but not yet added to it, wait in
+# .incoming/<topic>.
+INCOMING_DIRECTORY=".incoming"
+
+# Size of each read when copying an upload stream to disk
+DEFAULT_CHUNK_SIZE=64 * 1024
+
+# Promotion modes; either hard link every file into the container inbox and
+# remove the originals, or rename the whole topic directory into place
+PROMOTE_LINK="link"
+PROMOTE_RENAME="rename"
+
+# Stands in for the topic lock when writers don't need one
+class _NoLock(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NO_LOCK=_NoLock()
+
 # class Inboxer provides basic capabilities to put a file in the master inbox,
 # create a hardlink to that file in the correct container inboxes path and then
 # delete the original file in the master inbox.
@@ -31,21 +59,38 @@ class Inboxer(object):
     def __init__(self,
                  master_inbox_path=DEFAULT_MASTER_INBOX,
                  container_inboxes_path=DEFAULT_CONTAINER_INBOXES,
-                 atomic_counter=AtomicLong(0)):
+                 atomic_counter=AtomicLong(0),
+                 committer=None,
+                 promotion=PROMOTE_LINK):
+        if promotion not in (PROMOTE_LINK, PROMOTE_RENAME):
+            raise ValueError("Unknown promotion mode %s" % promotion)
+        self.promotion = promotion
         self.master_inbox_path = master_inbox_path
         self.container_inboxes_path = container_inboxes_path
         self.atomic_counter = atomic_counter
+        self.committer = committer # Makes writes durable; see groupcommit
         self.event_subscriptions = {} # Keep callbacks for events subscribed to
         self.count_cache = {} # Keep a cache of file counts; faster than recounting
+        self.count_lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+        self.topic_locks = {} # Per topic locks for backends that need them
+        self.incoming_path = os.path.join(self.master_inbox_path,
+                                          INCOMING_DIRECTORY)
 
         if not os.path.exists(self.master_inbox_path):
             os.makedirs(self.master_inbox_path)
 
+        if not os.path.exists(self.incoming_path):
+            os.makedirs(self.incoming_path)
+
         if not os.path.exists(self.container_inboxes_path):
             os.makedirs(self.container_inboxes_path)
 
+        self._reconcile_count_cache()
+        self._recover_incoming()
+
     # This method is called to trigger an event
-    def __trigger_event_subscription(self, event, data=None):
+    def _trigger_event_subscription(self, event, data=None):
         if (event in self.event_subscriptions and
                 self.event_subscriptions[event] is not None):
             self.event_subscriptions[event](data)
@@ -59,18 +104,86 @@ class Inboxer(object):
 
         return count
 
+    # Scans the master inbox once at startup so the count cache reflects any
+    # events left over from a previous run. The atomic counter is moved past
+    # the highest existing file name so new events can't overwrite old ones.
+    def _reconcile_count_cache(self):
+        highest = 0
+        for topic in os.listdir(self.master_inbox_path):
+            master_topic_path = os.path.join(self.master_inbox_path, topic)
+            if topic == INCOMING_DIRECTORY or not os.path.isdir(master_topic_path):
+                continue
+            self.count_cache[topic] = self.__get_file_count(topic)
+            for fname in os.listdir(master_topic_path):
+                if fname.isdigit():
+                    highest = max(highest, int(fname))
+
+        self._advance_counter(highest)
+
+    # Adds the spools a previous run accepted for a topic but didn't get to
+    # add, and removes the ones it was still writing, which were never
+    # accepted
+    def _recover_incoming(self):
+        for name in os.listdir(self.incoming_path):
+            path = os.path.join(self.incoming_path, name)
+            if not os.path.isdir(path):
+                os.remove(path)
+                continue
+            for fname in sorted(os.listdir(path)):
+                spooled = os.path.join(path, fname)
+                if self.add_file_by_path(name, spooled, notify=False) is None:
+                    print "Recovering spooled event %s failed" % spooled
+            if len(os.listdir(path)) == 0:
+                os.rmdir(path)
+
     # Get a count from the cache count
     def __get_count_cache(self, topic):
-        if topic not in self.count_cache:
-            self.count_cache[topic] = __get_file_count(topic)
-        return self.count_cache[topic]
+        return self.count_cache.get(topic, 0)
 
-    # Update the count cache
-    def __update_count_cache(self, topic, count=None):
-        if count is None:
-            self.count_cache[topic] = self.__get_file_count(topic)
-        else:
-            self.count_cache[topic] = count
+    # Adjust the cached count of a topic by amount (which may be negative)
+    def _update_count_cache(self, topic, amount):
+        with self.count_lock:
+            self.count_cache[topic] = self.count_cache.get(topic, 0) + amount
+
+    # Reserves the next count values of the atomic counter and returns the
+    # last one; incrementing and reading the value must happen together or two
+    # writers could get the same name
+    def _next_counter(self, count=1):
+        with self.counter_lock:
+            self.atomic_counter += count
+            return self.atomic_counter.value
+
+    # Moves the atomic counter forward to at least highest
+    def _advance_counter(self, highest):
+        with self.counter_lock:
+            if highest > self.atomic_counter.value:
+                self.atomic_counter.value = highest
+
+    # Gets (creating if needed) the lock guarding a single topic
+    def _get_topic_lock(self, topic):
+        lock = self.topic_locks.get(topic)
+        if lock is None:
+            with self.count_lock:
+                lock = self.topic_locks.setdefault(topic, threading.Lock())
+        return lock
+
+    # In rename mode writers hold the topic lock while they add to a topic so
+    # its directory can't be swapped out from under them. Link mode promotion
+    # never moves the directory, so writers don't need to lock.
+    def __writing(self, topic):
+        if self.promotion == PROMOTE_RENAME:
+            return self._get_topic_lock(topic)
+        return NO_LOCK
+
+    # Hands the descriptors of a finished write to the committer, blocking
+    # until they are durable. Returns False if the write couldn't be synced.
+    def _commit(self, fds, directory, size=0):
+        try:
+            self.committer.commit(fds, size, directory)
+            return True
+        except Exception as ex:
+            print "Making inbox write durable failed due to %s" % ex
+            return False
 
     # Registers a callback for a specific event
     # Don't care to support multiple registrations per event. Right now at
@@ -79,51 +192,171 @@ class Inboxer(object):
         self.event_subscriptions[event] = callback
 
     # Takes a topic and a path to a file on the file system and moved it into
-    # the master inbox removing it from its original location
-    def add_file_by_path(self, topic, file_path):
+    # the master inbox removing it from its original location. With notify
+    # set to False the "received" subscriber isn't called.
+    def add_file_by_path(self, topic, file_path, notify=True):
         master_topic_path = os.path.join(self.master_inbox_path, topic)
-        if not os.path.exists(master_topic_path):
-            os.makedirs(master_topic_path)
-        self.atomic_counter += 1
-        counter = self.atomic_counter.value
-
-        # Move into the master inbox under the correct topic with an updated
-        # count
-        destination = os.path.join(master_topic_path, str(counter))
-        if os.path.exists(file_path):
+        if not os.path.exists(file_path):
+            print "Cannot add %s to the master inbox; it does not exist" % file_path
+            return None
+        # Hold on to the file before moving it so it can still be synced if
+        # it's promoted out of the master inbox in the meantime
+        fd = os.open(file_path, os.O_RDONLY) if self.committer else None
+
+        with self.__writing(topic):
+            if not os.path.exists(master_topic_path):
+                os.makedirs(master_topic_path)
+            counter = self._next_counter()
+
+            # Move into the master inbox under the correct topic with an
+            # updated count
+            destination = os.path.join(master_topic_path, str(counter))
             try:
                 os.rename(file_path, destination)
             except Exception as ex:
                 print "Writing to master inbox failed due to %s" % ex
+                if fd is not None:
+                    os.close(fd)
                 return None
 
-        self.__update_count_cache(topic)
-        self.__trigger_event_subscription("received", {"topic": topic})
+            # The event counts as pending even if syncing fails, since the
+            # file is in the inbox either way; the caller just can't rely on
+            # it surviving a crash
+            self._update_count_cache(topic, 1)
+
+        if fd is not None and not self._commit([fd], master_topic_path,
+                                               os.fstat(fd).st_size):
+            return None
+
+        if notify:
+            self.notify_received(topic)
         return counter
 
     # Takes a topic and data and writes it to the master inbox
-    def add_file_by_bytes(self, topic, data):
+    def add_file_by_bytes(self, topic, data, notify=True):
+        master_topic_path = os.path.join(self.master_inbox_path, topic)
+        fd = None
+        with self.__writing(topic):
+            if not os.path.exists(master_topic_path):
+                os.makedirs(master_topic_path)
+            counter = self._next_counter()
+
+            # Move into the master inbox under the correct topic with an
+            # updated count
+            destination = os.path.join(master_topic_path, str(counter))
+            if not os.path.exists(destination):
+                try:
+                    with open(destination, "w") as fout:
+                        fout.write(data)
+                        if self.committer:
+                            fd = os.dup(fout.fileno())
+                except Exception as ex:
+                    print "Writing to master inbox failed due to %s" % ex
+                    return None
+
+            # The event counts as pending even if syncing fails, since the
+            # file is in the inbox either way; the caller just can't rely on
+            # it surviving a crash
+            self._update_count_cache(topic, 1)
+
+        if fd is not None and not self._commit([fd], master_topic_path,
+                                               len(data)):
+            return None
+
+        if notify:
+            self.notify_received(topic)
+        return counter
+
+    # Takes a topic and a list of records and writes each one to the master
+    # inbox as its own event. The events get consecutive counters and the
+    # subscriber is notified once for the whole batch. Returns the first and
+    # last counter assigned.
+    def add_batch(self, topic, records, notify=True):
+        if len(records) == 0:
+            return None
         master_topic_path = os.path.join(self.master_inbox_path, topic)
-        if not os.path.exists(master_topic_path):
-            os.makedirs(master_topic_path)
-        self.atomic_counter += 1
-        counter = self.atomic_counter.value
-
-        # Move into the master inbox under the correct topic with an updated
-        # count
-        destination = os.path.join(master_topic_path, str(counter))
-        if not os.path.exists(destination):
+        fds = []
+        written = 0
+        size = 0
+        with self.__writing(topic):
+            if not os.path.exists(master_topic_path):
+                os.makedirs(master_topic_path)
+            last = self._next_counter(len(records))
+            first = last - len(records) + 1
+
             try:
-                with open(destination, "w") as fout:
-                    fout.write(data)
+                for record in records:
+                    destination = os.path.join(master_topic_path,
+                                               str(first + written))
+                    with open(destination, "w") as fout:
+                        fout.write(record)
+                        if self.committer:
+                            fds.append(os.dup(fout.fileno()))
+                    written += 1
+                    size += len(record)
             except Exception as ex:
-                print "Writing to master inbox failed due to %s" % ex
+                print "Writing batch to master inbox failed due to %s" % ex
+                for fd in fds:
+                    os.close(fd)
+                self._update_count_cache(topic, written)
                 return None
 
-        self.__update_count_cache(topic)
-        self.__trigger_event_subscription("received", {"topic": topic})
+            self._update_count_cache(topic, written)
+
+        if self.committer and not self._commit(fds, master_topic_path, size):
+            return None
+
+        if notify:
+            self.notify_received(topic)
+        return (first, last)
+
+    # Copies a file-like object, chunk_size bytes at a time, into a temporary
+    # file next to the master inbox and returns its path (or None on failure).
+    # Memory use stays bounded regardless of the payload size. Given a topic,
+    # the finished spool is set aside for it so that it is added to the topic
+    # at startup should the process stop before it has been.
+    def spool(self, stream, chunk_size=DEFAULT_CHUNK_SIZE, topic=None):
+        fd, temp_path = tempfile.mkstemp(dir=self.incoming_path)
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                shutil.copyfileobj(stream, fout, chunk_size)
+            if topic is not None:
+                accepted_path = os.path.join(self.incoming_path, topic)
+                try:
+                    os.makedirs(accepted_path)
+                except OSError:
+                    # Another request made it first
+                    if not os.path.isdir(accepted_path):
+                        raise
+                accepted = os.path.join(accepted_path,
+                                        os.path.basename(temp_path))
+                os.rename(temp_path, accepted)
+                temp_path = accepted
+        except Exception as ex:
+            print "Spooling to master inbox failed due to %s" % ex
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        return temp_path
+
+    # Takes a topic and a file-like object and spools it to disk before moving
+    # it into the master inbox
+    def add_file_by_stream(self, topic, stream, chunk_size=DEFAULT_CHUNK_SIZE,
+                           notify=True):
+        temp_path = self.spool(stream, chunk_size)
+        if temp_path is None:
+            return None
+
+        counter = self.add_file_by_path(topic, temp_path, notify)
+        if counter is None and os.path.exists(temp_path):
+            os.remove(temp_path)
         return counter
 
+    # Tells the subscriber that events have been received for a topic. Used by
+    # callers that add files with notify=False.
+    def notify_received(self, topic):
+        self._trigger_event_subscription("received", {"topic": topic})
+
     # Gets a listing of files currently in the master queue for the specified
     # topic
     def get_inbox_list(self, topic):
@@ -140,9 +373,56 @@ class Inboxer(object):
     def get_inbox_count(self, topic):
         return self.__get_count_cache(topic)
 
+    # Promotes the whole topic directory by renaming it to the first
+    # container inbox and starting a fresh one. Every event written before
+    # the swap is promoted and every event written after it is not. Returns
+    # None if the swap couldn't be made.
+    def __promote_by_rename(self, topic, containerids):
+        master_topic_path = os.path.join(self.master_inbox_path, topic)
+        first_inbox = os.path.join(self.container_inboxes_path,
+                                   containerids[0])
+        with self._get_topic_lock(topic):
+            promoted = self.__get_count_cache(topic)
+            if promoted == 0 or not os.path.exists(master_topic_path):
+                return None
+            try:
+                os.rename(master_topic_path, first_inbox)
+                os.makedirs(master_topic_path)
+            except Exception as ex:
+                print "Swapping topic directory failed due to %s" % ex
+                return None
+            self._update_count_cache(topic, -promoted)
+
+        # Every other container gets hard links to the same files
+        container_inboxes = [first_inbox]
+        for containerid in containerids[1:]:
+            container_inbox_path = os.path.join(self.container_inboxes_path,
+                                                containerid)
+            if not os.path.exists(container_inbox_path):
+                os.makedirs(container_inbox_path)
+            try:
+                for fname in os.listdir(first_inbox):
+                    os.link(os.path.join(first_inbox, fname),
+                            os.path.join(container_inbox_path, fname))
+            except Exception as ex:
+                print "Generating hard links failed due to %s" % ex
+                return None
+            container_inboxes.append(container_inbox_path)
+
+        return container_inboxes
+
     # Promotes a file from the master inbox into a container inbox delineated
     # by container id
     def promote_to_container_inbox(self, topic, containerids):
+        if self.promotion == PROMOTE_RENAME:
+            isArray = not isinstance(containerids, basestring)
+            containerids = containerids if isArray else [containerids]
+            first_inbox = os.path.join(self.container_inboxes_path,
+                                       containerids[0])
+            # Renaming only works onto a missing (or empty) directory
+            if not os.path.exists(first_inbox) or not os.listdir(first_inbox):
+                return self.__promote_by_rename(topic, containerids)
+
         promotees = self.get_inbox_list(topic)
         container_inboxes = []
         if len(promotees) > 0:
@@ -171,18 +451,210 @@ class Inboxer(object):
                         print "Generating hard links failed due to %s" % ex
                         return None
 
+            removed = 0
             for fname in promotees:
                 fullpath = os.path.join(self.master_inbox_path, topic, fname)
                 if os.stat(fullpath).st_nlink > 0:
                     # Hard link created successfully; delete the original
                     try:
                         os.remove(fullpath)
+                        removed += 1
                     except Exception as ex:
                         print ("Deleting master inbox files after promotion"
                                "failed due to %s") % ex
+                        self._update_count_cache(topic, -removed)
                         return None
                 else:
                     print "Failure creating hard link on %s" % fullpath
 
-            self.__update_count_cache(topic)
+            self._update_count_cache(topic, -removed)
             return container_inboxes
+
+    # Promotes the files waiting for a topic into as many new container
+    # inboxes as it takes to hold at most batch_size files each, oldest first.
+    # A batch_size of zero (or None) means a single inbox. Returns the list of
+    # created inboxes.
+    def promote_in_batches(self, topic, batch_size):
+        if not batch_size or batch_size <= 0:
+            return self.promote_to_container_inbox(topic, str(uuid4()))
+
+        if self.promotion == PROMOTE_RENAME:
+            # Take everything in one swap, then move the overflow out of the
+            # first inbox into the others
+            container_inboxes = self.__promote_by_rename(topic, [str(uuid4())])
+            if container_inboxes is None:
+                return None
+            source = container_inboxes[0]
+            promotees = sorted(os.listdir(source), key=int)[batch_size:]
+        else:
+            source = os.path.join(self.master_inbox_path, topic)
+            container_inboxes = []
+            promotees = sorted(self.get_inbox_list(topic), key=int)
+        if len(promotees) == 0:
+            return container_inboxes or None
+
+        moved = 0
+        try:
+            for i in range(0, len(promotees), batch_size):
+                container_inbox_path = os.path.join(
+                    self.container_inboxes_path, str(uuid4()))
+                os.makedirs(container_inbox_path)
+                container_inboxes.append(container_inbox_path)
+                for fname in promotees[i:i + batch_size]:
+                    # A single rename moves the file; nothing to link or
+                    # clean up afterwards
+                    os.rename(os.path.join(source, fname),
+                              os.path.join(container_inbox_path, fname))
+                    moved += 1
+        except Exception as ex:
+            # Whatever wasn't moved stays where it was, either on the topic
+            # or in the first inbox, so hand over the inboxes filled so far
+            print "Splitting inbox into batches failed due to %s" % ex
+            if container_inboxes and not os.listdir(container_inboxes[-1]):
+                os.rmdir(container_inboxes.pop())
+            return container_inboxes or None
+        finally:
+            if self.promotion != PROMOTE_RENAME:
+                self._update_count_cache(topic, -moved)
+
+        return container_inboxes
+
+    # Delivers the files waiting for a topic to several subscribers at once.
+    # batch_sizes holds one max batch size per subscriber (0 or None for no
+    # limit) and the result holds, in the same order, the list of inboxes
+    # created for each subscriber. Returns None if nothing was promoted.
+    def fan_out(self, topic, batch_sizes):
+        if len(batch_sizes) == 1:
+            container_inboxes = self.promote_in_batches(topic, batch_sizes[0])
+            return [container_inboxes] if container_inboxes else None
+        return self._fan_out(topic, batch_sizes)
+
+    # Fans out in a single pass: the topic is listed once and every file is
+    # hard linked into one inbox per subscriber before the original goes
+    def _fan_out(self, topic, batch_sizes):
+        if self.promotion == PROMOTE_RENAME:
+            # Swap the topic out of the way so writers carry on into a fresh
+            # directory while we link
+            swapped = self.__promote_by_rename(topic, [str(uuid4())])
+            if swapped is None:
+                return None
+            source = swapped[0]
+            promotees = os.listdir(source)
+        else:
+            source = os.path.join(self.master_inbox_path, topic)
+            promotees = self.get_inbox_list(topic)
+        if len(promotees) == 0:
+            return None
+
+        promotees = sorted(promotees, key=int)
+        linked = self._link_batches(source, promotees, batch_sizes)
+        if self.promotion == PROMOTE_RENAME:
+            # Anything that couldn't be delivered goes back to the topic
+            leftovers = os.listdir(source)
+            if len(leftovers) > 0:
+                with self._get_topic_lock(topic):
+                    for fname in leftovers:
+                        os.rename(os.path.join(source, fname),
+                                  os.path.join(self.master_inbox_path, topic,
+                                               fname))
+                    self._update_count_cache(topic, len(leftovers))
+            os.rmdir(source)
+        else:
+            self._update_count_cache(topic, -len(linked[1]))
+
+        return linked[0] if len(linked[1]) > 0 else None
+
+    # Hard links each of the files named by promotees in source into one
+    # inbox per entry of batch_sizes, splitting each subscriber's share into
+    # inboxes of at most that many files. A file is only removed from source
+    # once every subscriber has a link to it; on failure the remaining files
+    # are left where they are. Returns the inboxes created per subscriber and
+    # the files that were delivered.
+    def _link_batches(self, source, promotees, batch_sizes):
+        subscribers = []
+        for batch_size in batch_sizes:
+            if not batch_size or batch_size <= 0:
+                batch_size = len(promotees)
+            container_inboxes = []
+            for i in range(0, len(promotees), batch_size):
+                container_inbox_path = os.path.join(
+                    self.container_inboxes_path, str(uuid4()))
+                os.makedirs(container_inbox_path)
+                container_inboxes.append(container_inbox_path)
+            subscribers.append((batch_size, container_inboxes))
+
+        delivered = []
+        for i, fname in enumerate(promotees):
+            fullpath = os.path.join(source, fname)
+            links = []
+            try:
+                for batch_size, container_inboxes in subscribers:
+                    link = os.path.join(container_inboxes[i // batch_size],
+                                        fname)
+                    os.link(fullpath, link)
+                    links.append(link)
+                os.remove(fullpath)
+            except Exception as ex:
+                print "Fanning out %s failed due to %s" % (fullpath, ex)
+                # Don't leave some subscribers with a copy the next
+                # promotion would hand them again
+                for link in links:
+                    os.remove(link)
+                break
+            delivered.append(fname)
+
+        # Drop the inboxes nothing was delivered to
+        result = []
+        for batch_size, container_inboxes in subscribers:
+            used = (len(delivered) + batch_size - 1) // batch_size
+            for container_inbox_path in container_inboxes[used:]:
+                os.rmdir(container_inbox_path)
+            result.append(container_inboxes[:used])
+
+        return (result, delivered)
+
+    # Get a count of the events in a container inbox made by this inboxer
+    def get_container_inbox_count(self, container_inbox):
+        return len(os.listdir(container_inbox))
+
+    # Regroups the events in the given container inboxes, oldest first, into
+    # inboxes of at most batch_size events each (a single inbox for zero or
+    # None). The given inboxes are reused as far as they go and any left
+    # empty are removed. Returns the list of inboxes, empty if there were no
+    # events.
+    def regroup(self, container_inboxes, batch_size):
+        events = sorted((int(fname), container_inbox)
+                        for container_inbox in container_inboxes
+                        for fname in os.listdir(container_inbox))
+        if not batch_size or batch_size <= 0:
+            batch_size = max(len(events), 1)
+
+        result = []
+        try:
+            for i in range(0, len(events), batch_size):
+                if len(result) < len(container_inboxes):
+                    target = container_inboxes[len(result)]
+                else:
+                    target = os.path.join(self.container_inboxes_path,
+                                          str(uuid4()))
+                    os.makedirs(target)
+                result.append(target)
+                for counter, container_inbox in events[i:i + batch_size]:
+                    if container_inbox != target:
+                        os.rename(os.path.join(container_inbox, str(counter)),
+                                  os.path.join(target, str(counter)))
+        except Exception as ex:
+            # Every event is still in one of the inboxes, just not in the
+            # batch it was meant for; hand over all that hold any
+            print "Regrouping container inboxes failed due to %s" % ex
+            result = container_inboxes + [container_inbox
+                                          for container_inbox in result
+                                          if container_inbox not in
+                                          container_inboxes]
+
+        # Drop the inboxes left without events
+        for container_inbox in set(container_inboxes + result):
+            if not os.listdir(container_inbox):
+                os.rmdir(container_inbox)
+        return [container_inbox for container_inbox in result
+                if os.path.exists(container_inbox)]
@@ -19,7 +19,9 @@ import unittest
 import os
 import shutil
 import tempfile
-from inboxer import Inboxer
+from StringIO import StringIO
+from atomiclong import AtomicLong
+from inboxer import Inboxer, PROMOTE_LINK, PROMOTE_RENAME
 
 class InboxerTest(unittest.TestCase):
 
@@ -82,6 +84,41 @@ class InboxerTest(unittest.TestCase):
                                                 str(counter))
         self.assertEqual(os.path.exists(master_inbox_destination), True)
 
+    def test_add_file_by_stream(self):
+        master_inbox_path = os.path.join(self.TEST_DIR, "master_inbox")
+        container_inboxes_path = os.path.join(self.TEST_DIR, "container_inboxes")
+
+        # Initialize inboxer using a tmp directory for unit testing
+        inboxer = Inboxer(master_inbox_path, container_inboxes_path)
+
+        data = "This is a streamed test file " * 1000
+        counter = inboxer.add_file_by_stream("MyTopic", StringIO(data),
+                                             chunk_size=16)
+        master_inbox_destination = os.path.join(master_inbox_path,
+                                                "MyTopic",
+                                                str(counter))
+        with open(master_inbox_destination) as fin:
+            self.assertEqual(fin.read(), data)
+
+        # Nothing should be left behind in the spool directory
+        self.assertEqual(os.listdir(inboxer.incoming_path), [])
+
+    def test_add_batch(self):
+        master_inbox_path = os.path.join(self.TEST_DIR, "master_inbox")
+        container_inboxes_path = os.path.join(self.TEST_DIR, "container_inboxes")
+        received = []
+
+        # Initialize inboxer using a tmp directory for unit testing
+        inboxer = Inboxer(master_inbox_path, container_inboxes_path)
+        inboxer.on("received", received.append)
+
+        first, last = inboxer.add_batch("MyTopic", ["one", "two", "three"])
+        self.assertEqual(last - first, 2)
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 3)
+        self.assertEqual(sorted(inboxer.get_inbox_list("MyTopic")),
+                         sorted(str(c) for c in range(first, last + 1)))
+        self.assertEqual(len(received), 1)
+
     def test_get_inbox_list(self):
         master_inbox_path = os.path.join(self.TEST_DIR, "master_inbox")
         container_inboxes_path = os.path.join(self.TEST_DIR, "container_inboxes")
@@ -134,6 +171,59 @@ class InboxerTest(unittest.TestCase):
 
         self.assertEqual(inboxer.get_inbox_count("MyTopic"), 3)
 
+    def test_get_inbox_count_after_promotion(self):
+        master_inbox_path = os.path.join(self.TEST_DIR, "master_inbox")
+        container_inboxes_path = os.path.join(self.TEST_DIR, "container_inboxes")
+
+        # Initialize inboxer using a tmp directory for unit testing
+        inboxer = Inboxer(master_inbox_path, container_inboxes_path)
+
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 0)
+        inboxer.add_file_by_bytes("MyTopic", "one")
+        inboxer.add_file_by_bytes("MyTopic", "two")
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 2)
+
+        inboxer.promote_to_container_inbox("MyTopic", "RandomContainerIDHere")
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 0)
+
+        inboxer.add_file_by_bytes("MyTopic", "three")
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 1)
+
+    def test_get_inbox_count_reconciles_on_startup(self):
+        master_inbox_path = os.path.join(self.TEST_DIR, "master_inbox")
+        container_inboxes_path = os.path.join(self.TEST_DIR, "container_inboxes")
+
+        inboxer = Inboxer(master_inbox_path, container_inboxes_path)
+        first = inboxer.add_file_by_bytes("MyTopic", "one")
+        inboxer.add_file_by_bytes("MyTopic", "two")
+
+        # A new inboxer over the same directories (e.g. after a restart)
+        # should pick up the pending files and never reuse their names
+        restarted = Inboxer(master_inbox_path, container_inboxes_path,
+                            atomic_counter=AtomicLong(0))
+        self.assertEqual(restarted.get_inbox_count("MyTopic"), 2)
+        counter = restarted.add_file_by_bytes("MyTopic", "three")
+        self.assertTrue(counter > first + 1)
+        self.assertEqual(restarted.get_inbox_count("MyTopic"), 3)
+
+    def test_incoming_recovered_on_startup(self):
+        master_inbox_path = os.path.join(self.TEST_DIR, "master_inbox")
+        container_inboxes_path = os.path.join(self.TEST_DIR, "container_inboxes")
+
+        inboxer = Inboxer(master_inbox_path, container_inboxes_path)
+        inboxer.add_file_by_bytes("MyTopic", "one")
+        # Accepted, then the process stopped before adding it
+        accepted = inboxer.spool(StringIO("two"), topic="MyTopic")
+        # Still being written when the process stopped
+        partial = inboxer.spool(StringIO("thr"))
+
+        restarted = Inboxer(master_inbox_path, container_inboxes_path,
+                            atomic_counter=AtomicLong(0))
+        self.assertEqual(restarted.get_inbox_count("MyTopic"), 2)
+        self.assertFalse(os.path.exists(accepted))
+        self.assertFalse(os.path.exists(partial))
+        self.assertEqual(os.listdir(restarted.incoming_path), [])
+
     def test_promote_to_container_inbox(self):
         master_inbox_path = os.path.join(self.TEST_DIR, "master_inbox")
         container_inboxes_path = os.path.join(self.TEST_DIR, "container_inboxes")
@@ -173,5 +263,168 @@ class InboxerTest(unittest.TestCase):
 
         self.assertEqual(len(inboxer.get_inbox_list("MyTopic3")), 0)
 
+    def test_promote_to_container_inbox_by_rename(self):
+        master_inbox_path = os.path.join(self.TEST_DIR, "master_inbox")
+        container_inboxes_path = os.path.join(self.TEST_DIR, "container_inboxes")
+
+        # Initialize inboxer using a tmp directory for unit testing
+        inboxer = Inboxer(master_inbox_path, container_inboxes_path,
+                          promotion=PROMOTE_RENAME)
+
+        self.assertIsNone(inboxer.promote_to_container_inbox("MyTopic",
+                                                             "Container1"))
+
+        first = inboxer.add_file_by_bytes("MyTopic", "one")
+        second = inboxer.add_file_by_bytes("MyTopic", "two")
+        inboxes = inboxer.promote_to_container_inbox("MyTopic",
+                                                     ["Container1",
+                                                      "Container2"])
+
+        self.assertEqual(len(inboxes), 2)
+        for inbox in inboxes:
+            self.assertEqual(sorted(os.listdir(inbox)),
+                             sorted([str(first), str(second)]))
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 0)
+        self.assertEqual(inboxer.get_inbox_list("MyTopic"), [])
+
+        # Events after the swap land in the fresh topic directory
+        inboxer.add_file_by_bytes("MyTopic", "three")
+        self.assertEqual(len(inboxer.get_inbox_list("MyTopic")), 1)
+        self.assertEqual(len(os.listdir(inboxes[0])), 2)
+
+    def test_promote_in_batches(self):
+        for promotion in [PROMOTE_LINK, PROMOTE_RENAME]:
+            master_inbox_path = os.path.join(self.TEST_DIR, promotion,
+                                             "master_inbox")
+            container_inboxes_path = os.path.join(self.TEST_DIR, promotion,
+                                                  "container_inboxes")
+
+            # Initialize inboxer using a tmp directory for unit testing
+            inboxer = Inboxer(master_inbox_path, container_inboxes_path,
+                              promotion=promotion)
+            first, last = inboxer.add_batch("MyTopic",
+                                            ["event"] * 5)
+
+            inboxes = inboxer.promote_in_batches("MyTopic", 2)
+
+            self.assertEqual(len(inboxes), 3)
+            self.assertEqual([sorted(os.listdir(inbox), key=int)
+                              for inbox in inboxes],
+                             [[str(first), str(first + 1)],
+                              [str(first + 2), str(first + 3)],
+                              [str(last)]])
+            self.assertEqual(inboxer.get_inbox_count("MyTopic"), 0)
+            self.assertEqual(inboxer.get_inbox_list("MyTopic"), [])
+
+    def test_promote_in_batches_relative_paths(self):
+        # The default inbox paths are relative to the working directory
+        base = os.path.relpath(os.path.join(self.TEST_DIR, "relative"))
+        inboxer = Inboxer(os.path.join(base, "master_inbox"),
+                          os.path.join(base, "container_inboxes"),
+                          promotion=PROMOTE_RENAME)
+        inboxer.add_batch("MyTopic", ["event"] * 3)
+
+        inboxes = inboxer.promote_in_batches("MyTopic", 2)
+        self.assertEqual([len(os.listdir(inbox)) for inbox in inboxes], [2, 1])
+
+        inboxer.add_batch("MyTopic", ["event"] * 3)
+        subscribers = inboxer.fan_out("MyTopic", [0, 2])
+        self.assertEqual([[len(os.listdir(inbox)) for inbox in inboxes]
+                          for inboxes in subscribers], [[3], [2, 1]])
+
+    def test_promote_in_batches_partial_failure(self):
+        master_inbox_path = os.path.join(self.TEST_DIR, "master_inbox")
+        container_inboxes_path = os.path.join(self.TEST_DIR, "container_inboxes")
+
+        # Initialize inboxer using a tmp directory for unit testing
+        inboxer = Inboxer(master_inbox_path, container_inboxes_path)
+        first, last = inboxer.add_batch("MyTopic", ["event"] * 5)
+
+        # The third move fails
+        rename = os.rename
+        calls = []
+        def failing_rename(source, destination):
+            calls.append(source)
+            if len(calls) == 3:
+                raise OSError("No space left on device")
+            rename(source, destination)
+        os.rename = failing_rename
+        try:
+            inboxes = inboxer.promote_in_batches("MyTopic", 2)
+        finally:
+            os.rename = rename
+
+        # The filled inbox is handed over and the rest stays on the topic
+        self.assertEqual([sorted(os.listdir(inbox), key=int)
+                          for inbox in inboxes],
+                         [[str(first), str(first + 1)]])
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 3)
+        self.assertEqual(len(os.listdir(container_inboxes_path)), 1)
+
+    def test_promote_in_batches_without_limit(self):
+        master_inbox_path = os.path.join(self.TEST_DIR, "master_inbox")
+        container_inboxes_path = os.path.join(self.TEST_DIR, "container_inboxes")
+
+        # Initialize inboxer using a tmp directory for unit testing
+        inboxer = Inboxer(master_inbox_path, container_inboxes_path)
+        inboxer.add_batch("MyTopic", ["event"] * 5)
+
+        inboxes = inboxer.promote_in_batches("MyTopic", 0)
+        self.assertEqual(len(inboxes), 1)
+        self.assertEqual(len(os.listdir(inboxes[0])), 5)
+
+    def test_fan_out(self):
+        for promotion in [PROMOTE_LINK, PROMOTE_RENAME]:
+            master_inbox_path = os.path.join(self.TEST_DIR, promotion,
+                                             "master_inbox")
+            container_inboxes_path = os.path.join(self.TEST_DIR, promotion,
+                                                  "container_inboxes")
+
+            # Initialize inboxer using a tmp directory for unit testing
+            inboxer = Inboxer(master_inbox_path, container_inboxes_path,
+                              promotion=promotion)
+            first, last = inboxer.add_batch("MyTopic", ["event"] * 3)
+
+            subscribers = inboxer.fan_out("MyTopic", [0, 2])
+
+            # Every subscriber sees every event, batched its own way
+            self.assertEqual(len(subscribers), 2)
+            self.assertEqual([[sorted(os.listdir(inbox), key=int)
+                               for inbox in inboxes]
+                              for inboxes in subscribers],
+                             [[[str(first), str(first + 1), str(last)]],
+                              [[str(first), str(first + 1)], [str(last)]]])
+            self.assertEqual(inboxer.get_inbox_count("MyTopic"), 0)
+            self.assertEqual(inboxer.get_inbox_list("MyTopic"), [])
+            # Nothing is left behind but the subscribers' inboxes
+            self.assertEqual(len(os.listdir(container_inboxes_path)), 3)
+
+            self.assertIsNone(inboxer.fan_out("MyTopic", [0, 0]))
+
+    def test_regroup(self):
+        inboxer = Inboxer(os.path.join(self.TEST_DIR, "master_inbox"),
+                          os.path.join(self.TEST_DIR, "container_inboxes"))
+        first, last = inboxer.add_batch("MyTopic", ["event"] * 2)
+        held = inboxer.promote_in_batches("MyTopic", 1)
+        inboxer.add_batch("MyTopic", ["event"] * 3)
+        new = inboxer.promote_in_batches("MyTopic", 0)
+        self.assertEqual([inboxer.get_container_inbox_count(inbox)
+                          for inbox in held + new], [1, 1, 3])
+
+        # Oldest first, into as few inboxes as the batch size allows
+        inboxes = inboxer.regroup(held + new, 2)
+        self.assertEqual([sorted(os.listdir(inbox), key=int)
+                          for inbox in inboxes],
+                         [[str(first), str(last)],
+                          [str(last + 1), str(last + 2)],
+                          [str(last + 3)]])
+        self.assertEqual(sorted(os.listdir(inboxer.container_inboxes_path)),
+                         sorted(os.path.basename(inbox) for inbox in inboxes))
+
+        inboxes = inboxer.regroup(inboxes, 0)
+        self.assertEqual(len(inboxes), 1)
+        self.assertEqual(inboxer.get_container_inbox_count(inboxes[0]), 5)
+        self.assertEqual(len(os.listdir(inboxer.container_inboxes_path)), 1)
+
 if __name__ == '__main__':
     unittest.main()
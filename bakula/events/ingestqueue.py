@@ -0,0 +1,101 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import os
+import threading
+from Queue import Queue, Full
+
+DEFAULT_MAX_SIZE = 1000
+DEFAULT_WRITERS = 2
+
+class QueueFullException(Exception):
+    pass
+
+# class IngestQueue takes ingest off the request thread. A request spools its
+# uploads to disk and enqueues them; writer threads move them into the inbox
+# and a dispatcher thread tells the inbox's subscriber (the Orchestrator)
+# about them, so neither the inbox write nor any container launch happens
+# while the client waits. The queue is bounded and put raises a
+# QueueFullException rather than block when it is full.
+class IngestQueue(object):
+
+    def __init__(self, inboxer, max_size=DEFAULT_MAX_SIZE,
+                 writers=DEFAULT_WRITERS):
+        self.inboxer = inboxer
+        self.jobs = Queue(max_size)
+        self.received = Queue()
+
+        self.writer_threads = []
+        for i in range(writers):
+            thread = threading.Thread(target=self.__write)
+            thread.daemon = True
+            thread.start()
+            self.writer_threads.append(thread)
+
+        self.dispatcher_thread = threading.Thread(target=self.__dispatch)
+        self.dispatcher_thread.daemon = True
+        self.dispatcher_thread.start()
+
+    # Moves queued files into the inbox, then hands the topic to the
+    # dispatcher
+    def __write(self):
+        while True:
+            topic, paths = self.jobs.get()
+            written = 0
+            for path in paths:
+                try:
+                    if self.inboxer.add_file_by_path(topic, path,
+                                                     notify=False) is not None:
+                        written += 1
+                except Exception as ex:
+                    print "Writing queued event to inbox failed due to %s" % ex
+                if os.path.exists(path):
+                    os.remove(path)
+            if written > 0:
+                self.received.put(topic)
+            self.jobs.task_done()
+
+    # Notifies the inbox subscriber once per written job
+    def __dispatch(self):
+        while True:
+            topic = self.received.get()
+            try:
+                self.inboxer.notify_received(topic)
+            except Exception as ex:
+                # Don't let a failed launch kill the dispatcher
+                print "Dispatching received event failed due to %s" % ex
+            self.received.task_done()
+
+    # True if the queue can't take another job right now
+    def full(self):
+        return self.jobs.full()
+
+    # Enqueues the spooled files at paths for topic without blocking
+    def put(self, topic, paths):
+        try:
+            self.jobs.put_nowait((topic, paths))
+        except Full:
+            raise QueueFullException("The ingest queue is full")
+
+    # Blocks until every queued job has been written and dispatched
+    def join(self):
+        self.jobs.join()
+        self.received.join()
+
+    # Number of jobs waiting to be written
+    def depth(self):
+        return self.jobs.qsize()
@@ -0,0 +1,63 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from inboxer import Inboxer
+from ingestqueue import IngestQueue, QueueFullException
+
+class IngestQueueTest(unittest.TestCase):
+
+    TEST_DIR = os.path.join(tempfile.gettempdir(), 'ingestqueue_test')
+
+    def setUp(self):
+        self.inboxer = Inboxer(os.path.join(self.TEST_DIR, "master_inbox"),
+                               os.path.join(self.TEST_DIR, "container_inboxes"))
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    def test_put(self):
+        received = []
+        self.inboxer.on("received", received.append)
+        ingest_queue = IngestQueue(self.inboxer)
+
+        paths = [self.inboxer.spool(StringIO("event %d" % i)) for i in range(3)]
+        ingest_queue.put("MyTopic", paths)
+        ingest_queue.join()
+
+        self.assertEqual(self.inboxer.get_inbox_count("MyTopic"), 3)
+        # One notification for the whole job, not one per file
+        self.assertEqual(received, [{"topic": "MyTopic"}])
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+    def test_put_when_full(self):
+        # Without writers nothing drains the queue
+        ingest_queue = IngestQueue(self.inboxer, max_size=1, writers=0)
+        ingest_queue.put("MyTopic", [self.inboxer.spool(StringIO("one"))])
+
+        self.assertTrue(ingest_queue.full())
+        self.assertEqual(ingest_queue.depth(), 1)
+        with self.assertRaises(QueueFullException):
+            ingest_queue.put("MyTopic", [self.inboxer.spool(StringIO("two"))])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import threading
+from collections import deque
+from time import time
+
+# class LaunchQueue caps how many containers run at once, both overall
+# (max_containers) and per registration (its max_concurrent). Launches over
+# a limit wait in a FIFO queue; a waiting launch blocked only by its own
+# registration's limit doesn't hold up launches for other registrations
+# behind it. Limits of 0 mean no limit.
+#
+# launch(topic, registration, inbox) is called to start a container and
+# returns True if it did; finished(topic, container) must be called when it
+# exits.
+#
+# Containers kept idle between launches, such as warm containers, count
+# against max_containers too. idle() returns how many are idle per
+# (topic, container); a launch for one of those takes an idle container's
+# place rather than a new slot. When launches are held back by
+# max_containers, reclaim() is asked to stop an idle container and returns
+# True if it did.
+class LaunchQueue(object):
+
+    def __init__(self, launch, max_containers=0, idle=None, reclaim=None):
+        self.launch = launch
+        self.max_containers = max_containers
+        self.idle = idle
+        self.reclaim = reclaim
+        self.lock = threading.Lock()
+        self.waiting = deque() # (enqueued time, topic, registration, inbox)
+        self.running = 0
+        self.running_by_registration = {} # (topic, container) -> running
+        self.launched = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    # Whether another container may start for registration, within its own
+    # limit; expects the lock to be held
+    def __can_start(self, registration):
+        max_concurrent = registration.get("max_concurrent") or 0
+        # A registration with warm containers runs at most one batch on each
+        warm_containers = registration.get("warm_containers") or 0
+        if warm_containers > 0 and (max_concurrent <= 0 or
+                                    warm_containers < max_concurrent):
+            max_concurrent = warm_containers
+        key = (registration["topic"], registration["container"])
+        return (max_concurrent <= 0 or
+                self.running_by_registration.get(key, 0) < max_concurrent)
+
+    # Queues a container launch for registration on inbox
+    def submit(self, topic, registration, inbox):
+        with self.lock:
+            self.waiting.append((time(), topic, registration, inbox))
+        self.__drain()
+
+    # Frees the slot of a container that has exited
+    def finished(self, topic, container):
+        key = (topic, container)
+        with self.lock:
+            self.running -= 1
+            self.running_by_registration[key] -= 1
+            if self.running_by_registration[key] <= 0:
+                del self.running_by_registration[key]
+        self.__drain()
+
+    # Tries the waiting launches again, e.g. once an idle container has gone
+    def wake(self):
+        self.__drain()
+
+    # Starts every waiting launch the limits allow, oldest first
+    def __drain(self):
+        ready = []
+        full = False
+        with self.lock:
+            idle = self.idle() if self.idle is not None else {}
+            total_idle = sum(idle.values())
+            blocked = deque()
+            while len(self.waiting) > 0:
+                enqueued, topic, registration, inbox = self.waiting.popleft()
+                key = (registration["topic"], registration["container"])
+                reuses_idle = idle.get(key, 0) > 0
+                if (not reuses_idle and self.max_containers > 0 and
+                        self.running + total_idle >= self.max_containers):
+                    full = True
+                    blocked.append((enqueued, topic, registration, inbox))
+                    continue
+                if not self.__can_start(registration):
+                    blocked.append((enqueued, topic, registration, inbox))
+                    continue
+                if reuses_idle:
+                    idle[key] -= 1
+                    total_idle -= 1
+                self.running += 1
+                self.running_by_registration[key] = \
+                    self.running_by_registration.get(key, 0) + 1
+                wait = time() - enqueued
+                self.launched += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                ready.append((topic, registration, inbox))
+            # Skipped launches keep their place ahead of the rest
+            blocked.extend(self.waiting)
+            self.waiting = blocked
+
+        for topic, registration, inbox in ready:
+            try:
+                launched = self.launch(topic, registration, inbox)
+            except Exception as ex:
+                print "Launching container for %s failed due to %s" % (topic, ex)
+                launched = False
+            if not launched:
+                self.finished(registration["topic"], registration["container"])
+
+        # Make room by stopping an idle container, then try again
+        if full and self.reclaim is not None and self.reclaim():
+            self.__drain()
+
+    # Number of launches waiting for a slot
+    def depth(self):
+        return len(self.waiting)
+
+    # Queue depth, running containers and how long launches have waited, in
+    # seconds
+    def status(self):
+        with self.lock:
+            oldest_wait = 0.0
+            if len(self.waiting) > 0:
+                oldest_wait = time() - self.waiting[0][0]
+            average_wait = 0.0
+            if self.launched > 0:
+                average_wait = self.total_wait / self.launched
+            idle = 0
+            if self.idle is not None:
+                idle = sum(self.idle().values())
+            return {
+                'depth': len(self.waiting),
+                'running': self.running,
+                'idle': idle,
+                'launched': self.launched,
+                'max_containers': self.max_containers,
+                'oldest_wait': oldest_wait,
+                'average_wait': average_wait,
+                'max_wait': self.max_wait
+            }
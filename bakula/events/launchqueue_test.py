@@ -0,0 +1,106 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+from launchqueue import LaunchQueue
+
+class LaunchQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.launched = []
+
+    def __launch(self, topic, registration, inbox):
+        self.launched.append(inbox)
+        return True
+
+    def __registration(self, container, max_concurrent=0):
+        return {"topic": "MyTopic", "container": container,
+                "max_concurrent": max_concurrent}
+
+    def test_unlimited(self):
+        queue = LaunchQueue(self.__launch)
+        for i in range(5):
+            queue.submit("MyTopic", self.__registration("c"), "inbox%d" % i)
+
+        self.assertEqual(len(self.launched), 5)
+        self.assertEqual(queue.status()["running"], 5)
+
+    def test_global_limit(self):
+        queue = LaunchQueue(self.__launch, max_containers=2)
+        for i in range(4):
+            queue.submit("MyTopic", self.__registration("c"), "inbox%d" % i)
+
+        self.assertEqual(self.launched, ["inbox0", "inbox1"])
+        self.assertEqual(queue.depth(), 2)
+
+        # A container exiting lets the oldest waiting launch start
+        queue.finished("MyTopic", "c")
+        self.assertEqual(self.launched, ["inbox0", "inbox1", "inbox2"])
+        status = queue.status()
+        self.assertEqual(status["depth"], 1)
+        self.assertEqual(status["running"], 2)
+        self.assertEqual(status["launched"], 3)
+
+    def test_registration_limit(self):
+        queue = LaunchQueue(self.__launch)
+        limited = self.__registration("limited", max_concurrent=1)
+        queue.submit("MyTopic", limited, "limited0")
+        queue.submit("MyTopic", limited, "limited1")
+        # Another registration isn't held up behind the limited one
+        queue.submit("MyTopic", self.__registration("other"), "other0")
+
+        self.assertEqual(self.launched, ["limited0", "other0"])
+        queue.finished("MyTopic", "limited")
+        self.assertEqual(self.launched, ["limited0", "other0", "limited1"])
+
+    def test_failed_launch_frees_slot(self):
+        queue = LaunchQueue(lambda topic, registration, inbox: False,
+                            max_containers=1)
+        queue.submit("MyTopic", self.__registration("c"), "inbox0")
+        queue.submit("MyTopic", self.__registration("c"), "inbox1")
+
+        status = queue.status()
+        self.assertEqual(status["running"], 0)
+        self.assertEqual(status["depth"], 0)
+
+    def test_idle_containers_count(self):
+        idle = {("MyTopic", "warm"): 1}
+        def reclaim():
+            if len(idle) == 0:
+                return False
+            idle.clear()
+            return True
+        queue = LaunchQueue(self.__launch, max_containers=2,
+                            idle=lambda: dict(idle), reclaim=reclaim)
+
+        # The idle container takes up one of the two slots
+        queue.submit("MyTopic", self.__registration("c"), "inbox0")
+        self.assertEqual(self.launched, ["inbox0"])
+        self.assertEqual(queue.status()["idle"], 1)
+
+        # A launch for the idle container's registration takes its place
+        queue.submit("MyTopic", self.__registration("warm"), "warm0")
+        self.assertEqual(self.launched, ["inbox0", "warm0"])
+        queue.finished("MyTopic", "warm")
+
+        # Any other launch has the idle container stopped to make room
+        queue.submit("MyTopic", self.__registration("c"), "inbox1")
+        self.assertEqual(self.launched, ["inbox0", "warm0", "inbox1"])
+        self.assertEqual(queue.status()["idle"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
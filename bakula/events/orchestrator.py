@@ -15,46 +15,137 @@
 #   specific language governing permissions and limitations
 #   under the License.
 from bakula.events.inboxer import Inboxer
+from bakula.events.scheduler import Scheduler
+from bakula.events.routing import RoutingTable
+from bakula.events.launchqueue import LaunchQueue
+from bakula.events.warmpool import WarmPool
+from bakula.events.precreatedpool import PrecreatedPool
 from bakula.docker.dockeragent import DockerAgent
-from bakula.models import Registration, Metric, Event, resolve_query
+from bakula.runtime.runtime import RUNTIME_DOCKER
+from bakula.models import Metric, Event
+from bakula.bulkwriter import BulkWriter
 from dateutil import parser
-from threading import Thread
 from calendar import timegm
-from time import gmtime, sleep, time
-from uuid import uuid4
+from time import time
+import os
+import shutil
+import threading
 
-TIMER_INTERVAL = 10.0
+# Warm containers' volumes live here, inside the container inboxes
+WARM_DIRECTORY = ".warm"
+
+# The empty inboxes of pre-created containers live here, on the same file
+# system as the batches that replace them
+PRECREATED_DIRECTORY = ".precreated"
 
 # This class handles the event handling of the inboxer and, when a threshold is hit,
 # it promotes the appropriate files as an inbox or a docker container then fires the
 # docker container.
 class Orchestrator(object):
-    def __init__(self, inboxer=Inboxer(), docker_agent=None):
+    def __init__(self, inboxer=Inboxer(), docker_agent=None, routing_table=None,
+                 coalesce_window=0, max_containers=0, writer=None,
+                 runtimes=None):
         self.inboxer = inboxer
+        # Registrations by topic; kept in memory so events don't hit the
+        # database
+        self.routing_table = routing_table
+        if self.routing_table is None:
+            self.routing_table = RoutingTable()
         self.inboxer.on("received", self.__handle_inbox_received_event)
         self.docker_agent = docker_agent
         self.id_to_cpu = {}
-        self.id_to_metadata = {}
+        # Metric and Event rows are written in bulk, off the calling thread
+        self.writer = writer
+        self.owns_writer = writer is None
+        if self.owns_writer:
+            self.writer = BulkWriter()
         if self.docker_agent is None:
             self.docker_agent = DockerAgent()
+        # What each registration's runtime names; registrations run on Docker
+        # unless they say otherwise
+        self.runtimes = dict(runtimes or {})
+        self.runtimes[RUNTIME_DOCKER] = self.docker_agent
 
-        # Setup pending queue
-        self.pending = { }
-        self.pending_thread = Thread(target=self.__process_pending)
-        self.pending_thread.daemon = True
-        self.pending_thread.start()
-
-    # Clean up the id_to_cpu dict
-    def __clean_container(self, container_id):
-        if container_id in self.id_to_metadata:
-            meta = self.id_to_metadata[container_id]
-            Event.create(
-                topic=meta['topic'],
-                container=meta['container'],
-                timestamp=meta['timestamp'],
-                duration=(int(time() * 1000) - meta['timestamp'])
-            )
-            del self.id_to_metadata[container_id]
+        # Containers start through the launch queue, which holds them back
+        # while max_containers (or a registration's max_concurrent) are
+        # already running. Idle warm containers count towards
+        # max_containers and are stopped to make room when it's reached.
+        self.launch_queue = LaunchQueue(
+            self.__launch, max_containers,
+            idle=lambda: self.warm_pool.idle_counts(),
+            reclaim=lambda: self.warm_pool.reclaim())
+
+        # Long-lived containers for registrations with warm_containers set
+        self.warm_pool = WarmPool(
+            self.docker_agent,
+            os.path.join(self.inboxer.container_inboxes_path, WARM_DIRECTORY),
+            stat_processor=self.__handle_stat,
+            on_released=self.launch_queue.wake)
+
+        # Containers created ahead of their batches for registrations with
+        # precreated_containers set; filled as registrations are added and
+        # emptied as they're removed
+        self.precreated_pool = PrecreatedPool(
+            self.docker_agent,
+            os.path.join(self.inboxer.container_inboxes_path,
+                         PRECREATED_DIRECTORY))
+        self.routing_table.on(self.__handle_registration_change)
+        if self.routing_table.all() is not None:
+            self.__fill_precreated()
+
+        # Every registration counts its own waiting events and runs once its
+        # own threshold or timeout is reached. The events a topic's other
+        # registrations ran on are held for it here, by (topic, container),
+        # and its timeout is scheduled under the same key.
+        self.held = {}
+        self.held_lock = threading.Lock()
+        self.scheduler = Scheduler(self.__process_pending)
+
+        # Received events for a topic arriving within coalesce_window seconds
+        # of the first are evaluated together, once. With no window every
+        # event is evaluated as it arrives.
+        self.coalesce_window = coalesce_window
+        self.coalescer = None
+        if coalesce_window > 0:
+            self.coalescer = Scheduler(self.__evaluate)
+
+    # Stops the writer the orchestrator made for itself, if it made one,
+    # once what it buffered is written
+    def close(self):
+        if self.owns_writer:
+            self.writer.stop()
+
+    # Fills the pools of every registration with pre-created containers
+    def __fill_precreated(self):
+        self.precreated_pool.sync(
+            [registration for registration in self.routing_table.all() or []
+             if self.__on_docker(registration) and
+             registration.get("precreated_containers")])
+
+    # Keeps the pre-created containers in step with the registrations
+    def __handle_registration_change(self, action, registration):
+        if action == "loaded":
+            self.__fill_precreated()
+            return
+        if action == "removed":
+            self.__drop_held(registration["topic"], registration["container"])
+        if not self.__on_docker(registration):
+            return
+        if action == "added" and registration.get("precreated_containers"):
+            self.precreated_pool.fill(registration["topic"], registration)
+        elif action == "removed":
+            self.precreated_pool.discard(registration["topic"],
+                                         registration["container"])
+
+    # Records the finished run described by meta and cleans up the id_to_cpu
+    # dict
+    def __clean_container(self, container_id, meta):
+        self.writer.add(Event,
+            topic=meta['topic'],
+            container=meta['container'],
+            timestamp=meta['timestamp'],
+            duration=(int(time() * 1000) - meta['timestamp'])
+        )
         if container_id in self.id_to_cpu:
             del self.id_to_cpu[container_id]
 
@@ -62,9 +153,9 @@ class Orchestrator(object):
     def __handle_stat(self, stat, id, topic, container_name):
         try:
             read_dt = parser.parse(stat['read'])
-            timestamp = int((time.mktime(read_dt.timetuple()) + (read_dt.microsecond/1000000.0)) * 1000)
+            timestamp = int((timegm(read_dt.utctimetuple()) + (read_dt.microsecond/1000000.0)) * 1000)
             memory_usage = float(stat['memory_stats']['usage'])/float(stat['memory_stats']['limit'])
-            Metric.create(
+            self.writer.add(Metric,
                 topic=topic,
                 container=container_name,
                 timestamp=timestamp,
@@ -85,7 +176,7 @@ class Orchestrator(object):
                     usage_pct = usage_diff/system_diff
                 else:
                     usage_pct = 0.0
-                Metric.create(
+                self.writer.add(Metric,
                     topic=topic,
                     container=container_name,
                     timestamp=timestamp,
@@ -101,103 +192,240 @@ class Orchestrator(object):
             # if some statistics aren't saved properly
             pass
 
+    # True if registration's handler runs on Docker, the only runtime with
+    # warm and pre-created containers
+    def __on_docker(self, registration):
+        return (registration.get("runtime") or RUNTIME_DOCKER) == RUNTIME_DOCKER
+
+    # The runtime registration's handler runs on
+    def __runtime(self, registration):
+        name = registration.get("runtime") or RUNTIME_DOCKER
+        if name not in self.runtimes:
+            raise ValueError("Unknown runtime %s" % name)
+        return self.runtimes[name]
+
     # Get listing of registered containers filtered by topic
     def __get_registered_containers(self, topic):
-        return resolve_query(Registration.select().where(Registration.topic == topic))
-
-    # Clear the pending queue of a specific topic
-    def __clear_pending(self, topic, container_name):
-        if topic is not None and topic in self.pending:
-            if container_name is not None and container_name in self.pending[topic]:
-                del self.pending[topic][container_name]
-
-    # Iterate through the self.pending queue and act on anything queued
-    # that has passed its timer
-    def __process_pending(self):
-        while (True):
-            for_process = []
-            for topic in self.pending:
-                for container in self.pending[topic]:
-                    if self.__get_current_time_in_seconds() > self.pending[topic][container]:
-                        # It's go time! Pop into array so we can run after the loop
-                        # Otherwise modiying the dictionary during runtime is bad (item is
-                        # removed from pending immediately upon start of processing)
-                        for_process.append({ "topic": topic, "container": container })
-
-            # Iterate the array and run the things inside
-            for process in for_process:
-                self.__process(process["topic"], process["container"])
-
-            del for_process[:]
-            try:
-                sleep(TIMER_INTERVAL)
-            except KeyboardInterrupt:
-                self.pending_thread.stop()
+        return self.routing_table.get(topic)
+
+    # The number of events held for a registration
+    def __held_count(self, topic, container_name):
+        with self.held_lock:
+            held = self.held.get((topic, container_name))
+            return held["count"] if held is not None else 0
+
+    # Holds container_inboxes for a registration until it's due
+    def __hold(self, topic, container_name, container_inboxes):
+        count = sum(self.inboxer.get_container_inbox_count(container_inbox)
+                    for container_inbox in container_inboxes)
+        with self.held_lock:
+            held = self.held.setdefault((topic, container_name),
+                                        {"inboxes": [], "count": 0})
+            held["inboxes"].extend(container_inboxes)
+            held["count"] += count
 
-    def __process(self, topic, container_name):
-        self.__clear_pending(topic, container_name) # Clear the topic so this isn't hit multiple times
+    # Removes and returns the inboxes held for a registration
+    def __take_held(self, topic, container_name):
+        self.scheduler.cancel((topic, container_name))
+        with self.held_lock:
+            held = self.held.pop((topic, container_name), None)
+        return held["inboxes"] if held is not None else []
 
-        # Promote all files in the inbox, delineated by topic, to a directory for
-        # a container to mount; returns a list of created inboxes
-        container_inboxes = self.inboxer.promote_to_container_inbox(topic, str(uuid4()))
+    # Throws away the events held for a removed registration
+    def __drop_held(self, topic, container_name):
+        for container_inbox in self.__take_held(topic, container_name):
+            shutil.rmtree(container_inbox, ignore_errors=True)
 
-        if container_inboxes is None or len(container_inboxes) == 0:
+    # Called by the scheduler once a registration's timeout has passed
+    # without it reaching its threshold
+    def __process_pending(self, key):
+        topic, container_name = key
+        self.__evaluate(topic, expired=container_name)
+
+    # Runs the registrations on a topic named by due against the events
+    # waiting for them. The events are fanned out in one pass so each of the
+    # topic's registrations gets its own copy of every event, split into
+    # batches of its max_batch_size; registrations that aren't due hold on to
+    # theirs.
+    def __process(self, topic, registrations, due):
+        # Promote all files in the inbox, delineated by topic, to directories for
+        # containers to mount. Returns a list of created inboxes per
+        # registration.
+        inboxes_by_registration = self.inboxer.fan_out(
+            topic, [registration.get("max_batch_size")
+                    for registration in registrations])
+        if inboxes_by_registration is None:
+            inboxes_by_registration = [[] for registration in registrations]
+
+        runs = []
+        for registration, container_inboxes in zip(registrations, inboxes_by_registration):
+            container_name = registration["container"]
+            if container_name not in due:
+                if len(container_inboxes) > 0:
+                    self.__hold(topic, container_name, container_inboxes)
+                continue
+            held = self.__take_held(topic, container_name)
+            if len(held) > 0:
+                # The held events go first, in batches of its max_batch_size
+                # along with the new ones
+                container_inboxes = self.inboxer.regroup(
+                    held + container_inboxes, registration.get("max_batch_size"))
+            runs.append((registration, container_inboxes))
+
+        if not any(container_inboxes for registration, container_inboxes in runs):
             print "There are no container inboxes available for the event run; did something weird happen?"
             return None
 
-        for container_inbox in container_inboxes:
-            # container_inbox is the path inboxer promoted to be mounted in the docker container
-            self.docker_agent.pull(container_name)
-            container_id = self.docker_agent.start_container(
+        # Every registration already has its inboxes, so one that can't run
+        # mustn't hold up the others
+        for registration, container_inboxes in runs:
+            if len(container_inboxes) == 0:
+                continue
+            try:
+                runtime = self.__runtime(registration)
+            except ValueError as ex:
+                print "Dropping %d batches of %s for %s: %s" % (
+                    len(container_inboxes), topic, registration["container"], ex)
+                for container_inbox in container_inboxes:
+                    shutil.rmtree(container_inbox, ignore_errors=True)
+                continue
+            try:
+                # Only reaches the registry if the image hasn't been pulled
+                # lately
+                runtime.ensure_image(registration["container"])
+            except Exception as ex:
+                # The image may still be there from before; the launch will
+                # tell
+                print "Preparing %s failed due to %s" % (
+                    registration["container"], ex)
+            for container_inbox in container_inboxes:
+                # Starts now, or once the concurrency limits allow
+                self.launch_queue.submit(topic, registration, container_inbox)
+
+    # Starts a container for registration on container_inbox, the path inboxer
+    # promoted to be mounted in the docker container. Called by the launch
+    # queue.
+    def __launch(self, topic, registration, container_inbox):
+        container_name = registration["container"]
+        runtime = self.__runtime(registration)
+
+        if self.__on_docker(registration) and registration.get("warm_containers"):
+            timestamp = int(time() * 1000)
+
+            def on_done():
+                self.launch_queue.finished(topic, container_name)
+                self.writer.add(Event,
+                    topic=topic,
+                    container=container_name,
+                    timestamp=timestamp,
+                    duration=(int(time() * 1000) - timestamp)
+                )
+
+            try:
+                self.warm_pool.deliver(topic, registration, container_inbox,
+                                       on_done)
+                return True
+            except Exception as ex:
+                # The batch is still in its inbox; start a container for it
+                print "Delivering batch to a warm container failed due to %s" % ex
+
+        # Kept by the callback rather than by container id, since a quick
+        # handler may stop before starting it has returned
+        meta = {
+            'topic': topic,
+            'container': container_name,
+            'timestamp': int(time() * 1000)
+        }
+
+        # Free the launch slot first so a failure to record the event can't
+        # leak it
+        def on_terminate(container_id):
+            self.launch_queue.finished(topic, container_name)
+            self.__clean_container(container_id, meta)
+
+        precreated = None
+        if (self.__on_docker(registration) and
+                registration.get("precreated_containers")):
+            precreated = self.precreated_pool.take(topic, registration)
+        if precreated is not None:
+            # The batch takes the place of the empty inbox the container was
+            # created with, so only the start is left to do
+            try:
+                os.rename(container_inbox, precreated["inbox"])
+            except Exception as ex:
+                print "Moving batch into pre-created container failed due to %s" % ex
+                self.docker_agent.remove_container(precreated["id"])
+                shutil.rmtree(precreated["inbox"], ignore_errors=True)
+                precreated = None
+        if precreated is not None:
+            container_id = self.docker_agent.start_created_container(
+                precreated["id"],
+                on_terminate=on_terminate
+            )
+        else:
+            container_id = runtime.start_container(
                 host_inbox=container_inbox,
                 image_name=container_name,
-                on_terminate=self.__clean_container,
+                command=registration.get("command"),
+                working_dir=registration.get("working_dir"),
+                on_terminate=on_terminate,
                 topic=topic
             )
-            self.id_to_metadata[container_id] = {
-                'topic': topic,
-                'container': container_name,
-                'timestamp': int(time() * 1000)
-            }
-            self.docker_agent.stats(
-                container_id,
-                topic,
-                container_name,
-                self.__handle_stat
-            )
-
-    # Get the current time, in seconds, since epoch
-    def __get_current_time_in_seconds(self):
-        return timegm(gmtime())
+        runtime.stats(
+            container_id,
+            topic,
+            container_name,
+            self.__handle_stat
+        )
+        return True
 
     # This event handler is executed every time a file is put into the master inbox
     # The data argument includes a property specify the topic that was appended to
     def __handle_inbox_received_event(self, data):
         topic = data["topic"]
+        if self.coalescer is not None:
+            # Evaluate once the window closes; notifications arriving before
+            # then are folded into the same evaluation
+            self.coalescer.schedule(topic, time() + self.coalesce_window)
+        else:
+            self.__evaluate(topic)
+
+    # Decides which registrations on a topic should run on the events waiting
+    # for them now and which wait for more events or for their timeout.
+    # expired names the registration whose timeout has just passed, if any.
+    def __evaluate(self, topic, expired=None):
         count = self.inboxer.get_inbox_count(topic)
-        # Get a list of all files in the inbox delineated by the topic in the event
-        inbox_list = self.inboxer.get_inbox_list(topic)
 
         # If there are no items in the inbox then there is literally nothing to do
-        if count == 0:
+        if count == 0 and expired is None:
             return None
 
-        container_infos = self.__get_registered_containers(data["topic"])
+        container_infos = self.__get_registered_containers(topic)
 
         # We have no container infos! :(
         if container_infos is None:
             print "Container for topic not found; doing nothing..."
             return None
 
+        # A registration is waiting on the events in the inbox and on those
+        # it was handed when the topic's other registrations ran
+        due = set()
         for container_info in container_infos:
-            container = container_info["container"]
+            waiting = count + self.__held_count(topic, container_info["container"])
             # If the count has reached the threshold then it's time to execute!
             threshold = container_info["threshold"] if container_info["threshold"] is not None else 1
-            if count >= threshold:
-                self.__process(topic, container)
-            else:
-                # We haven't hit the threshold so we need to start counting down
-                # Set the current time
-                if topic not in self.pending:
-                    self.pending[topic] = {}
-                self.pending[topic][container] = (self.__get_current_time_in_seconds() + container_info["timeout"])
+            if waiting > 0 and (waiting >= threshold or
+                                container_info["container"] == expired):
+                due.add(container_info["container"])
+        if len(due) > 0:
+            self.__process(topic, container_infos, due)
+            count = self.inboxer.get_inbox_count(topic)
+
+        # The others start counting down, from their first waiting event, and
+        # run when their own timeout expires
+        for container_info in container_infos:
+            if container_info["container"] in due:
+                continue
+            if count + self.__held_count(topic, container_info["container"]) > 0:
+                self.scheduler.schedule((topic, container_info["container"]),
+                                        time() + (container_info["timeout"] or 0))
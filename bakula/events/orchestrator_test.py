@@ -25,10 +25,15 @@ from inboxer import Inboxer
 from bakula import models
 from bakula.models import Registration
 from bakula.docker import dockeragent
+from bakula.docker.testclient import recording_agent
 from orchestrator import Orchestrator
+from routing import RoutingTable
+from bakula.runtime.localprocess import LocalProcessRuntime
+import sys
 import time
 
 DOCKER_TIMEOUT = 10
+
 class OrchestratorTest(unittest.TestCase):
     TEST_DIR = os.path.join(tempfile.gettempdir(), 'orchestrator_test')
 
@@ -39,13 +44,35 @@ class OrchestratorTest(unittest.TestCase):
 
     def setUp(self):
         Registration.delete().execute()
+        self.docker_agents = []
+        self.orchestrators = []
 
     def tearDown(self):
+        for orchestrator in self.orchestrators:
+            orchestrator.close()
+        for docker_agent in self.docker_agents:
+            docker_agent.stop()
         shutil.rmtree(self.TEST_DIR, ignore_errors=True)
         models.Registration.delete().execute()
         # allow the cleanup thread to remove old containers
         time.sleep(10)
 
+    # A DockerAgent on a RecordingClient, stopped after the test
+    def __docker_agent(self):
+        docker_agent, self.client = recording_agent()
+        self.docker_agents.append(docker_agent)
+        return docker_agent
+
+    # An Orchestrator, closed after the test
+    def __orchestrator(self, *args, **kwargs):
+        orchestrator = Orchestrator(*args, **kwargs)
+        self.orchestrators.append(orchestrator)
+        return orchestrator
+
+    # How many events each container started had in its inbox
+    def __started(self):
+        return [len(files) for container_id, files in self.client.started]
+
     def test_Orchestrator_with_threshold(self):
         Registration.create(
             topic="MyTopic1",
@@ -57,7 +84,7 @@ class OrchestratorTest(unittest.TestCase):
 
         inboxer = Inboxer(os.path.join(self.TEST_DIR, "master_inbox"),
                           os.path.join(self.TEST_DIR, "container_inboxes"))
-        orchestrator = Orchestrator(inboxer)
+        orchestrator = self.__orchestrator(inboxer)
         inboxer.add_file_by_bytes("MyTopic1", "This is some data")
         self.assertEqual(len(inboxer.get_inbox_list("MyTopic1")), 0)
 
@@ -72,10 +99,194 @@ class OrchestratorTest(unittest.TestCase):
 
         inboxer = Inboxer(os.path.join(self.TEST_DIR, "master_inbox"),
                           os.path.join(self.TEST_DIR, "container_inboxes"))
-        orchestrator = Orchestrator(inboxer)
+        orchestrator = self.__orchestrator(inboxer)
         inboxer.add_file_by_bytes("MyTopic2", "This is some data")
         sleep(20)
         self.assertEqual(len(inboxer.get_inbox_list("MyTopic2")), 0)
 
+    def test_Orchestrator_coalesces_received_events(self):
+        Registration.create(
+            topic="MyTopic3",
+            container="busybox",
+            creator="me",
+            threshold=1,
+            timeout=15
+        )
+        routing_table = RoutingTable()
+        routing_table.load()
+
+        inboxer = Inboxer(os.path.join(self.TEST_DIR, "master_inbox"),
+                          os.path.join(self.TEST_DIR, "container_inboxes"))
+        docker_agent = self.__docker_agent()
+        orchestrator = self.__orchestrator(inboxer, docker_agent,
+                                    routing_table=routing_table,
+                                    coalesce_window=0.5)
+        for i in range(5):
+            inboxer.add_file_by_bytes("MyTopic3", "This is some data")
+        sleep(2)
+
+        # A single threshold check hands every event to one container
+        self.assertEqual(self.__started(), [5])
+        self.assertEqual(len(inboxer.get_inbox_list("MyTopic3")), 0)
+
+    def test_Orchestrator_with_precreated_containers(self):
+        registration = Registration.create(
+            topic="MyTopic4",
+            container="busybox",
+            creator="me",
+            threshold=1,
+            timeout=15,
+            precreated_containers=1
+        )
+        routing_table = RoutingTable()
+        routing_table.load()
+
+        inboxer = Inboxer(os.path.join(self.TEST_DIR, "master_inbox"),
+                          os.path.join(self.TEST_DIR, "container_inboxes"))
+        docker_agent = self.__docker_agent()
+        orchestrator = self.__orchestrator(inboxer, docker_agent,
+                                    routing_table=routing_table)
+        routing_table.added(dict(registration._data))
+        for i in range(500):
+            if orchestrator.precreated_pool.size("MyTopic4", "busybox") == 1:
+                break
+            sleep(0.01)
+        self.assertEqual(orchestrator.precreated_pool.size("MyTopic4",
+                                                           "busybox"), 1)
+
+        inboxer.add_file_by_bytes("MyTopic4", "This is some data")
+
+        # The batch went into the created container's inbox
+        self.assertEqual(self.__started(), [1])
+
+    def test_Orchestrator_fills_precreated_on_load(self):
+        Registration.create(
+            topic="MyTopic7",
+            container="busybox",
+            creator="me",
+            threshold=1,
+            timeout=15,
+            precreated_containers=1
+        )
+        routing_table = RoutingTable()
+
+        inboxer = Inboxer(os.path.join(self.TEST_DIR, "master_inbox"),
+                          os.path.join(self.TEST_DIR, "container_inboxes"))
+        orchestrator = self.__orchestrator(inboxer, self.__docker_agent(),
+                                    routing_table=routing_table)
+        # Registrations that already existed get containers once loaded
+        routing_table.load()
+        for i in range(500):
+            if orchestrator.precreated_pool.size("MyTopic7", "busybox") == 1:
+                break
+            sleep(0.01)
+        self.assertEqual(orchestrator.precreated_pool.size("MyTopic7",
+                                                           "busybox"), 1)
+
+    def test_Orchestrator_with_process_runtime(self):
+        handled = os.path.join(self.TEST_DIR, "handled")
+        Registration.create(
+            topic="MyTopic5",
+            container="handler",
+            creator="me",
+            threshold=1,
+            timeout=15,
+            runtime="process",
+            command='%s -c "import os, sys; os.rename(sys.argv[1], %r)"' %
+                    (sys.executable, handled)
+        )
+        routing_table = RoutingTable()
+        routing_table.load()
+
+        inboxer = Inboxer(os.path.join(self.TEST_DIR, "master_inbox"),
+                          os.path.join(self.TEST_DIR, "container_inboxes"))
+        orchestrator = self.__orchestrator(inboxer, self.__docker_agent(),
+                                    routing_table=routing_table,
+                                    runtimes={"process": LocalProcessRuntime()})
+        inboxer.add_file_by_bytes("MyTopic5", "This is some data")
+        for i in range(500):
+            if orchestrator.launch_queue.status()["running"] == 0:
+                break
+            sleep(0.01)
+
+        # The handler ran on the batch and its slot was freed
+        self.assertEqual(len(os.listdir(handled)), 1)
+        self.assertEqual(orchestrator.launch_queue.status()["running"], 0)
+
+    def test_Orchestrator_with_unavailable_runtime(self):
+        for container, runtime in [("handler", "process"),
+                                   ("busybox", "docker")]:
+            Registration.create(
+                topic="MyTopic6",
+                container=container,
+                creator="me",
+                threshold=1,
+                timeout=15,
+                runtime=runtime,
+                command="cat"
+            )
+        routing_table = RoutingTable()
+        routing_table.load()
+
+        inboxer = Inboxer(os.path.join(self.TEST_DIR, "master_inbox"),
+                          os.path.join(self.TEST_DIR, "container_inboxes"))
+        docker_agent = self.__docker_agent()
+        orchestrator = self.__orchestrator(inboxer, docker_agent,
+                                    routing_table=routing_table)
+        inboxer.add_file_by_bytes("MyTopic6", "This is some data")
+
+        # The registration without a runtime doesn't hold up the other, and
+        # its batch doesn't linger
+        self.assertEqual(self.__started(), [1])
+        self.assertEqual(len(os.listdir(inboxer.container_inboxes_path)), 1)
+
+        # The writer the orchestrator made for itself goes with it
+        orchestrator.close()
+        self.assertFalse(orchestrator.writer.thread.is_alive())
+
+    def test_Orchestrator_runs_registrations_on_their_own_thresholds(self):
+        Registration.create(
+            topic="MyTopic7",
+            container="busybox",
+            creator="me",
+            threshold=1,
+            timeout=15
+        )
+        Registration.create(
+            topic="MyTopic7",
+            container="alpine",
+            creator="me",
+            threshold=100,
+            timeout=1
+        )
+        routing_table = RoutingTable()
+        routing_table.load()
+
+        inboxer = Inboxer(os.path.join(self.TEST_DIR, "master_inbox"),
+                          os.path.join(self.TEST_DIR, "container_inboxes"))
+        docker_agent = self.__docker_agent()
+        orchestrator = self.__orchestrator(inboxer, docker_agent,
+                                    routing_table=routing_table)
+
+        # Events that arrive for a registration's run
+        def started(image):
+            images = dict((container["id"], container["image"])
+                          for container in self.client.created_containers)
+            return [len(files) for container_id, files in self.client.started
+                    if images[container_id] == image]
+
+        inboxer.add_file_by_bytes("MyTopic7", "This is some data")
+        inboxer.add_file_by_bytes("MyTopic7", "This is some data")
+
+        # Reaching one registration's threshold doesn't run the other
+        self.assertEqual(started("busybox"), [1, 1])
+        self.assertEqual(started("alpine"), [])
+
+        # which gets everything it was holding, together, on its timeout
+        sleep(3)
+        self.assertEqual(started("busybox"), [1, 1])
+        self.assertEqual(started("alpine"), [2])
+        self.assertEqual(len(inboxer.get_inbox_list("MyTopic7")), 0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,174 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import atexit
+import os
+import shutil
+import threading
+from Queue import Queue
+from uuid import uuid4
+
+# class PrecreatedPool keeps containers for registrations with
+# precreated_containers set already created, but not started, so that a
+# batch only waits for the container to start. Each container is created on
+# an empty inbox directory of its own; a batch takes the place of that
+# directory before the container starts. Taking a container asks for the
+# pool to be refilled on a background thread. Containers created from an
+# image other than the registration's current one are discarded when found,
+# and any left at exit are removed.
+class PrecreatedPool(object):
+
+    def __init__(self, docker_agent, inboxes_path):
+        self.docker_agent = docker_agent
+        self.inboxes_path = inboxes_path
+        self.containers = {} # (topic, container) -> list of created containers
+        self.registrations = {} # (topic, container) -> registration to fill for
+        self.lock = threading.Lock()
+        self.refills = Queue()
+        self.queued = set() # Keys waiting in refills
+        self.closed = False
+        self.thread = threading.Thread(target=self.__refill_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    # Asks for registration's pool to be topped up on the background thread
+    def fill(self, topic, registration):
+        key = (topic, registration["container"])
+        with self.lock:
+            if self.closed:
+                return
+            self.registrations[key] = registration
+            if key in self.queued:
+                return
+            self.queued.add(key)
+        self.refills.put(key)
+
+    # Returns a created container for registration as a dict with its "id"
+    # and "inbox", or None if none is ready, and asks for the pool to be
+    # refilled. The caller should move its batch to the inbox path and then
+    # start the container.
+    def take(self, topic, registration):
+        key = (topic, registration["container"])
+        # Cached unless the image is due to be pulled again
+        image_id = self.docker_agent.ensure_image(registration["container"])
+        taken = None
+        stale = []
+        with self.lock:
+            created = self.containers.get(key, [])
+            while taken is None and len(created) > 0:
+                candidate = created.pop(0)
+                if candidate["image_id"] == image_id:
+                    taken = candidate
+                else:
+                    stale.append(candidate)
+        for container in stale:
+            self.__destroy(container)
+        self.fill(topic, registration)
+        return taken
+
+    # Removes every created container of a registration and stops filling
+    # its pool
+    def discard(self, topic, container):
+        key = (topic, container)
+        with self.lock:
+            self.registrations.pop(key, None)
+            created = self.containers.pop(key, [])
+        for container in created:
+            self.__destroy(container)
+
+    # Fills the pools of the given registrations and discards those of any
+    # other, e.g. once every registration has been loaded
+    def sync(self, registrations):
+        wanted = dict(((registration["topic"], registration["container"]),
+                       registration) for registration in registrations)
+        with self.lock:
+            stale = [key for key in self.registrations if key not in wanted]
+        for topic, container in stale:
+            self.discard(topic, container)
+        for (topic, container), registration in wanted.items():
+            self.fill(topic, registration)
+
+    # Removes every created container and stops filling any pool. Called at
+    # exit, since containers that were never started would stay behind.
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.registrations = {}
+            created = [container for containers in self.containers.values()
+                       for container in containers]
+            self.containers = {}
+        for container in created:
+            self.__destroy(container, wait=True)
+
+    # Number of created containers ready for a registration
+    def size(self, topic, container):
+        with self.lock:
+            return len(self.containers.get((topic, container), []))
+
+    def __destroy(self, container, wait=False):
+        try:
+            self.docker_agent.remove_container(container["id"], wait=wait)
+        except Exception as ex:
+            print "Removing created container %s failed due to %s" % (container["id"], ex)
+        shutil.rmtree(container["inbox"], ignore_errors=True)
+
+    # Creates containers for the registration under key until it has as many
+    # as it asks for
+    def __refill(self, key):
+        topic, container_name = key
+        while True:
+            with self.lock:
+                registration = self.registrations.get(key)
+                if (registration is None or
+                        len(self.containers.get(key, [])) >=
+                        (registration.get("precreated_containers") or 0)):
+                    return
+            image_id = self.docker_agent.ensure_image(container_name)
+            inbox = os.path.join(self.inboxes_path, str(uuid4()))
+            os.makedirs(inbox)
+            try:
+                container_id = self.docker_agent.create_container(
+                    image_name=container_name,
+                    host_inbox=inbox,
+                    command=registration.get("command"),
+                    working_dir=registration.get("working_dir"),
+                    topic=topic
+                )
+            except:
+                shutil.rmtree(inbox, ignore_errors=True)
+                raise
+            container = {"id": container_id, "inbox": inbox,
+                         "image_id": image_id}
+            with self.lock:
+                # Discarded while it was being created
+                keep = key in self.registrations
+                if keep:
+                    self.containers.setdefault(key, []).append(container)
+            if not keep:
+                self.__destroy(container)
+                return
+
+    def __refill_forever(self):
+        while True:
+            key = self.refills.get()
+            with self.lock:
+                self.queued.discard(key)
+            try:
+                self.__refill(key)
+            except Exception as ex:
+                print "Creating containers for %s failed due to %s" % (key, ex)
@@ -0,0 +1,134 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from precreatedpool import PrecreatedPool
+from bakula.docker.testclient import recording_agent
+
+class PrecreatedPoolTest(unittest.TestCase):
+
+    TEST_DIR = os.path.join(tempfile.gettempdir(), 'precreatedpool_test')
+    REGISTRATION = {"topic": "MyTopic", "container": "image",
+                    "precreated_containers": 2}
+
+    def setUp(self):
+        self.docker_agent, self.client = recording_agent()
+        self.pool = PrecreatedPool(self.docker_agent,
+                                   os.path.join(self.TEST_DIR, "inboxes"))
+
+    def tearDown(self):
+        self.pool.close()
+        self.docker_agent.stop()
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    def __wait_for_size(self, size):
+        deadline = time.time() + 5
+        while (self.pool.size("MyTopic", "image") != size and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(self.pool.size("MyTopic", "image"), size)
+
+    # The ids of the containers created so far
+    def __created(self):
+        return [container["id"]
+                for container in self.client.created_containers]
+
+    # Waits for the pool's removals, which are queued, and returns them
+    def __removed(self, count):
+        self.client.wait_for_calls("remove_container", count)
+        return sorted(self.client.calls_to("remove_container"))
+
+    def test_fill(self):
+        self.pool.fill("MyTopic", self.REGISTRATION)
+        self.__wait_for_size(2)
+
+        self.assertEqual(len(self.client.created_containers), 2)
+        for container in self.client.created_containers:
+            self.assertEqual(os.listdir(container["inbox"]), [])
+        # Created, but not started
+        self.assertEqual(self.client.calls_to("start"), [])
+
+    def test_take_refills(self):
+        self.assertIsNone(self.pool.take("MyTopic", self.REGISTRATION))
+        self.__wait_for_size(2)
+
+        taken = self.pool.take("MyTopic", self.REGISTRATION)
+        self.assertEqual(taken["id"], self.__created()[0])
+        self.assertTrue(os.path.isdir(taken["inbox"]))
+        self.__wait_for_size(2)
+        self.assertEqual(len(self.client.created_containers), 3)
+
+    def test_image_change(self):
+        self.pool.fill("MyTopic", self.REGISTRATION)
+        self.__wait_for_size(2)
+        old = self.__created()
+
+        self.client.push("image")
+        self.docker_agent.invalidate_image("image")
+        # Both containers are of the old image
+        self.assertIsNone(self.pool.take("MyTopic", self.REGISTRATION))
+        self.assertEqual(self.__removed(2), sorted(old))
+        self.__wait_for_size(2)
+        self.assertEqual(self.pool.take("MyTopic", self.REGISTRATION)["id"],
+                         self.__created()[2])
+
+    def test_discard(self):
+        self.pool.fill("MyTopic", self.REGISTRATION)
+        self.__wait_for_size(2)
+
+        self.pool.discard("MyTopic", "image")
+
+        self.assertEqual(self.pool.size("MyTopic", "image"), 0)
+        self.assertEqual(self.__removed(2), sorted(self.__created()))
+        for container in self.client.created_containers:
+            self.assertFalse(os.path.exists(container["inbox"]))
+
+    def test_sync(self):
+        self.pool.fill("MyTopic", self.REGISTRATION)
+        self.__wait_for_size(2)
+
+        other = {"topic": "OtherTopic", "container": "image",
+                 "precreated_containers": 1}
+        self.pool.sync([other])
+
+        # Only the registrations given keep a pool
+        self.assertEqual(self.pool.size("MyTopic", "image"), 0)
+        deadline = time.time() + 5
+        while (self.pool.size("OtherTopic", "image") != 1 and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(self.pool.size("OtherTopic", "image"), 1)
+
+    def test_close(self):
+        self.pool.fill("MyTopic", self.REGISTRATION)
+        self.__wait_for_size(2)
+
+        self.pool.close()
+
+        # Removed before close returns
+        self.assertEqual(sorted(self.client.calls_to("remove_container")),
+                         sorted(self.__created()))
+        self.assertIsNone(self.pool.take("MyTopic", self.REGISTRATION))
+        time.sleep(0.1)
+        self.assertEqual(len(self.client.created_containers), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import os
+import threading
+from time import time
+from bakula.models import Registration, resolve_query
+
+# How often, in seconds, to check whether another process changed the
+# registrations
+DEFAULT_CHECK_INTERVAL = 1.0
+
+# class RoutingTable keeps every registration in memory, keyed by topic, so
+# routing an event doesn't need a database query. The table is loaded from
+# the database on first use and kept current by the registration service
+# calling added and removed. Updates copy the table and swap it in whole,
+# so readers never take a lock.
+#
+# When several processes serve Bakula, give them all the same version_path:
+# every update touches that file, and each process reloads its table when it
+# sees the file change (checking at most every check_interval seconds).
+class RoutingTable(object):
+
+    def __init__(self, version_path=None,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.routes = None # topic -> tuple of registration dicts
+        self.lock = threading.Lock() # Serializes updates, never reads
+        self.listeners = []
+        self.configure(version_path, check_interval)
+
+    # Sets where and how often to look for updates from other processes
+    def configure(self, version_path=None,
+                  check_interval=DEFAULT_CHECK_INTERVAL):
+        self.version_path = version_path
+        self.check_interval = check_interval
+        self.version = self.__read_version()
+        self.next_check = time() + check_interval
+
+    # Subscribes callback(action, registration) to changes, where action is
+    # 'added' or 'removed', or 'loaded' with no registration once the whole
+    # table has been (re)loaded
+    def on(self, callback):
+        self.listeners.append(callback)
+
+    def __notify(self, action, registration):
+        for listener in self.listeners:
+            try:
+                listener(action, registration)
+            except Exception as ex:
+                print "Routing listener failed due to %s" % ex
+
+    def __read_version(self):
+        if self.version_path is None or not os.path.exists(self.version_path):
+            return None
+        return os.stat(self.version_path).st_mtime
+
+    # Tells other processes the registrations changed
+    def __bump_version(self):
+        if self.version_path is None:
+            return
+        # If another process got there first, leave our version alone so
+        # the next lookup still picks up its change
+        current = self.__read_version() == self.version
+        with open(self.version_path, "a"):
+            os.utime(self.version_path, None)
+        if current:
+            self.version = self.__read_version()
+
+    # True if another process changed the registrations since we loaded them
+    def __is_stale(self):
+        if self.version_path is None or time() < self.next_check:
+            return False
+        self.next_check = time() + self.check_interval
+        return self.__read_version() != self.version
+
+    # (Re)loads every registration from the database
+    def load(self):
+        with self.lock:
+            version = self.__read_version()
+            routes = {}
+            for registration in resolve_query(Registration.select()):
+                routes.setdefault(registration["topic"], ())
+                routes[registration["topic"]] += (registration,)
+            self.routes = routes
+            self.version = version
+        self.__notify("loaded", None)
+        return routes
+
+    # Gets every registration, or None if the table hasn't been loaded
+    def all(self):
+        routes = self.routes
+        if routes is None:
+            return None
+        return [registration for registrations in routes.values()
+                for registration in registrations]
+
+    # Gets the registrations for a topic
+    def get(self, topic):
+        routes = self.routes
+        if routes is None or self.__is_stale():
+            routes = self.load()
+        return list(routes.get(topic, ()))
+
+    # Records a newly created registration, given as a dict of its fields
+    def added(self, registration):
+        with self.lock:
+            if self.routes is not None:
+                routes = dict(self.routes)
+                topic = registration["topic"]
+                routes[topic] = tuple(existing for existing
+                                      in routes.get(topic, ())
+                                      if existing["id"] != registration["id"])
+                routes[topic] += (registration,)
+                self.routes = routes
+            self.__bump_version()
+        self.__notify("added", registration)
+
+    # Forgets a deleted registration, given as a dict of its fields
+    def removed(self, registration):
+        with self.lock:
+            if self.routes is not None:
+                routes = dict(self.routes)
+                topic = registration["topic"]
+                remaining = tuple(existing for existing
+                                  in routes.get(topic, ())
+                                  if existing["id"] != registration["id"])
+                if len(remaining) > 0:
+                    routes[topic] = remaining
+                else:
+                    routes.pop(topic, None)
+                self.routes = routes
+            self.__bump_version()
+        self.__notify("removed", registration)
+
+    # Drops the table so the next lookup reloads it
+    def invalidate(self):
+        self.routes = None
+
+# The table shared by the registration and event services
+routing_table = RoutingTable()
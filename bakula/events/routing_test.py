@@ -0,0 +1,100 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import os
+import shutil
+import tempfile
+from bakula import models
+from bakula.models import Registration, User
+from routing import RoutingTable
+
+class RoutingTableTest(unittest.TestCase):
+
+    TEST_DIR = os.path.join(tempfile.gettempdir(), 'routing_test')
+    VERSION_FILE = os.path.join(TEST_DIR, 'routing.version')
+
+    @classmethod
+    def setUpClass(self):
+        models.initialize_models({'database.name': ':memory:',
+                                  'database.type': 'sqlite'})
+        User.get_or_create(id='me', password='password')
+
+    def setUp(self):
+        Registration.delete().execute()
+        os.makedirs(self.TEST_DIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+        Registration.delete().execute()
+
+    def __create(self, topic, container):
+        registration = Registration.create(topic=topic, container=container,
+                                           creator='me')
+        return dict(registration._data)
+
+    def test_get_loads_registrations(self):
+        self.__create("MyTopic", "container1")
+        self.__create("MyTopic", "container2")
+        self.__create("OtherTopic", "container1")
+
+        routing_table = RoutingTable()
+        self.assertEqual(sorted(r["container"]
+                                for r in routing_table.get("MyTopic")),
+                         ["container1", "container2"])
+        self.assertEqual(routing_table.get("NoTopic"), [])
+
+    def test_added_and_removed(self):
+        routing_table = RoutingTable()
+        self.assertEqual(routing_table.get("MyTopic"), [])
+        changes = []
+        routing_table.on(lambda action, r: changes.append(action))
+
+        registration = self.__create("MyTopic", "container1")
+        # Changes come from the registration service, not the database
+        self.assertEqual(routing_table.get("MyTopic"), [])
+        routing_table.added(registration)
+        self.assertEqual(routing_table.get("MyTopic"), [registration])
+
+        routing_table.removed(registration)
+        self.assertEqual(routing_table.get("MyTopic"), [])
+        self.assertEqual(changes, ["added", "removed"])
+
+    def test_load_notifies(self):
+        registration = self.__create("MyTopic", "container1")
+        routing_table = RoutingTable()
+        self.assertIsNone(routing_table.all())
+        changes = []
+        routing_table.on(lambda action, r: changes.append((action, r)))
+
+        routing_table.get("MyTopic")
+
+        self.assertEqual(changes, [("loaded", None)])
+        self.assertEqual([r["id"] for r in routing_table.all()],
+                         [registration["id"]])
+
+    def test_changes_from_other_processes(self):
+        reader = RoutingTable(self.VERSION_FILE, check_interval=0)
+        writer = RoutingTable(self.VERSION_FILE, check_interval=0)
+        self.assertEqual(reader.get("MyTopic"), [])
+
+        writer.added(self.__create("MyTopic", "container1"))
+
+        self.assertEqual(len(reader.get("MyTopic")), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import heapq
+import threading
+from time import time
+
+# class Scheduler calls back with a key once the deadline scheduled for that
+# key has passed. Deadlines are kept in a min-heap, so scheduling is O(log n)
+# and the scheduler thread sleeps until exactly the next deadline, waking
+# early when a sooner one is scheduled. A key has at most one deadline; a
+# cancelled or superseded deadline is left in the heap and skipped when it
+# reaches the top.
+class Scheduler(object):
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = [] # (deadline, key) pairs, soonest first
+        self.deadlines = {} # The live deadline of every scheduled key
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Schedules a callback for key at deadline (seconds since epoch). If key
+    # is already scheduled, the earlier of the two deadlines wins.
+    def schedule(self, key, deadline):
+        with self.condition:
+            if key in self.deadlines and self.deadlines[key] <= deadline:
+                return
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, key))
+            if self.heap[0][1] == key:
+                # This is now the soonest deadline; wake the thread so it
+                # doesn't oversleep
+                self.condition.notify()
+
+    # Removes key's deadline, if it has one
+    def cancel(self, key):
+        with self.condition:
+            if key in self.deadlines:
+                del self.deadlines[key]
+
+    # True if key has a deadline that hasn't fired yet
+    def is_scheduled(self, key):
+        with self.condition:
+            return key in self.deadlines
+
+    # Stops the scheduler thread and waits up to timeout seconds for it to
+    # finish; deadlines that haven't passed never fire
+    def stop(self, timeout=5):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+    # Waits for the next live deadline to pass and returns its key, or None
+    # once stopped
+    def __next_due(self):
+        with self.condition:
+            while not self.stopped:
+                # Drop deadlines that have been cancelled or superseded
+                while (len(self.heap) > 0 and
+                       self.deadlines.get(self.heap[0][1]) != self.heap[0][0]):
+                    heapq.heappop(self.heap)
+
+                if len(self.heap) == 0:
+                    self.condition.wait()
+                    continue
+                remaining = self.heap[0][0] - time()
+                if remaining <= 0:
+                    deadline, key = heapq.heappop(self.heap)
+                    del self.deadlines[key]
+                    return key
+                self.condition.wait(remaining)
+            return None
+
+    def __run(self):
+        while True:
+            key = self.__next_due()
+            if key is None:
+                return
+            try:
+                self.callback(key)
+            except Exception as ex:
+                # Don't let one failed callback stop every other deadline
+                print "Scheduled callback for %s failed due to %s" % (key, ex)
@@ -0,0 +1,77 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import threading
+from time import time
+from scheduler import Scheduler
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fired = []
+        self.fired_event = threading.Event()
+        self.scheduler = Scheduler(self.__callback)
+
+    def __callback(self, key):
+        self.fired.append((key, time()))
+        self.fired_event.set()
+
+    def test_schedule(self):
+        deadline = time() + 0.2
+        self.scheduler.schedule("MyTopic", deadline)
+        self.assertTrue(self.scheduler.is_scheduled("MyTopic"))
+
+        self.assertTrue(self.fired_event.wait(5))
+        key, fired_at = self.fired[0]
+        self.assertEqual(key, "MyTopic")
+        self.assertTrue(fired_at >= deadline)
+        self.assertFalse(self.scheduler.is_scheduled("MyTopic"))
+
+    def test_sooner_deadline_wakes_scheduler(self):
+        self.scheduler.schedule("Later", time() + 60)
+        self.scheduler.schedule("Sooner", time() + 0.1)
+
+        self.assertTrue(self.fired_event.wait(5))
+        self.assertEqual(self.fired[0][0], "Sooner")
+        self.assertTrue(self.scheduler.is_scheduled("Later"))
+
+    def test_earlier_deadline_wins(self):
+        self.scheduler.schedule("MyTopic", time() + 0.1)
+        self.scheduler.schedule("MyTopic", time() + 60)
+
+        self.assertTrue(self.fired_event.wait(5))
+        self.assertEqual([key for key, fired_at in self.fired], ["MyTopic"])
+
+    def test_cancel(self):
+        self.scheduler.schedule("Cancelled", time() + 0.1)
+        self.scheduler.cancel("Cancelled")
+        self.scheduler.schedule("Kept", time() + 0.2)
+
+        self.assertTrue(self.fired_event.wait(5))
+        self.assertEqual([key for key, fired_at in self.fired], ["Kept"])
+
+    def test_stop(self):
+        self.scheduler.schedule("MyTopic", time() + 0.1)
+
+        self.scheduler.stop()
+
+        self.assertFalse(self.scheduler.thread.is_alive())
+        self.assertFalse(self.fired_event.wait(0.2))
+
+if __name__ == '__main__':
+    unittest.main()
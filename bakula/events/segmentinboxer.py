@@ -0,0 +1,505 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import os
+import shutil
+import struct
+from uuid import uuid4
+from atomiclong import AtomicLong
+from bakula.events.inboxer import (Inboxer, DEFAULT_MASTER_INBOX,
+                                   DEFAULT_CONTAINER_INBOXES,
+                                   DEFAULT_CHUNK_SIZE, INCOMING_DIRECTORY)
+
+SEGMENT_LOG = "segment.log"
+SEGMENT_INDEX = "segment.idx"
+
+# Every index entry holds the event counter, the offset of the event in the
+# segment log and its length in bytes
+INDEX_ENTRY = struct.Struct(">QQI")
+
+# Promotion modes; either write each event out as its own file in the
+# container inbox (the same layout the file based Inboxer produces) or hand
+# the container the segment log and its index as they are
+PROMOTE_MATERIALIZE = "materialize"
+PROMOTE_SEGMENT = "segment"
+
+# Reads an index file and returns a list of (counter, offset, length) tuples.
+# A partially written trailing entry is ignored.
+def read_index(index_path):
+    with open(index_path, "rb") as fin:
+        raw = fin.read()
+    count = len(raw) // INDEX_ENTRY.size
+    return [INDEX_ENTRY.unpack_from(raw, i * INDEX_ENTRY.size)
+            for i in range(count)]
+
+# class SegmentInboxer is an Inboxer backend that packs the events of a topic
+# into one append-only segment log with a compact offset index, rather than
+# writing one file per event. Promotion moves the whole segment into the
+# container inbox with two renames.
+class SegmentInboxer(Inboxer):
+
+    def __init__(self,
+                 master_inbox_path=DEFAULT_MASTER_INBOX,
+                 container_inboxes_path=DEFAULT_CONTAINER_INBOXES,
+                 atomic_counter=AtomicLong(0),
+                 committer=None,
+                 promotion=PROMOTE_MATERIALIZE):
+        if promotion not in (PROMOTE_MATERIALIZE, PROMOTE_SEGMENT):
+            raise ValueError("Unknown promotion mode %s" % promotion)
+        self.segments = {} # Open segment files keyed by topic
+        super(SegmentInboxer, self).__init__(master_inbox_path,
+                                             container_inboxes_path,
+                                             atomic_counter,
+                                             committer)
+        # Segments are always promoted by rename; this only decides what the
+        # container is handed
+        self.promotion = promotion
+
+    # Cuts off anything a crash left half written: a trailing partial index
+    # entry, or entries pointing past the end of the log. Returns the entries
+    # that survived.
+    def __recover_segment(self, topic_path):
+        log_path = os.path.join(topic_path, SEGMENT_LOG)
+        index_path = os.path.join(topic_path, SEGMENT_INDEX)
+        if not os.path.exists(index_path):
+            return []
+
+        log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        entries = read_index(index_path)
+        while entries and entries[-1][1] + entries[-1][2] > log_size:
+            entries.pop()
+
+        index_size = len(entries) * INDEX_ENTRY.size
+        if os.path.getsize(index_path) != index_size:
+            with open(index_path, "r+b") as fout:
+                fout.truncate(index_size)
+        log_end = entries[-1][1] + entries[-1][2] if entries else 0
+        if log_size != log_end:
+            with open(log_path, "r+b") as fout:
+                fout.truncate(log_end)
+        return entries
+
+    # Counts the events in every topic's segment at startup
+    def _reconcile_count_cache(self):
+        highest = 0
+        for topic in os.listdir(self.master_inbox_path):
+            topic_path = os.path.join(self.master_inbox_path, topic)
+            if topic == INCOMING_DIRECTORY or not os.path.isdir(topic_path):
+                continue
+            entries = self.__recover_segment(topic_path)
+            if entries:
+                self.count_cache[topic] = len(entries)
+                highest = max(highest, max(entry[0] for entry in entries))
+
+        self._advance_counter(highest)
+
+    # Gets the open segment for a topic, opening it if needed. Must be called
+    # with the topic lock held.
+    def __get_segment(self, topic):
+        segment = self.segments.get(topic)
+        if segment is None:
+            topic_path = os.path.join(self.master_inbox_path, topic)
+            if not os.path.exists(topic_path):
+                os.makedirs(topic_path)
+            log = open(os.path.join(topic_path, SEGMENT_LOG), "ab")
+            index = open(os.path.join(topic_path, SEGMENT_INDEX), "ab")
+            log.seek(0, os.SEEK_END)
+            index.seek(0, os.SEEK_END)
+            segment = {"log": log, "index": index, "offset": log.tell(),
+                       "index_offset": index.tell()}
+            self.segments[topic] = segment
+        return segment
+
+    # Closes the open segment for a topic. Must be called with the topic lock
+    # held.
+    def __close_segment(self, topic):
+        segment = self.segments.pop(topic, None)
+        if segment is not None:
+            segment["log"].close()
+            segment["index"].close()
+
+    # Drops whatever part of a failed append made it into the log and index;
+    # the segment will be reopened at the right offsets next time. Must be
+    # called with the topic lock held.
+    def __rollback(self, topic):
+        segment = self.segments[topic]
+        self.__close_segment(topic)
+        topic_path = os.path.join(self.master_inbox_path, topic)
+        with open(os.path.join(topic_path, SEGMENT_LOG), "r+b") as fout:
+            fout.truncate(segment["offset"])
+        with open(os.path.join(topic_path, SEGMENT_INDEX), "r+b") as fout:
+            fout.truncate(segment["index_offset"])
+
+    # Makes an append durable (if durability is on) and notifies the
+    # subscriber. Called after the topic lock has been released so other
+    # writers can join the same group commit.
+    def __finish_append(self, topic, count, fds, size, notify):
+        self._update_count_cache(topic, count)
+        if self.committer and not self._commit(
+                fds, os.path.join(self.master_inbox_path, topic), size):
+            return False
+        if notify:
+            self.notify_received(topic)
+        return True
+
+    # Appends one event, made up of the given chunks, to the topic's segment
+    def __append(self, topic, chunks, notify):
+        fds = None
+        with self._get_topic_lock(topic):
+            segment = self.__get_segment(topic)
+            counter = self._next_counter()
+            offset = segment["offset"]
+            length = 0
+            try:
+                for chunk in chunks:
+                    segment["log"].write(chunk)
+                    length += len(chunk)
+                segment["log"].flush()
+                segment["index"].write(INDEX_ENTRY.pack(counter, offset, length))
+                segment["index"].flush()
+            except Exception as ex:
+                print "Writing to segment log failed due to %s" % ex
+                self.__rollback(topic)
+                return None
+            segment["offset"] = offset + length
+            segment["index_offset"] += INDEX_ENTRY.size
+            if self.committer:
+                fds = [os.dup(segment["log"].fileno()),
+                       os.dup(segment["index"].fileno())]
+
+        if not self.__finish_append(topic, 1, fds, length, notify):
+            return None
+        return counter
+
+    # Takes a topic and a list of records and appends them to the topic's
+    # segment with a single write to the index. Returns the first and last
+    # counter assigned.
+    def add_batch(self, topic, records, notify=True):
+        if len(records) == 0:
+            return None
+        fds = None
+        with self._get_topic_lock(topic):
+            segment = self.__get_segment(topic)
+            last = self._next_counter(len(records))
+            first = last - len(records) + 1
+            offset = segment["offset"]
+            position = offset
+            entries = []
+            try:
+                for i, record in enumerate(records):
+                    segment["log"].write(record)
+                    entries.append(INDEX_ENTRY.pack(first + i, position,
+                                                    len(record)))
+                    position += len(record)
+                segment["log"].flush()
+                segment["index"].write("".join(entries))
+                segment["index"].flush()
+            except Exception as ex:
+                print "Writing batch to segment log failed due to %s" % ex
+                self.__rollback(topic)
+                return None
+            segment["offset"] = position
+            segment["index_offset"] += INDEX_ENTRY.size * len(records)
+            if self.committer:
+                fds = [os.dup(segment["log"].fileno()),
+                       os.dup(segment["index"].fileno())]
+
+        if not self.__finish_append(topic, len(records), fds,
+                                    position - offset, notify):
+            return None
+        return (first, last)
+
+    # Takes a topic and a path to a file on the file system and appends its
+    # contents to the topic's segment, removing the original file. Streams
+    # are spooled to disk first (see Inboxer.add_file_by_stream) and added
+    # here, so a slow upload never holds the topic lock.
+    def add_file_by_path(self, topic, file_path, notify=True):
+        if not os.path.exists(file_path):
+            print "Cannot add %s to the master inbox; it does not exist" % file_path
+            return None
+        with open(file_path, "rb") as fin:
+            counter = self.__append(
+                topic, iter(lambda: fin.read(DEFAULT_CHUNK_SIZE), ""), notify)
+        if counter is not None:
+            os.remove(file_path)
+        return counter
+
+    # Takes a topic and data and appends it to the topic's segment
+    def add_file_by_bytes(self, topic, data, notify=True):
+        return self.__append(topic, [data], notify)
+
+    # Gets a listing of the events currently in the segment for the specified
+    # topic
+    def get_inbox_list(self, topic):
+        index_path = os.path.join(self.master_inbox_path, topic, SEGMENT_INDEX)
+        if not os.path.exists(index_path):
+            return []
+        return [str(entry[0]) for entry in read_index(index_path)]
+
+    # Writes the given index entries of the segment log at log_path out as one
+    # file per event in inbox_path
+    def __materialize(self, log_path, entries, inbox_path):
+        if not os.path.exists(inbox_path):
+            os.makedirs(inbox_path)
+        with open(log_path, "rb") as log:
+            for counter, offset, length in entries:
+                log.seek(offset)
+                with open(os.path.join(inbox_path, str(counter)), "wb") as fout:
+                    remaining = length
+                    while remaining > 0:
+                        chunk = log.read(min(DEFAULT_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        fout.write(chunk)
+                        remaining -= len(chunk)
+
+    # Gives inbox_path a hard link to the segment log at log_path and an
+    # index holding only the given entries
+    def __link_segment(self, log_path, entries, inbox_path):
+        os.makedirs(inbox_path)
+        os.link(log_path, os.path.join(inbox_path, SEGMENT_LOG))
+        with open(os.path.join(inbox_path, SEGMENT_INDEX), "wb") as fout:
+            fout.write("".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+
+    # Renames the topic's segment into inbox_path out from under the writers,
+    # so events arriving afterwards go into a fresh segment. Returns the
+    # number of events taken, or None if there was nothing to take.
+    def __take_segment(self, topic, inbox_path):
+        topic_path = os.path.join(self.master_inbox_path, topic)
+        with self._get_topic_lock(topic):
+            self.__close_segment(topic)
+            index_path = os.path.join(topic_path, SEGMENT_INDEX)
+            if not os.path.exists(index_path):
+                return None
+            promoted = os.path.getsize(index_path) // INDEX_ENTRY.size
+            if promoted == 0:
+                return None
+
+            try:
+                if not os.path.exists(inbox_path):
+                    os.makedirs(inbox_path)
+                os.rename(os.path.join(topic_path, SEGMENT_LOG),
+                          os.path.join(inbox_path, SEGMENT_LOG))
+                os.rename(index_path, os.path.join(inbox_path, SEGMENT_INDEX))
+            except Exception as ex:
+                print "Moving segment to container inbox failed due to %s" % ex
+                return None
+        self._update_count_cache(topic, -promoted)
+        return promoted
+
+    # Promotes the topic's segment into a container inbox delineated by
+    # container id
+    def promote_to_container_inbox(self, topic, containerids):
+        isArray = not isinstance(containerids, basestring)
+        containerids = containerids if isArray else [containerids]
+        if len(containerids) == 0:
+            return None
+
+        first_inbox = os.path.join(self.container_inboxes_path,
+                                   containerids[0])
+        if self.__take_segment(topic, first_inbox) is None:
+            return None
+
+        if self.promotion == PROMOTE_MATERIALIZE:
+            log_path = os.path.join(first_inbox, SEGMENT_LOG)
+            index_path = os.path.join(first_inbox, SEGMENT_INDEX)
+            self.__materialize(log_path, read_index(index_path), first_inbox)
+            os.remove(log_path)
+            os.remove(index_path)
+
+        # Every other container gets hard links to the same files
+        container_inboxes = [first_inbox]
+        for containerid in containerids[1:]:
+            container_inbox_path = os.path.join(self.container_inboxes_path,
+                                                containerid)
+            if not os.path.exists(container_inbox_path):
+                os.makedirs(container_inbox_path)
+            try:
+                for fname in os.listdir(first_inbox):
+                    os.link(os.path.join(first_inbox, fname),
+                            os.path.join(container_inbox_path, fname))
+            except Exception as ex:
+                print "Generating hard links failed due to %s" % ex
+                return None
+            container_inboxes.append(container_inbox_path)
+
+        return container_inboxes
+
+    # Promotes the topic's segment into as many container inboxes as it takes
+    # to hold at most batch_size events each. When handing over segments,
+    # every inbox gets a link to the same log and an index of its own slice.
+    def promote_in_batches(self, topic, batch_size):
+        first_inbox = os.path.join(self.container_inboxes_path, str(uuid4()))
+        if self.__take_segment(topic, first_inbox) is None:
+            return None
+
+        log_path = os.path.join(first_inbox, SEGMENT_LOG)
+        index_path = os.path.join(first_inbox, SEGMENT_INDEX)
+        entries = read_index(index_path)
+        if not batch_size or batch_size <= 0:
+            batch_size = len(entries)
+        batches = [entries[i:i + batch_size]
+                   for i in range(0, len(entries), batch_size)]
+
+        container_inboxes = [first_inbox]
+        for batch in batches[1:]:
+            container_inboxes.append(
+                os.path.join(self.container_inboxes_path, str(uuid4())))
+
+        try:
+            for inbox_path, batch in zip(container_inboxes, batches):
+                if self.promotion == PROMOTE_MATERIALIZE:
+                    self.__materialize(log_path, batch, inbox_path)
+                elif inbox_path != first_inbox:
+                    self.__link_segment(log_path, batch, inbox_path)
+                else:
+                    # The first inbox keeps the log; cut its index down to
+                    # the first batch
+                    with open(index_path, "r+b") as fout:
+                        fout.truncate(len(batch) * INDEX_ENTRY.size)
+        except Exception as ex:
+            print "Splitting segment into batches failed due to %s" % ex
+            return None
+
+        if self.promotion == PROMOTE_MATERIALIZE:
+            os.remove(log_path)
+            os.remove(index_path)
+        return container_inboxes
+
+    # Appends the given index entries of the segment log at log_path back to
+    # the topic's segment, e.g. after a failed fan out. They get new numbers.
+    def __restore(self, topic, log_path, entries):
+        with open(log_path, "rb") as log:
+            for counter, offset, length in entries:
+                log.seek(offset)
+                if self.add_file_by_bytes(topic, log.read(length),
+                                          notify=False) is None:
+                    print "Returning event %d to %s failed" % (counter, topic)
+
+    # Fans the topic's segment out to several subscribers. The segment is
+    # taken once into a staging directory; it's then either written out as
+    # files there and linked into every subscriber's inboxes, or, when
+    # handing over segments, linked whole into each inbox along with an index
+    # of that inbox's slice. Whatever couldn't be delivered goes back to the
+    # topic.
+    def _fan_out(self, topic, batch_sizes):
+        staging = os.path.join(self.container_inboxes_path, str(uuid4()))
+        if self.__take_segment(topic, staging) is None:
+            return None
+
+        log_path = os.path.join(staging, SEGMENT_LOG)
+        index_path = os.path.join(staging, SEGMENT_INDEX)
+        entries = read_index(index_path)
+        result = []
+        try:
+            if self.promotion == PROMOTE_MATERIALIZE:
+                self.__materialize(log_path, entries, staging)
+                os.remove(log_path)
+                os.remove(index_path)
+                result, delivered = self._link_batches(
+                    staging, [str(entry[0]) for entry in entries], batch_sizes)
+            else:
+                for batch_size in batch_sizes:
+                    if not batch_size or batch_size <= 0:
+                        batch_size = len(entries)
+                    container_inboxes = []
+                    result.append(container_inboxes)
+                    for i in range(0, len(entries), batch_size):
+                        inbox_path = os.path.join(self.container_inboxes_path,
+                                                  str(uuid4()))
+                        container_inboxes.append(inbox_path)
+                        self.__link_segment(log_path,
+                                            entries[i:i + batch_size],
+                                            inbox_path)
+                os.remove(log_path)
+                os.remove(index_path)
+        except Exception as ex:
+            print "Fanning out segment failed due to %s" % ex
+            # No subscriber gets anything; the events go back to the topic
+            for container_inboxes in result:
+                for inbox_path in container_inboxes:
+                    shutil.rmtree(inbox_path, ignore_errors=True)
+            result = None
+            if os.path.exists(log_path):
+                self.__restore(topic, log_path, entries)
+                shutil.rmtree(staging, ignore_errors=True)
+                return None
+
+        # Events that weren't delivered are left as files in staging
+        leftovers = sorted(os.listdir(staging), key=int)
+        for fname in leftovers:
+            if self.add_file_by_path(topic, os.path.join(staging, fname),
+                                     notify=False) is None:
+                print "Returning event %s to %s failed" % (fname, topic)
+        if len(os.listdir(staging)) > 0:
+            print "Some events could not be fanned out; left in %s" % staging
+        else:
+            os.rmdir(staging)
+        return result if result and len(leftovers) < len(entries) else None
+
+    # Get a count of the events in a container inbox made by this inboxer
+    def get_container_inbox_count(self, container_inbox):
+        if self.promotion == PROMOTE_MATERIALIZE:
+            return Inboxer.get_container_inbox_count(self, container_inbox)
+        return (os.path.getsize(os.path.join(container_inbox, SEGMENT_INDEX)) //
+                INDEX_ENTRY.size)
+
+    # Regroups the events in the given container inboxes into inboxes of at
+    # most batch_size events each. Handed over segments are copied into one
+    # new segment that every resulting inbox links along with an index of its
+    # own slice, oldest event first. If that fails the given inboxes
+    # are returned as they are.
+    def regroup(self, container_inboxes, batch_size):
+        if self.promotion == PROMOTE_MATERIALIZE:
+            return Inboxer.regroup(self, container_inboxes, batch_size)
+
+        staging = os.path.join(self.container_inboxes_path, str(uuid4()))
+        log_path = os.path.join(staging, SEGMENT_LOG)
+        result = []
+        try:
+            os.makedirs(staging)
+            entries = []
+            with open(log_path, "wb") as log:
+                for container_inbox in container_inboxes:
+                    with open(os.path.join(container_inbox, SEGMENT_LOG),
+                              "rb") as source:
+                        for counter, offset, length in read_index(
+                                os.path.join(container_inbox, SEGMENT_INDEX)):
+                            source.seek(offset)
+                            entries.append((counter, log.tell(), length))
+                            log.write(source.read(length))
+            entries.sort()
+
+            if not batch_size or batch_size <= 0:
+                batch_size = max(len(entries), 1)
+            for i in range(0, len(entries), batch_size):
+                inbox_path = os.path.join(self.container_inboxes_path,
+                                          str(uuid4()))
+                result.append(inbox_path)
+                self.__link_segment(log_path, entries[i:i + batch_size],
+                                    inbox_path)
+        except Exception as ex:
+            print "Regrouping segments failed due to %s" % ex
+            for inbox_path in result:
+                shutil.rmtree(inbox_path, ignore_errors=True)
+            shutil.rmtree(staging, ignore_errors=True)
+            return container_inboxes
+
+        shutil.rmtree(staging, ignore_errors=True)
+        for container_inbox in container_inboxes:
+            shutil.rmtree(container_inbox, ignore_errors=True)
+        return result
@@ -0,0 +1,289 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+from atomiclong import AtomicLong
+from segmentinboxer import (SegmentInboxer, PROMOTE_SEGMENT,
+                            PROMOTE_MATERIALIZE, SEGMENT_LOG,
+                            SEGMENT_INDEX, read_index)
+
+# A request body whose sender stalls after the first chunk until released
+class StalledStream(object):
+    def __init__(self):
+        self.chunks = ["first ", "second"]
+        self.reading = threading.Event()
+        self.release = threading.Event()
+
+    def read(self, size=-1):
+        if len(self.chunks) == 1:
+            self.reading.set()
+            self.release.wait(5)
+        return self.chunks.pop(0) if self.chunks else ""
+
+class SegmentInboxerTest(unittest.TestCase):
+
+    TEST_DIR = os.path.join(tempfile.gettempdir(), 'segmentinboxer_test')
+    MASTER_INBOX = os.path.join(TEST_DIR, "master_inbox")
+    CONTAINER_INBOXES = os.path.join(TEST_DIR, "container_inboxes")
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    def test_add_events(self):
+        inboxer = SegmentInboxer(self.MASTER_INBOX, self.CONTAINER_INBOXES)
+        testfile = os.path.join(self.TEST_DIR, "testFile.json")
+        with open(testfile, "w") as fout:
+            fout.write("from a file")
+
+        first = inboxer.add_file_by_bytes("MyTopic", "from bytes")
+        second = inboxer.add_file_by_path("MyTopic", testfile)
+        third = inboxer.add_file_by_stream("MyTopic", StringIO("streamed"),
+                                           chunk_size=3)
+
+        self.assertFalse(os.path.exists(testfile))
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 3)
+        self.assertEqual(inboxer.get_inbox_list("MyTopic"),
+                         [str(first), str(second), str(third)])
+        # Everything lives in a single log and index
+        self.assertEqual(sorted(os.listdir(os.path.join(self.MASTER_INBOX,
+                                                        "MyTopic"))),
+                         [SEGMENT_INDEX, SEGMENT_LOG])
+
+    def test_stalled_stream_does_not_block_topic(self):
+        inboxer = SegmentInboxer(self.MASTER_INBOX, self.CONTAINER_INBOXES)
+        stream = StalledStream()
+        thread = threading.Thread(target=inboxer.add_file_by_stream,
+                                  args=("MyTopic", stream))
+        thread.start()
+        self.assertTrue(stream.reading.wait(5))
+
+        # Other writers carry on while the upload is stalled
+        done = threading.Event()
+
+        def write():
+            inboxer.add_file_by_bytes("MyTopic", "quick")
+            done.set()
+        threading.Thread(target=write).start()
+        self.assertTrue(done.wait(2))
+
+        stream.release.set()
+        thread.join(5)
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 2)
+        log_path = os.path.join(self.MASTER_INBOX, "MyTopic", SEGMENT_LOG)
+        with open(log_path, "rb") as fin:
+            self.assertEqual(fin.read(), "quickfirst second")
+
+    def test_add_batch(self):
+        inboxer = SegmentInboxer(self.MASTER_INBOX, self.CONTAINER_INBOXES)
+        inboxer.add_file_by_bytes("MyTopic", "single")
+        first, last = inboxer.add_batch("MyTopic", ["one", "two", "three"])
+
+        self.assertEqual(last - first, 2)
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 4)
+        self.assertEqual(inboxer.get_inbox_list("MyTopic")[1:],
+                         [str(c) for c in range(first, last + 1)])
+
+        inbox = inboxer.promote_to_container_inbox("MyTopic", "Container")[0]
+        with open(os.path.join(inbox, str(last))) as fin:
+            self.assertEqual(fin.read(), "three")
+
+    def test_promote_materialize(self):
+        inboxer = SegmentInboxer(self.MASTER_INBOX, self.CONTAINER_INBOXES)
+        first = inboxer.add_file_by_bytes("MyTopic", "one")
+        second = inboxer.add_file_by_bytes("MyTopic", "two")
+
+        inboxes = inboxer.promote_to_container_inbox("MyTopic",
+                                                     ["Container1",
+                                                      "Container2"])
+
+        self.assertEqual(len(inboxes), 2)
+        for inbox in inboxes:
+            self.assertEqual(sorted(os.listdir(inbox)),
+                             sorted([str(first), str(second)]))
+            with open(os.path.join(inbox, str(second))) as fin:
+                self.assertEqual(fin.read(), "two")
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 0)
+        self.assertEqual(inboxer.get_inbox_list("MyTopic"), [])
+
+        # Writers carry on into a fresh segment
+        inboxer.add_file_by_bytes("MyTopic", "three")
+        self.assertEqual(inboxer.get_inbox_count("MyTopic"), 1)
+
+    def test_promote_segment(self):
+        inboxer = SegmentInboxer(self.MASTER_INBOX, self.CONTAINER_INBOXES,
+                                 promotion=PROMOTE_SEGMENT)
+        inboxer.add_file_by_bytes("MyTopic", "one")
+        counter = inboxer.add_file_by_bytes("MyTopic", "two")
+
+        inbox = inboxer.promote_to_container_inbox("MyTopic", "Container")[0]
+
+        entries = read_index(os.path.join(inbox, SEGMENT_INDEX))
+        self.assertEqual(len(entries), 2)
+        last_counter, offset, length = entries[-1]
+        self.assertEqual(last_counter, counter)
+        with open(os.path.join(inbox, SEGMENT_LOG), "rb") as fin:
+            fin.seek(offset)
+            self.assertEqual(fin.read(length), "two")
+
+    def test_promote_in_batches(self):
+        for promotion in [PROMOTE_MATERIALIZE, PROMOTE_SEGMENT]:
+            inboxer = SegmentInboxer(os.path.join(self.MASTER_INBOX, promotion),
+                                     self.CONTAINER_INBOXES,
+                                     promotion=promotion)
+            first, last = inboxer.add_batch("MyTopic",
+                                            ["e%d" % i for i in range(5)])
+
+            inboxes = inboxer.promote_in_batches("MyTopic", 2)
+
+            self.assertEqual(len(inboxes), 3)
+            self.assertEqual(inboxer.get_inbox_count("MyTopic"), 0)
+            batches = []
+            for inbox in inboxes:
+                if promotion == PROMOTE_MATERIALIZE:
+                    batches.append(sorted(int(f) for f in os.listdir(inbox)))
+                else:
+                    entries = read_index(os.path.join(inbox, SEGMENT_INDEX))
+                    batches.append([entry[0] for entry in entries])
+            self.assertEqual(batches, [[first, first + 1],
+                                       [first + 2, first + 3],
+                                       [last]])
+
+            # The last slice still reads its event from the shared log
+            if promotion == PROMOTE_SEGMENT:
+                counter, offset, length = read_index(
+                    os.path.join(inboxes[2], SEGMENT_INDEX))[0]
+                with open(os.path.join(inboxes[2], SEGMENT_LOG), "rb") as fin:
+                    fin.seek(offset)
+                    self.assertEqual(fin.read(length), "e4")
+
+    def test_promote_empty(self):
+        inboxer = SegmentInboxer(self.MASTER_INBOX, self.CONTAINER_INBOXES)
+        self.assertIsNone(inboxer.promote_to_container_inbox("MyTopic",
+                                                             "Container"))
+
+    def test_recovery_on_startup(self):
+        inboxer = SegmentInboxer(self.MASTER_INBOX, self.CONTAINER_INBOXES)
+        inboxer.add_file_by_bytes("MyTopic", "one")
+        counter = inboxer.add_file_by_bytes("MyTopic", "two")
+
+        # Simulate a crash part way through writing an index entry
+        index_path = os.path.join(self.MASTER_INBOX, "MyTopic", SEGMENT_INDEX)
+        with open(index_path, "ab") as fout:
+            fout.write("\x00\x01")
+
+        restarted = SegmentInboxer(self.MASTER_INBOX, self.CONTAINER_INBOXES,
+                                   atomic_counter=AtomicLong(0))
+        self.assertEqual(restarted.get_inbox_count("MyTopic"), 2)
+        self.assertTrue(restarted.add_file_by_bytes("MyTopic", "three") > counter)
+        self.assertEqual(len(restarted.get_inbox_list("MyTopic")), 3)
+
+    def test_fan_out(self):
+        for promotion in [PROMOTE_MATERIALIZE, PROMOTE_SEGMENT]:
+            inboxer = SegmentInboxer(os.path.join(self.MASTER_INBOX, promotion),
+                                     os.path.join(self.CONTAINER_INBOXES,
+                                                  promotion),
+                                     promotion=promotion)
+            first, last = inboxer.add_batch("MyTopic", ["e0", "e1", "e2"])
+
+            subscribers = inboxer.fan_out("MyTopic", [None, 2])
+
+            self.assertEqual(inboxer.get_inbox_count("MyTopic"), 0)
+            batches = []
+            for inboxes in subscribers:
+                for inbox in inboxes:
+                    if promotion == PROMOTE_MATERIALIZE:
+                        batches.append(sorted(int(f) for f in os.listdir(inbox)))
+                    else:
+                        entries = read_index(os.path.join(inbox, SEGMENT_INDEX))
+                        batches.append([entry[0] for entry in entries])
+            self.assertEqual(batches, [[first, first + 1, last],
+                                       [first, first + 1],
+                                       [last]])
+            # The staging directory is cleaned up
+            self.assertEqual(len(os.listdir(os.path.join(self.CONTAINER_INBOXES,
+                                                         promotion))), 3)
+
+    def test_fan_out_failure_returns_events(self):
+        for promotion in [PROMOTE_MATERIALIZE, PROMOTE_SEGMENT]:
+            container_inboxes = os.path.join(self.CONTAINER_INBOXES, promotion)
+            inboxer = SegmentInboxer(os.path.join(self.MASTER_INBOX, promotion),
+                                     container_inboxes, promotion=promotion)
+            inboxer.add_batch("MyTopic", ["e0", "e1", "e2"])
+
+            # The second link fails
+            link = os.link
+            calls = []
+            def failing_link(source, destination):
+                calls.append(source)
+                if len(calls) == 2:
+                    raise OSError("Too many links")
+                link(source, destination)
+            os.link = failing_link
+            try:
+                self.assertIsNone(inboxer.fan_out("MyTopic", [None, 2]))
+            finally:
+                os.link = link
+
+            # Every event is back on the topic and nothing is left behind
+            self.assertEqual(inboxer.get_inbox_count("MyTopic"), 3)
+            self.assertEqual(os.listdir(container_inboxes), [])
+            inbox = inboxer.promote_to_container_inbox("MyTopic", "c1")[0]
+            if promotion == PROMOTE_MATERIALIZE:
+                contents = [open(os.path.join(inbox, f)).read()
+                            for f in sorted(os.listdir(inbox), key=int)]
+                self.assertEqual(contents, ["e0", "e1", "e2"])
+
+    def test_regroup(self):
+        for promotion in [PROMOTE_MATERIALIZE, PROMOTE_SEGMENT]:
+            container_inboxes = os.path.join(self.CONTAINER_INBOXES, promotion)
+            inboxer = SegmentInboxer(os.path.join(self.MASTER_INBOX, promotion),
+                                     container_inboxes, promotion=promotion)
+            inboxer.add_batch("MyTopic", ["e0", "e1"])
+            held = inboxer.promote_in_batches("MyTopic", 1)
+            inboxer.add_batch("MyTopic", ["e2", "e3", "e4"])
+            new = inboxer.promote_in_batches("MyTopic", 0)
+            self.assertEqual([inboxer.get_container_inbox_count(inbox)
+                              for inbox in held + new], [1, 1, 3])
+
+            inboxes = inboxer.regroup(held + new, 2)
+
+            batches = []
+            for inbox in inboxes:
+                if promotion == PROMOTE_MATERIALIZE:
+                    batches.append([open(os.path.join(inbox, f)).read()
+                                    for f in sorted(os.listdir(inbox), key=int)])
+                else:
+                    with open(os.path.join(inbox, SEGMENT_LOG), "rb") as log:
+                        batch = []
+                        for counter, offset, length in read_index(
+                                os.path.join(inbox, SEGMENT_INDEX)):
+                            log.seek(offset)
+                            batch.append(log.read(length))
+                        batches.append(batch)
+            self.assertEqual(batches, [["e0", "e1"], ["e2", "e3"], ["e4"]])
+            # Only the regrouped inboxes are left
+            self.assertEqual(sorted(os.listdir(container_inboxes)),
+                             sorted(os.path.basename(inbox)
+                                    for inbox in inboxes))
+
+if __name__ == '__main__':
+    unittest.main()
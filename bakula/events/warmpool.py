@@ -0,0 +1,318 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import os
+import shutil
+import threading
+from time import time
+from uuid import uuid4
+
+# Marker files a warm worker and Bakula signal each other with. A batch is
+# delivered as the directory /inbox/<batch> and announced by creating
+# /inbox/<batch>.ready; the worker creates /inbox/<batch>.done once it has
+# finished with it.
+READY_MARKER = ".ready"
+DONE_MARKER = ".done"
+
+# Set in a warm worker's environment so the image knows to wait for batches
+# rather than process /inbox and exit
+WARM_ENVIRONMENT = {"BAKULA_WARM": "1"}
+
+# How often, in seconds, busy workers are checked for finished batches
+DEFAULT_POLL_INTERVAL = 0.01
+
+# Seconds an idle worker is kept when its registration doesn't say
+DEFAULT_IDLE_TIMEOUT = 60
+
+# Times a batch is handed to a new worker after the one working on it exited
+# before finishing it
+DEFAULT_MAX_REDELIVERIES = 3
+
+# class WarmPool keeps long-lived worker containers for registrations with
+# warm_containers set and hands each new batch to an idle one, saving a
+# container create, start and removal per batch. Each worker mounts a
+# volume of its own as /inbox; batches are moved into it and signalled with
+# marker files. Workers idle for longer than their registration's
+# idle_timeout are stopped. A batch whose worker exits before finishing it
+# is handed to a new worker, up to max_redeliveries times.
+#
+# Callers must not deliver more batches at once to a registration than it
+# has warm_containers; the orchestrator's launch queue sees to that. Idle
+# workers still take up room on the host, so on_released() is called
+# whenever one goes away.
+class WarmPool(object):
+
+    def __init__(self, docker_agent, workers_path,
+                 poll_interval=DEFAULT_POLL_INTERVAL, stat_processor=None,
+                 max_redeliveries=DEFAULT_MAX_REDELIVERIES, on_released=None):
+        self.docker_agent = docker_agent
+        self.workers_path = workers_path
+        self.poll_interval = poll_interval
+        self.stat_processor = stat_processor
+        self.max_redeliveries = max_redeliveries
+        self.on_released = on_released
+        self.workers = {} # (topic, container) -> list of workers
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.__watch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Starts a new worker container for registration, already reserved for
+    # batch
+    def __start_worker(self, topic, registration, batch, on_done, attempts):
+        volume = os.path.join(self.workers_path, str(uuid4()))
+        os.makedirs(volume)
+        container_name = registration["container"]
+        container_id = self.docker_agent.start_container(
+            host_inbox=volume,
+            image_name=container_name,
+            command=registration.get("command"),
+            working_dir=registration.get("working_dir"),
+            on_terminate=self.__worker_exited,
+            topic=topic,
+            environment=WARM_ENVIRONMENT
+        )
+        worker = {
+            "id": container_id,
+            "key": (topic, container_name),
+            "registration": registration,
+            "volume": volume,
+            "idle_timeout": registration.get("idle_timeout") or DEFAULT_IDLE_TIMEOUT,
+            "idle_since": time(),
+            "batch": batch,
+            "on_done": on_done,
+            "attempts": attempts
+        }
+        with self.condition:
+            self.workers.setdefault(worker["key"], []).append(worker)
+        if self.stat_processor is not None:
+            self.docker_agent.stats(container_id, topic, container_name,
+                                    self.stat_processor)
+        return worker
+
+    # Hands the batch in inbox to an idle worker of registration, starting
+    # one if none is idle. on_done() is called once the worker is finished
+    # with it. If the batch can't be moved to the worker, the worker is
+    # freed again, the batch is left in inbox and the error is raised.
+    def deliver(self, topic, registration, inbox, on_done):
+        self.__deliver(topic, registration, inbox, on_done, 0)
+
+    # Delivers a batch that has already been handed to attempts workers
+    def __deliver(self, topic, registration, inbox, on_done, attempts):
+        key = (topic, registration["container"])
+        batch = os.path.basename(inbox)
+        worker = None
+        with self.condition:
+            for candidate in self.workers.get(key, []):
+                if candidate["batch"] is None:
+                    # Reserve it
+                    worker = candidate
+                    worker["batch"] = batch
+                    worker["on_done"] = on_done
+                    worker["attempts"] = attempts
+                    break
+        if worker is None:
+            worker = self.__start_worker(topic, registration, batch, on_done,
+                                         attempts)
+
+        batch_path = os.path.join(worker["volume"], batch)
+        try:
+            os.rename(inbox, batch_path)
+            # Only announce the batch once it's all in place
+            open(batch_path + READY_MARKER, "w").close()
+        except:
+            if os.path.exists(batch_path):
+                os.rename(batch_path, inbox)
+            with self.condition:
+                worker["batch"] = None
+                worker["on_done"] = None
+                worker["idle_since"] = time()
+            self.__released()
+            raise
+        with self.condition:
+            self.condition.notify()
+
+    # Number of workers, busy or idle, kept for a registration
+    def size(self, topic, container):
+        with self.condition:
+            return len(self.workers.get((topic, container), []))
+
+    # Number of idle workers by (topic, container)
+    def idle_counts(self):
+        counts = {}
+        with self.condition:
+            for key, workers in self.workers.items():
+                idle = len([w for w in workers if w["batch"] is None])
+                if idle > 0:
+                    counts[key] = idle
+        return counts
+
+    # Stops the worker that has been idle the longest, to make room for
+    # another container. Returns False if no worker is idle.
+    def reclaim(self):
+        with self.condition:
+            idle = [worker for workers in self.workers.values()
+                    for worker in workers if worker["batch"] is None]
+            if len(idle) == 0:
+                return False
+            worker = min(idle, key=lambda w: w["idle_since"])
+            self.__discard(worker)
+        self.__reap(worker)
+        return True
+
+    # Removes worker from the pool and its volume from disk; expects the
+    # condition's lock to be held
+    def __discard(self, worker):
+        workers = self.workers.get(worker["key"], [])
+        if worker in workers:
+            workers.remove(worker)
+            if len(workers) == 0:
+                del self.workers[worker["key"]]
+        shutil.rmtree(worker["volume"], ignore_errors=True)
+
+    # Called by the docker agent when a worker container exits. A batch it
+    # was working on is moved out of its volume and handed to a new worker.
+    def __worker_exited(self, container_id):
+        on_done = None
+        redelivery = None
+        released = False
+        with self.condition:
+            for workers in self.workers.values():
+                for worker in workers:
+                    if worker["id"] != container_id:
+                        continue
+                    if worker["batch"] is None:
+                        released = True
+                    else:
+                        redelivery = self.__take_batch(worker)
+                        if redelivery is None:
+                            on_done = worker["on_done"]
+                    self.__discard(worker)
+                    break
+        if redelivery is not None:
+            # Starting a container takes a while; don't hold up the caller
+            thread = threading.Thread(target=self.__redeliver,
+                                      args=redelivery)
+            thread.daemon = True
+            thread.start()
+        if on_done is not None:
+            self.__finish(on_done)
+        if released:
+            self.__released()
+
+    # Moves the unfinished batch of an exited worker out of its volume and
+    # returns what's needed to deliver it again, or None if it has been
+    # tried too often; expects the condition's lock to be held
+    def __take_batch(self, worker):
+        batch_path = os.path.join(worker["volume"], worker["batch"])
+        attempts = worker["attempts"] + 1
+        if attempts > self.max_redeliveries or not os.path.exists(batch_path):
+            print ("Warm container %s exited before finishing batch %s; "
+                   "giving up on it") % (worker["id"], worker["batch"])
+            return None
+        print ("Warm container %s exited before finishing batch %s; "
+               "delivering it again") % (worker["id"], worker["batch"])
+        inbox = os.path.join(self.workers_path, worker["batch"])
+        try:
+            os.rename(batch_path, inbox)
+        except Exception as ex:
+            print "Moving batch %s failed due to %s" % (worker["batch"], ex)
+            return None
+        topic, container_name = worker["key"]
+        return (topic, worker["registration"], inbox, worker["on_done"],
+                attempts)
+
+    def __redeliver(self, topic, registration, inbox, on_done, attempts):
+        try:
+            self.__deliver(topic, registration, inbox, on_done, attempts)
+        except Exception as ex:
+            print "Delivering batch %s again failed due to %s" % (inbox, ex)
+            shutil.rmtree(inbox, ignore_errors=True)
+            self.__finish(on_done)
+
+    def __released(self):
+        if self.on_released is not None:
+            try:
+                self.on_released()
+            except Exception as ex:
+                print "Releasing warm container failed due to %s" % ex
+
+    def __finish(self, on_done):
+        try:
+            on_done()
+        except Exception as ex:
+            print "Finishing warm batch failed due to %s" % ex
+
+    # Seconds until the watcher next has something to check: the poll
+    # interval while any worker is busy, otherwise until the first idle
+    # worker is due to be stopped. Expects the condition's lock to be held.
+    def __next_check(self):
+        workers = [worker for workers in self.workers.values()
+                   for worker in workers]
+        if len(workers) == 0:
+            return None
+        if any(worker["batch"] is not None for worker in workers):
+            return self.poll_interval
+        due = min(worker["idle_since"] + worker["idle_timeout"]
+                  for worker in workers)
+        return max(self.poll_interval, due - time())
+
+    # Collects finished batches and stops workers that have idled too long
+    def __watch(self):
+        while True:
+            finished = []
+            idle = []
+            with self.condition:
+                while len(self.workers) == 0:
+                    self.condition.wait()
+                now = time()
+                for workers in self.workers.values():
+                    for worker in list(workers):
+                        if worker["batch"] is not None:
+                            batch_path = os.path.join(worker["volume"],
+                                                      worker["batch"])
+                            if os.path.exists(batch_path + DONE_MARKER):
+                                shutil.rmtree(batch_path, ignore_errors=True)
+                                for marker in [READY_MARKER, DONE_MARKER]:
+                                    if os.path.exists(batch_path + marker):
+                                        os.remove(batch_path + marker)
+                                finished.append(worker["on_done"])
+                                worker["batch"] = None
+                                worker["on_done"] = None
+                                worker["idle_since"] = now
+                        elif now - worker["idle_since"] > worker["idle_timeout"]:
+                            # Take it out of the pool first so no batch is
+                            # delivered to it while it stops
+                            self.__discard(worker)
+                            idle.append(worker)
+
+            for on_done in finished:
+                self.__finish(on_done)
+            for worker in idle:
+                self.__reap(worker)
+            if len(idle) > 0:
+                self.__released()
+            with self.condition:
+                # A delivery wakes it
+                self.condition.wait(self.__next_check())
+
+    # Stops an idle worker; the docker agent removes it once it has exited
+    def __reap(self, worker):
+        try:
+            self.docker_agent.stop_container(worker["id"])
+        except Exception as ex:
+            print "Stopping idle warm container %s failed due to %s" % (worker["id"], ex)
@@ -0,0 +1,152 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from warmpool import WarmPool, READY_MARKER, DONE_MARKER, WARM_ENVIRONMENT
+from bakula.docker.testclient import recording_agent
+
+class WarmPoolTest(unittest.TestCase):
+
+    TEST_DIR = os.path.join(tempfile.gettempdir(), 'warmpool_test')
+    REGISTRATION = {"topic": "MyTopic", "container": "image",
+                    "warm_containers": 1, "idle_timeout": 0.5}
+
+    def setUp(self):
+        os.makedirs(self.TEST_DIR)
+        self.docker_agent, self.client = recording_agent()
+        self.docker_agent.ensure_image("image")
+        # Workers that die are only noticed through the event stream
+        self.assertTrue(self.client.wait_for_stream())
+        self.pool = WarmPool(self.docker_agent,
+                             os.path.join(self.TEST_DIR, "workers"))
+
+    def tearDown(self):
+        self.docker_agent.stop()
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    # The volume and environment of each worker started so far
+    def __started(self):
+        return [(container["inbox"], container["environment"])
+                for container in self.client.created_containers]
+
+    # The id of the nth worker started
+    def __worker(self, n):
+        return self.client.created_containers[n]["id"]
+
+    def __batch(self, name):
+        inbox = os.path.join(self.TEST_DIR, name)
+        os.makedirs(inbox)
+        with open(os.path.join(inbox, "1"), "w") as fout:
+            fout.write("event")
+        return inbox
+
+    def test_deliver_reuses_worker(self):
+        done = threading.Event()
+        self.pool.deliver("MyTopic", self.REGISTRATION, self.__batch("batch1"),
+                          done.set)
+
+        self.assertEqual(len(self.__started()), 1)
+        volume, environment = self.__started()[0]
+        self.assertEqual(environment, WARM_ENVIRONMENT)
+        batch_path = os.path.join(volume, "batch1")
+        self.assertEqual(os.listdir(batch_path), ["1"])
+        self.assertTrue(os.path.exists(batch_path + READY_MARKER))
+
+        # The worker says it's done
+        open(batch_path + DONE_MARKER, "w").close()
+        self.assertTrue(done.wait(5))
+        self.assertFalse(os.path.exists(batch_path))
+
+        # The next batch goes to the same, now idle, worker
+        self.pool.deliver("MyTopic", self.REGISTRATION, self.__batch("batch2"),
+                          lambda: None)
+        self.assertEqual(len(self.__started()), 1)
+        self.assertTrue(os.path.exists(os.path.join(volume, "batch2")))
+
+    def test_idle_worker_is_reaped(self):
+        done = threading.Event()
+        self.pool.deliver("MyTopic", self.REGISTRATION, self.__batch("batch1"),
+                          done.set)
+        volume = self.__started()[0][0]
+        open(os.path.join(volume, "batch1" + DONE_MARKER), "w").close()
+        self.assertTrue(done.wait(5))
+
+        for i in range(50):
+            if self.client.calls_to("stop"):
+                break
+            threading.Event().wait(0.1)
+        self.assertEqual(self.client.calls_to("stop"), [self.__worker(0)])
+        self.assertEqual(self.pool.size("MyTopic", "image"), 0)
+
+    def test_unfinished_batch_is_redelivered(self):
+        self.pool.max_redeliveries = 1
+        done = threading.Event()
+        self.pool.deliver("MyTopic", self.REGISTRATION, self.__batch("batch1"),
+                          done.set)
+
+        # The worker dies part way through; a new one gets the batch
+        self.client.stop(self.__worker(0))
+        for i in range(50):
+            if len(self.__started()) == 2:
+                break
+            threading.Event().wait(0.1)
+        volume = self.__started()[1][0]
+        self.assertEqual(os.listdir(os.path.join(volume, "batch1")), ["1"])
+        self.assertFalse(done.is_set())
+        self.assertFalse(os.path.exists(self.__started()[0][0]))
+
+        # Once it has been tried often enough it's given up on
+        self.client.stop(self.__worker(1))
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self.pool.size("MyTopic", "image"), 0)
+
+    def test_failed_delivery_frees_worker(self):
+        done = threading.Event()
+        missing = os.path.join(self.TEST_DIR, "missing")
+        self.assertRaises(OSError, self.pool.deliver, "MyTopic",
+                          self.REGISTRATION, missing, done.set)
+
+        # The worker started for it is idle rather than stuck with the batch
+        self.assertFalse(done.is_set())
+        self.assertEqual(self.pool.idle_counts(), {("MyTopic", "image"): 1})
+        self.pool.deliver("MyTopic", self.REGISTRATION, self.__batch("batch1"),
+                          lambda: None)
+        self.assertEqual(len(self.__started()), 1)
+        volume = self.__started()[0][0]
+        self.assertTrue(os.path.exists(os.path.join(volume, "batch1")))
+
+    def test_reclaim_idle_worker(self):
+        self.assertFalse(self.pool.reclaim())
+        done = threading.Event()
+        self.pool.deliver("MyTopic", self.REGISTRATION, self.__batch("batch1"),
+                          done.set)
+        self.assertEqual(self.pool.idle_counts(), {})
+        volume = self.__started()[0][0]
+        open(os.path.join(volume, "batch1" + DONE_MARKER), "w").close()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self.pool.idle_counts(), {("MyTopic", "image"): 1})
+
+        self.assertTrue(self.pool.reclaim())
+        self.assertEqual(self.client.calls_to("stop"), [self.__worker(0)])
+        self.assertEqual(self.pool.idle_counts(), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,7 +15,8 @@
 #   specific language governing permissions and limitations
 #   under the License.
 from peewee import (Proxy, Model, CharField, ForeignKeyField, IntegerField,
-                    BooleanField, DecimalField)
+                    BooleanField, DecimalField, FloatField)
+from playhouse.migrate import SchemaMigrator, migrate
 from bakula.bottle import peeweeutils
 
 db = Proxy()
@@ -34,6 +35,24 @@ class Registration(BaseModel):
     privileged = BooleanField(default=False)
     threshold = IntegerField(default=0)
     timeout = IntegerField(default=0)
+    # Largest number of events handed to a single container; a bigger backlog
+    # is split across several containers running in parallel. 0 means no limit.
+    max_batch_size = IntegerField(default=0)
+    # Most containers of this registration running at once; 0 means no limit
+    max_concurrent = IntegerField(default=0)
+    # Long-lived containers kept to take batches as they come, and how many
+    # seconds one may sit idle before it's stopped. 0 containers means a
+    # fresh container per batch.
+    warm_containers = IntegerField(default=0)
+    idle_timeout = IntegerField(default=60)
+    # Containers kept created, but not yet started, for upcoming batches. 0
+    # means every container is created when its batch is ready.
+    precreated_containers = IntegerField(default=0)
+    # What runs the handler: 'docker' runs the container image, 'process'
+    # runs command in working_dir on the Bakula host instead
+    runtime = CharField(default='docker')
+    command = CharField(null=True)
+    working_dir = CharField(null=True)
     creator = ForeignKeyField(User)
 
     class Meta:
@@ -49,6 +68,28 @@ class Metric(BaseModel):
     name = CharField()
     value = DecimalField()
 
+# Metric samples summarised per hour; bucket is the start of the hour in
+# milliseconds. See bakula.rollups.
+class MetricHour(BaseModel):
+    topic = CharField()
+    container = CharField()
+    name = CharField()
+    bucket = IntegerField()
+    count = IntegerField()
+    sum = FloatField()
+    min = FloatField()
+    max = FloatField()
+
+    class Meta:
+        indexes = (
+            (('topic', 'container', 'name', 'bucket'), True),
+        )
+
+# The id of the last Metric row included in the rollups
+class RollupWatermark(BaseModel):
+    name = CharField(primary_key=True)
+    last_id = IntegerField()
+
 class Event(BaseModel):
     topic = CharField()
     container = CharField()
@@ -67,6 +108,19 @@ def resolve_query(query):
         result.append(item)
     return result
 
+# Adds the columns of model that its table doesn't have yet, as when the
+# database was created by an earlier version of Bakula. Every column added
+# since has a default or allows nulls, so existing rows stay valid.
+def add_missing_columns(model):
+    table = model._meta.db_table
+    existing = set(column.name for column in db.get_columns(table))
+    missing = [field for field in model._meta.sorted_fields
+               if field.db_column not in existing]
+    if len(missing) > 0:
+        migrator = SchemaMigrator.from_database(db.obj)
+        migrate(*[migrator.add_column(table, field.db_column, field)
+                  for field in missing])
+
 # Initialize all Models (and their database tables) with a configuration object
 # denoting which database should be used.
 #
@@ -79,8 +133,13 @@ def initialize_models(config):
     # already exist)
     User.create_table(True)
     Registration.create_table(True)
+    add_missing_columns(Registration)
     Metric.create_table(True)
     Event.create_table(True)
+    MetricHour.create_table(True)
+    # Earlier versions also kept per-minute rollups that nothing read
+    db.execute_sql('DROP TABLE IF EXISTS metricminute')
+    RollupWatermark.create_table(True)
 
     # The first user in the DB will be the admin user. Ignore errors.
     from bakula.security import iam
@@ -15,6 +15,9 @@
 #   specific language governing permissions and limitations
 #   under the License.
 import unittest
+import os
+import sqlite3
+import tempfile
 from peewee import Model, CharField, Proxy
 from bakula import models
 from bakula.bottle import peeweeutils
@@ -56,5 +59,41 @@ class ModelsTest(unittest.TestCase):
         self.assertTrue(models.Registration.table_exists())
         self.assertTrue(models.User.table_exists())
 
+    def test_initialize_models_adds_columns(self):
+        # A database made before registrations had batching, warm or
+        # pre-created containers or runtimes
+        path = os.path.join(tempfile.gettempdir(), 'models_test.db')
+        connection = sqlite3.connect(path)
+        connection.executescript("""
+            CREATE TABLE "user" ("id" VARCHAR(255) NOT NULL PRIMARY KEY,
+                                 "password" VARCHAR(255) NOT NULL);
+            CREATE TABLE "registration" (
+                "id" INTEGER NOT NULL PRIMARY KEY,
+                "topic" VARCHAR(255) NOT NULL,
+                "container" VARCHAR(255) NOT NULL,
+                "privileged" SMALLINT NOT NULL,
+                "threshold" INTEGER NOT NULL,
+                "timeout" INTEGER NOT NULL,
+                "creator_id" VARCHAR(255) NOT NULL
+                    REFERENCES "user" ("id"));
+            INSERT INTO "user" VALUES ('me', 'secret');
+            INSERT INTO "registration" VALUES (1, 'MyTopic', 'busybox', 0,
+                                               10, 5, 'me');
+        """)
+        connection.close()
+        try:
+            models.initialize_models({'database.name': path,
+                                      'database.type': 'sqlite'})
+
+            registration = models.Registration.get()
+            self.assertEqual(registration.threshold, 10)
+            self.assertEqual(registration.max_batch_size, 0)
+            self.assertEqual(registration.idle_timeout, 60)
+            self.assertEqual(registration.runtime, 'docker')
+            self.assertIsNone(registration.command)
+        finally:
+            models.db.close()
+            os.remove(path)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,139 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import threading
+from peewee import fn
+from bakula.bulkwriter import SQLITE_MAX_VARIABLES
+from bakula.models import db, Metric, MetricHour, RollupWatermark
+
+MILLISECONDS_IN_HOUR = 3600000
+
+SUMMARY_FIELDS = ['topic', 'container', 'name', 'bucket', 'count', 'sum',
+                  'min', 'max']
+
+# Metric rows summarised per call of roll_up_metrics
+DEFAULT_BATCH_SIZE = 10000
+
+WATERMARK = 'metric'
+
+# Only one roll up runs at a time, so no row is counted twice
+rollup_lock = threading.Lock()
+
+# Adds the given summaries to those already in model's table, inserting the
+# ones it doesn't have yet, with one statement per chunk that fits SQLite's
+# limit on bound values. Works on SQLite 3.24+ and PostgreSQL 9.5+.
+def _upsert(model, summaries):
+    table = model._meta.db_table
+    columns = ", ".join('"%s"' % field for field in SUMMARY_FIELDS)
+    placeholder = "(%s)" % ", ".join([db.interpolation] * len(SUMMARY_FIELDS))
+    update = (
+        '"count" = "{0}"."count" + excluded."count", '
+        '"sum" = "{0}"."sum" + excluded."sum", '
+        '"min" = CASE WHEN excluded."min" < "{0}"."min" '
+        'THEN excluded."min" ELSE "{0}"."min" END, '
+        '"max" = CASE WHEN excluded."max" > "{0}"."max" '
+        'THEN excluded."max" ELSE "{0}"."max" END').format(table)
+    chunk = SQLITE_MAX_VARIABLES // len(SUMMARY_FIELDS)
+    for i in range(0, len(summaries), chunk):
+        rows = summaries[i:i + chunk]
+        db.execute_sql(
+            'INSERT INTO "%s" (%s) VALUES %s ON CONFLICT '
+            '("topic", "container", "name", "bucket") DO UPDATE SET %s' %
+            (table, columns, ", ".join([placeholder] * len(rows)), update),
+            [value for row in rows for value in row])
+
+# Folds the samples in rows into the per-period summaries held in model
+def _fold(model, rows, period):
+    buckets = {}
+    for row in rows:
+        key = (row['topic'], row['container'], row['name'],
+               row['timestamp'] // period * period)
+        value = float(row['value'])
+        if key not in buckets:
+            buckets[key] = [0, 0.0, value, value]
+        bucket = buckets[key]
+        bucket[0] += 1
+        bucket[1] += value
+        bucket[2] = min(bucket[2], value)
+        bucket[3] = max(bucket[3], value)
+
+    _upsert(model, [key + tuple(bucket) for key, bucket in buckets.items()])
+
+# Gets the id of the last Metric row included in the rollups
+def get_watermark():
+    try:
+        return RollupWatermark.get(RollupWatermark.name == WATERMARK).last_id
+    except RollupWatermark.DoesNotExist:
+        return 0
+
+# Adds Metric rows written since the last call to the per-hour rollups, at
+# most batch_size of them, in one transaction. Returns the number of rows
+# rolled up.
+def roll_up_metrics(batch_size=DEFAULT_BATCH_SIZE):
+    with rollup_lock:
+        with db.atomic():
+            watermark = get_watermark()
+            rows = list(Metric.select().where(Metric.id > watermark)
+                        .order_by(Metric.id).limit(batch_size).dicts())
+            if len(rows) == 0:
+                return 0
+
+            _fold(MetricHour, rows, MILLISECONDS_IN_HOUR)
+
+            last_id = rows[-1]['id']
+            if RollupWatermark.update(last_id=last_id).where(
+                    RollupWatermark.name == WATERMARK).execute() == 0:
+                RollupWatermark.create(name=WATERMARK, last_id=last_id)
+            return len(rows)
+
+# Rolls up every Metric row not yet in the rollups
+def roll_up_all_metrics(batch_size=DEFAULT_BATCH_SIZE):
+    while roll_up_metrics(batch_size) == batch_size:
+        pass
+
+# Gets the average of every metric recorded for a topic and container, by
+# name. Answered from the hourly rollups plus the raw rows written since
+# the last roll up, so the cost doesn't grow with the number of samples.
+def metric_averages(topic, container):
+    totals = {}
+    with db.atomic():
+        watermark = get_watermark()
+        rolled_up = MetricHour.select(
+            MetricHour.name,
+            fn.SUM(MetricHour.sum).alias('total'),
+            fn.SUM(MetricHour.count).alias('samples')
+        ).where(
+            MetricHour.topic == topic,
+            MetricHour.container == container
+        ).group_by(MetricHour.name)
+        tail = Metric.select(
+            Metric.name,
+            fn.SUM(Metric.value).alias('total'),
+            fn.COUNT(Metric.id).alias('samples')
+        ).where(
+            Metric.topic == topic,
+            Metric.container == container,
+            Metric.id > watermark
+        ).group_by(Metric.name)
+
+        for summary in list(rolled_up) + list(tail):
+            total, samples = totals.get(summary.name, (0.0, 0))
+            totals[summary.name] = (total + float(summary.total),
+                                    samples + summary.samples)
+
+    return dict((name, total / samples)
+                for name, (total, samples) in totals.items() if samples > 0)
@@ -0,0 +1,92 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+from peewee import fn
+from bakula import models
+from bakula.models import Metric, MetricHour, RollupWatermark
+from bakula.rollups import (roll_up_metrics, roll_up_all_metrics,
+                            metric_averages, get_watermark)
+
+class RollupsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        models.initialize_models({'database.name': ':memory:',
+                                  'database.type': 'sqlite'})
+
+    def setUp(self):
+        for model in [Metric, MetricHour, RollupWatermark]:
+            model.delete().execute()
+
+    def __record(self, name, values, timestamp):
+        for value in values:
+            Metric.create(topic='topic', container='container',
+                          timestamp=timestamp, name=name, value=value)
+
+    def __raw_averages(self):
+        return dict((row.name, float(row.average)) for row in Metric.select(
+            Metric.name, fn.AVG(Metric.value).alias('average')
+        ).where(
+            Metric.topic == 'topic', Metric.container == 'container'
+        ).group_by(Metric.name))
+
+    def test_roll_up(self):
+        # Two samples in one hour and one in the next
+        self.__record('cpu', [0.25, 0.75], 60000)
+        self.__record('cpu', [0.5], 3660000)
+
+        self.assertEqual(roll_up_metrics(), 3)
+        self.assertEqual(roll_up_metrics(), 0)
+
+        hours = [(h.bucket, h.count, h.sum, h.min, h.max)
+                 for h in MetricHour.select().order_by(MetricHour.bucket)]
+        self.assertEqual(hours, [(0, 2, 1.0, 0.25, 0.75),
+                                 (3600000, 1, 0.5, 0.5, 0.5)])
+
+        # Later samples are added to the hour already summarised
+        self.__record('cpu', [0.125, 1.0], 120000)
+        self.assertEqual(roll_up_metrics(), 2)
+        hour = MetricHour.get(MetricHour.bucket == 0)
+        self.assertEqual((hour.count, hour.sum, hour.min, hour.max),
+                         (4, 2.125, 0.125, 1.0))
+
+    def test_roll_up_in_batches(self):
+        self.__record('cpu', [0.1, 0.2, 0.3, 0.4, 0.5], 60000)
+
+        self.assertEqual(roll_up_metrics(batch_size=2), 2)
+        roll_up_all_metrics(batch_size=2)
+
+        self.assertEqual(get_watermark(), Metric.select(fn.MAX(Metric.id)).scalar())
+        self.assertEqual(MetricHour.get().count, 5)
+
+    def test_averages_match_raw(self):
+        self.__record('cpu', [0.0143, 0.0148, 0.0153], 60000)
+        self.__record('memory', [0.0045, 0.004535], 3600000)
+        roll_up_metrics()
+        # Samples written since the roll up are read from the raw table
+        self.__record('memory', [0.00612], 3660000)
+        self.__record('disk', [0.5], 3660000)
+
+        averages = metric_averages('topic', 'container')
+        raw = self.__raw_averages()
+        self.assertEqual(sorted(averages.keys()), sorted(raw.keys()))
+        for name in raw:
+            self.assertAlmostEqual(averages[name], raw[name])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import os
+import shlex
+import subprocess
+import threading
+from datetime import datetime
+
+from bakula.runtime.runtime import Runtime
+from bakula.docker.statscollector import StatsCollector, DEFAULT_INTERVAL
+
+# Ids of handlers run as processes are this followed by the process id
+PROCESS_ID_PREFIX = 'process-'
+
+# Environment variable holding the path of a process's inbox. The path is
+# also given as the last argument of its command.
+INBOX_ENVIRONMENT = 'BAKULA_INBOX'
+
+# /proc counts CPU time in clock ticks; Docker reports it in nanoseconds
+NANOSECONDS_PER_TICK = 1e9 / os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# class ProcStats reads a process's resource usage from /proc and reports it
+# the way the Docker stats API does, so a StatsCollector can sample
+# processes just like containers
+class ProcStats(object):
+
+    def stats(self, container_id, decode=True, stream=False):
+        pid = int(container_id[len(PROCESS_ID_PREFIX):])
+        with open('/proc/%d/stat' % pid) as fin:
+            # The command name may hold spaces, so count fields from after it
+            fields = fin.read().rsplit(')', 1)[1].split()
+        # utime and stime are the 14th and 15th fields, the 3rd being first
+        # after the name
+        process_ticks = int(fields[11]) + int(fields[12])
+        with open('/proc/%d/statm' % pid) as fin:
+            resident_pages = int(fin.read().split()[1])
+        with open('/proc/stat') as fin:
+            system_ticks = sum(int(ticks) for ticks in fin.readline().split()[1:])
+        memory_limit = None
+        with open('/proc/meminfo') as fin:
+            for line in fin:
+                if line.startswith('MemTotal:'):
+                    memory_limit = int(line.split()[1]) * 1024
+                    break
+        return {
+            'read': datetime.utcnow().isoformat() + 'Z',
+            'memory_stats': {
+                'usage': resident_pages * PAGE_SIZE,
+                'limit': memory_limit
+            },
+            'cpu_stats': {
+                'cpu_usage': {
+                    'total_usage': int(process_ticks * NANOSECONDS_PER_TICK)
+                },
+                'system_cpu_usage': int(system_ticks * NANOSECONDS_PER_TICK)
+            }
+        }
+
+# class LocalProcessRuntime runs handlers as processes on this host rather
+# than in containers, for trusted handlers where starting a container costs
+# more than the work, or where there's no Docker daemon. A registration's
+# command is run in its working directory with the inbox path appended as
+# the last argument and in the BAKULA_INBOX environment variable. Handlers
+# get no isolation from Bakula or each other.
+class LocalProcessRuntime(Runtime):
+
+    def __init__(self, stats_interval=DEFAULT_INTERVAL, stats_workers=1):
+        self._processes = {} # id -> Popen
+        self._lock = threading.Lock()
+        self._stats_collector = StatsCollector(ProcStats(),
+                                               interval=stats_interval,
+                                               workers=stats_workers)
+
+    # There are no images to pull; the command must already be on the host
+    def ensure_image(self, image_name, tag='latest'):
+        return None
+
+    def start_container(self,
+                        image_name,
+                        host_inbox,
+                        ports=None,
+                        run_privileged=False,
+                        command=None,
+                        on_terminate=None,
+                        topic=None,
+                        environment=None,
+                        working_dir=None):
+        if not command:
+            raise ValueError('Running %s as a process needs a command' %
+                             image_name)
+        process_environment = dict(os.environ)
+        process_environment.update(environment or {})
+        process_environment[INBOX_ENVIRONMENT] = host_inbox
+        process = subprocess.Popen(shlex.split(command) + [host_inbox],
+                                   cwd=working_dir,
+                                   env=process_environment,
+                                   close_fds=True)
+        container_id = '%s%d' % (PROCESS_ID_PREFIX, process.pid)
+        with self._lock:
+            self._processes[container_id] = process
+        thread = threading.Thread(target=self.__wait,
+                                  args=(container_id, process, on_terminate))
+        thread.daemon = True
+        thread.start()
+        return container_id
+
+    # Reaps the process once it exits and hands it to on_terminate
+    def __wait(self, container_id, process, on_terminate):
+        exit_code = process.wait()
+        with self._lock:
+            self._processes.pop(container_id, None)
+            self._stats_collector.unwatch(container_id)
+        if exit_code != 0:
+            print "Process %s exited with %d" % (container_id, exit_code)
+        if on_terminate is not None:
+            try:
+                on_terminate(container_id)
+            except Exception as ex:
+                print "Terminate callback for %s failed due to %s" % (container_id, ex)
+
+    def stats(self, container_id, topic, container_name, stat_processor):
+        with self._lock:
+            # Don't watch a process that has already been reaped
+            if container_id in self._processes:
+                self._stats_collector.watch(container_id, topic,
+                                            container_name, stat_processor)
+
+    def stop_container(self, container_id, timeout=10):
+        with self._lock:
+            process = self._processes.get(container_id)
+        if process is None:
+            return
+        process.terminate()
+
+        def kill():
+            if process.poll() is None:
+                process.kill()
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    # Number of handler processes running
+    def running(self):
+        with self._lock:
+            return len(self._processes)
@@ -0,0 +1,108 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from localprocess import (LocalProcessRuntime, ProcStats, PROCESS_ID_PREFIX,
+                          INBOX_ENVIRONMENT)
+
+# Writes the number of files in its inbox, and where it found the inbox, to
+# handled.txt in its working directory
+HANDLER = ("import os, sys; "
+           "inbox = sys.argv[1]; "
+           "open('handled.txt', 'w').write('%d %s' % (len(os.listdir(inbox)), "
+           "os.environ['" + INBOX_ENVIRONMENT + "'] == inbox))")
+
+class LocalProcessRuntimeTest(unittest.TestCase):
+
+    TEST_DIR = os.path.join(tempfile.gettempdir(), 'localprocess_test')
+
+    def setUp(self):
+        self.inbox = os.path.join(self.TEST_DIR, "inbox")
+        os.makedirs(self.inbox)
+        for name in ["1", "2"]:
+            with open(os.path.join(self.inbox, name), "w") as fout:
+                fout.write("event")
+        self.runtime = LocalProcessRuntime(stats_interval=0.05)
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    def test_run_handler(self):
+        terminated = threading.Event()
+        ids = []
+
+        def on_terminate(container_id):
+            ids.append(container_id)
+            terminated.set()
+
+        container_id = self.runtime.start_container(
+            image_name="handler",
+            host_inbox=self.inbox,
+            command='%s -c "%s"' % (sys.executable, HANDLER),
+            working_dir=self.TEST_DIR,
+            on_terminate=on_terminate)
+
+        self.assertTrue(terminated.wait(10))
+        self.assertEqual(ids, [container_id])
+        self.assertEqual(self.runtime.running(), 0)
+        with open(os.path.join(self.TEST_DIR, "handled.txt")) as fin:
+            self.assertEqual(fin.read(), "2 True")
+
+    def test_stats(self):
+        samples = []
+        sampled = threading.Event()
+
+        def stat_processor(stat, container_id, topic, container_name):
+            samples.append(stat)
+            sampled.set()
+
+        container_id = self.runtime.start_container(
+            image_name="handler",
+            host_inbox=self.inbox,
+            command='%s -c "import time; time.sleep(30)"' % sys.executable)
+        self.runtime.stats(container_id, "MyTopic", "handler", stat_processor)
+
+        self.assertTrue(sampled.wait(10))
+        stat = samples[0]
+        self.assertTrue(0 < stat['memory_stats']['usage'] <
+                        stat['memory_stats']['limit'])
+        self.assertTrue(stat['cpu_stats']['system_cpu_usage'] >=
+                        stat['cpu_stats']['cpu_usage']['total_usage'])
+
+        self.runtime.stop_container(container_id, timeout=1)
+        for i in range(500):
+            if self.runtime.running() == 0:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(self.runtime.running(), 0)
+
+    def test_command_required(self):
+        self.assertRaises(ValueError, self.runtime.start_container,
+                          image_name="handler", host_inbox=self.inbox)
+
+    def test_proc_stats_of_this_process(self):
+        stat = ProcStats().stats("%s%d" % (PROCESS_ID_PREFIX, os.getpid()))
+        self.assertTrue(stat['read'].endswith('Z'))
+        self.assertTrue(stat['cpu_stats']['cpu_usage']['total_usage'] > 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing,
+#   software distributed under the License is distributed on an
+#   "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#   KIND, either express or implied.  See the License for the
+#   specific language governing permissions and limitations
+#   under the License.
+
+# Names a registration's runtime field may take
+RUNTIME_DOCKER = 'docker'
+RUNTIME_PROCESS = 'process'
+
+# class Runtime is what the orchestrator runs a registration's handler on.
+# A handler is started on an inbox directory holding its batch; the runtime
+# calls on_terminate(container_id) once it has stopped and hands samples of
+# its resource usage, shaped like the Docker stats API's, to the stats
+# processor. DockerAgent runs handlers as containers and
+# LocalProcessRuntime as processes on this host.
+class Runtime(object):
+
+    # Makes sure what's needed to run image_name is available, returning
+    # its id if the runtime has one
+    def ensure_image(self, image_name, tag='latest'):
+        raise NotImplementedError()
+
+    # Starts a handler on host_inbox, running command in working_dir when
+    # they're given, and returns its id
+    def start_container(self,
+                        image_name,
+                        host_inbox,
+                        ports=None,
+                        run_privileged=False,
+                        command=None,
+                        on_terminate=None,
+                        topic=None,
+                        environment=None,
+                        working_dir=None):
+        raise NotImplementedError()
+
+    # Samples the handler's resource usage until it terminates, handing each
+    # sample to stat_processor(stat, container_id, topic, container_name)
+    def stats(self, container_id, topic, container_name, stat_processor):
+        raise NotImplementedError()
+
+    # Asks a running handler to stop, killing it after timeout seconds
+    def stop_container(self, container_id, timeout=10):
+        raise NotImplementedError()
@@ -18,9 +18,34 @@ from bottle import Bottle, HTTPResponse, request, response, FileUpload
 
 from bakula.bottle import configuration
 from bakula.bottle.errorutils import create_error
-from bakula.docker.dockeragent import DockerAgent
-from bakula.events.inboxer import Inboxer, DEFAULT_CONTAINER_INBOXES, DEFAULT_MASTER_INBOX
+from bakula.docker.dockeragent import (DockerAgent, DEFAULT_IMAGE_TTL,
+                                      MONITOR_EVENTS, DEFAULT_STATS_INTERVAL,
+                                      DEFAULT_STATS_WORKERS,
+                                      DEFAULT_REMOVE_WORKERS,
+                                      DEFAULT_REMOVE_RETRIES,
+                                      DEFAULT_IMAGE_INDEX_MAX_AGE,
+                                      DEFAULT_DOCKER_TIMEOUT,
+                                      DEFAULT_LAUNCH_SIZE,
+                                      DEFAULT_BACKGROUND_SIZE)
+from bakula.docker.fakeclient import FakeDockerClient, DEFAULT_RUN_TIME
+from bakula.events.inboxer import Inboxer, DEFAULT_CONTAINER_INBOXES, DEFAULT_MASTER_INBOX, PROMOTE_LINK
+from bakula.events.segmentinboxer import SegmentInboxer, PROMOTE_MATERIALIZE
+from bakula.events.groupcommit import (create_committer, DURABILITY_NONE,
+                                       DEFAULT_INTERVAL, DEFAULT_MAX_BYTES)
+from bakula.events.ingestqueue import (IngestQueue, QueueFullException,
+                                      DEFAULT_MAX_SIZE, DEFAULT_WRITERS)
 from bakula.events.orchestrator import Orchestrator
+from bakula.runtime.runtime import RUNTIME_DOCKER, RUNTIME_PROCESS
+from bakula.runtime.localprocess import LocalProcessRuntime
+from bakula.bulkwriter import (BulkWriter, DEFAULT_FLUSH_ROWS,
+                               DEFAULT_FLUSH_INTERVAL, DEFAULT_MAX_ROWS)
+from bakula.models import Metric
+from bakula.rollups import roll_up_all_metrics
+from bakula.events.routing import routing_table, DEFAULT_CHECK_INTERVAL
+import json
+import os
+import struct
+from StringIO import StringIO
 from atomiclong import AtomicLong
 from bakula.security.tokenauthplugin import TokenAuthorizationPlugin
 
@@ -34,15 +59,294 @@ auth_plugin = TokenAuthorizationPlugin(token_secret)
 app.install(auth_plugin)
 
 count = AtomicLong(0)
-inbox = Inboxer(atomic_counter=count,
+# Durability of inbox writes: 'none', 'fsync' (one fsync per event) or 'group'
+# (fsyncs batched across concurrent requests)
+committer = create_committer(app.config.get('inbox.durability', DURABILITY_NONE),
+    interval=float(app.config.get('inbox.group_commit.interval', DEFAULT_INTERVAL)),
+    max_bytes=int(app.config.get('inbox.group_commit.max_bytes', DEFAULT_MAX_BYTES)))
+inbox_args = dict(atomic_counter=count,
+    committer=committer,
     master_inbox_path=app.config.get('inbox.master', DEFAULT_MASTER_INBOX),
     container_inboxes_path=app.config.get('inbox.containers', DEFAULT_CONTAINER_INBOXES))
+# The 'segment' backend packs each topic's events into an append-only log
+# instead of writing one file per event
+if app.config.get('inbox.backend', 'file') == 'segment':
+    inbox = SegmentInboxer(
+        promotion=app.config.get('inbox.segment.promotion', PROMOTE_MATERIALIZE),
+        **inbox_args)
+else:
+    # Promotion of the per-file backend either links files one by one
+    # ('link') or swaps the whole topic directory into place ('rename')
+    inbox = Inboxer(promotion=app.config.get('inbox.promotion', PROMOTE_LINK),
+                    **inbox_args)
+# Setting docker.client to 'fake' swaps the Docker daemon for a simulated
+# one, for benchmarking and trying Bakula out without Docker
+docker_client = None
+if app.config.get("docker.client", "docker") == "fake":
+    docker_client = FakeDockerClient(
+        run_time=float(app.config.get("docker.fake.run_time", DEFAULT_RUN_TIME)),
+        default_latency=float(app.config.get("docker.fake.latency", 0)))
+
 docker_agent = DockerAgent(registry_host=app.config.get("registry.host", None),
     username=app.config.get("registry.username", None),
     password=app.config.get("registry.password", None),
-    docker_timeout=app.config.get("docker.timeout", 2))
+    docker_timeout=app.config.get("docker.timeout", DEFAULT_DOCKER_TIMEOUT),
+    image_ttl=float(app.config.get("docker.image_ttl", DEFAULT_IMAGE_TTL)),
+    monitor=app.config.get("docker.monitor", MONITOR_EVENTS),
+    stats_interval=float(app.config.get("docker.stats.interval", DEFAULT_STATS_INTERVAL)),
+    stats_workers=int(app.config.get("docker.stats.workers", DEFAULT_STATS_WORKERS)),
+    remove_workers=int(app.config.get("docker.remove.workers", DEFAULT_REMOVE_WORKERS)),
+    remove_retries=int(app.config.get("docker.remove.retries", DEFAULT_REMOVE_RETRIES)),
+    auto_remove=bool(app.config.get("docker.auto_remove", False)),
+    image_index_max_age=float(app.config.get("docker.image_index.max_age", DEFAULT_IMAGE_INDEX_MAX_AGE)),
+    launch_connections=int(app.config.get("docker.pool.launch", DEFAULT_LAUNCH_SIZE)),
+    background_connections=int(app.config.get("docker.pool.background", DEFAULT_BACKGROUND_SIZE)),
+    docker_client=docker_client)
+
+# Processes sharing a database should share routing.version_file, so that
+# registration changes made through one are seen by all of them
+routing_table.configure(app.config.get('routing.version_file', None),
+    check_interval=float(app.config.get('routing.check_interval', DEFAULT_CHECK_INTERVAL)))
+
+# Pull a registration's image as soon as it's created so its first event
+# doesn't wait on the registry
+def prepull_registered_image(action, registration):
+    if action != 'added':
+        return
+    if (registration.get('runtime') or RUNTIME_DOCKER) == RUNTIME_DOCKER:
+        docker_agent.prepull(registration['container'])
+
+routing_table.on(prepull_registered_image)
+
+# Metric and Event rows are buffered and written in bulk
+writer = BulkWriter(
+    flush_rows=int(app.config.get('writer.flush_rows', DEFAULT_FLUSH_ROWS)),
+    flush_interval=float(app.config.get('writer.flush_interval', DEFAULT_FLUSH_INTERVAL)),
+    max_rows=int(app.config.get('writer.max_rows', DEFAULT_MAX_ROWS)))
+# Keep the metric rollups current as samples are written
+writer.on_flush(Metric, roll_up_all_metrics)
+
+# Registrations may only run commands on this host when it's allowed
+runtimes = {}
+if app.config.get('runtime.process.enabled', False):
+    runtimes[RUNTIME_PROCESS] = LocalProcessRuntime(
+        stats_interval=float(app.config.get("docker.stats.interval", DEFAULT_STATS_INTERVAL)))
+
+# Events received for a topic within orchestrator.coalesce_window seconds of
+# each other get a single threshold check
+orchestrator = Orchestrator(inboxer=inbox,docker_agent=docker_agent,
+                            routing_table=routing_table,
+                            coalesce_window=float(app.config.get('orchestrator.coalesce_window', 0)),
+                            max_containers=int(app.config.get('orchestrator.max_containers', 0)),
+                            writer=writer,
+                            runtimes=runtimes)
+
+# In 'async' ingest mode requests only spool their uploads and queue them;
+# the inbox write and any container launches happen on background threads
+ingest_queue = None
+if app.config.get('ingest.mode', 'sync') == 'async':
+    ingest_queue = IngestQueue(inbox,
+        max_size=int(app.config.get('ingest.queue_size', DEFAULT_MAX_SIZE)),
+        writers=int(app.config.get('ingest.writers', DEFAULT_WRITERS)))
+retry_after = str(app.config.get('ingest.retry_after', 1))
+
+# Tell the client to back off when the ingest queue is full
+def queue_full_error():
+    return create_error(status_code=429,
+                        message='The event queue is full; try again later',
+                        headers={'Retry-After': retry_after})
+
+# Spools the uploads to disk and queues them, answering 202 Accepted
+def queue_event(topic, uploads):
+    if ingest_queue.full():
+        return queue_full_error()
+
+    paths = []
+    for item in uploads:
+        path = inbox.spool(item.file, topic=topic)
+        if path is None:
+            for spooled in paths:
+                os.remove(spooled)
+            return create_error(status_code=500,
+                                message=('Could not write %s to the '
+                                         'inbox') % item.filename)
+        paths.append(path)
+
+    if len(paths) > 0:
+        try:
+            ingest_queue.put(topic, paths)
+        except QueueFullException:
+            for spooled in paths:
+                os.remove(spooled)
+            return queue_full_error()
+        response.status = 202
+
+    return {"results": [item.filename for item in uploads]}
+
+# Records in a length-prefixed batch are preceded by their length as a 4 byte
+# big-endian integer
+BATCH_LENGTH_PREFIX = struct.Struct(">I")
+max_batch_records = int(app.config.get('ingest.batch.max_records', 10000))
+max_batch_bytes = int(app.config.get('ingest.batch.max_bytes', 16 * 1024 * 1024))
+# Number of records handed to the inbox in one write while streaming a batch
+BATCH_WRITE_SIZE = 500
+
+# Splits a newline-delimited body into records, skipping blank lines. Raises a
+# ValueError if a record isn't JSON.
+def read_ndjson(body):
+    for line in body:
+        record = line.rstrip("\r\n")
+        if record.strip():
+            try:
+                json.loads(record)
+            except ValueError:
+                raise ValueError("Batch holds a line that is not JSON")
+            yield record
 
-orchestrator = Orchestrator(inboxer=inbox,docker_agent=docker_agent)
+# Splits a length-prefixed body into records. Raises a ValueError if the body
+# ends part way through a record.
+def read_length_prefixed(body):
+    while True:
+        prefix = body.read(BATCH_LENGTH_PREFIX.size)
+        if not prefix:
+            return
+        if len(prefix) < BATCH_LENGTH_PREFIX.size:
+            raise ValueError("Batch ends in the middle of a length prefix")
+        length = BATCH_LENGTH_PREFIX.unpack(prefix)[0]
+        record = body.read(length)
+        if len(record) < length:
+            raise ValueError("Batch ends in the middle of a record")
+        yield record
+
+BATCH_READERS = {
+    'ndjson': read_ndjson,
+    'length-prefixed': read_length_prefixed
+}
+
+# Refuses a batch over ingest.batch.max_records or ingest.batch.max_bytes
+def batch_too_large_error():
+    return create_error(status_code=413,
+                        message=('A batch may hold at most %d events and %d '
+                                 'bytes') % (max_batch_records, max_batch_bytes))
+
+# Groups records into lists of at most size
+def chunk_records(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+# Writes the batch to the inbox BATCH_WRITE_SIZE records at a time, notifying
+# once at the end. Returns how many records were written, the first and last
+# counters assigned to them and whether that was the whole batch. Records
+# written before a failure stay in the inbox.
+def write_batch(topic, records):
+    written = 0
+    first = None
+    last = None
+    try:
+        for chunk in chunk_records(records, BATCH_WRITE_SIZE):
+            counters = inbox.add_batch(topic, chunk, notify=False)
+            if counters is None:
+                return (written, first, last, False)
+            written += len(chunk)
+            first = counters[0] if first is None else first
+            last = counters[1]
+    finally:
+        if written > 0:
+            inbox.notify_received(topic)
+    return (written, first, last, True)
+
+# Spools every record of the batch on its own and queues them, answering 202
+# Accepted
+def queue_batch(topic, records):
+    if ingest_queue.full():
+        return queue_full_error()
+
+    paths = []
+    queued = False
+    try:
+        for record in records:
+            path = inbox.spool(StringIO(record), topic=topic)
+            if path is None:
+                return create_error(status_code=500,
+                                    message='Could not write the batch to the inbox')
+            paths.append(path)
+        ingest_queue.put(topic, paths)
+        queued = True
+    except QueueFullException:
+        return queue_full_error()
+    finally:
+        # Spools that weren't queued mustn't be recovered at startup either
+        if not queued:
+            for spooled in paths:
+                os.remove(spooled)
+    response.status = 202
+    return {"accepted": len(paths)}
+
+# Accepts a batch of events for one topic in a single body
+# Query 'topic' -> The topic for the events
+# Query 'format' -> 'ndjson' (one event per line) or 'length-prefixed'. When
+#                   missing, an application/octet-stream body is taken to be
+#                   length-prefixed and anything else newline-delimited.
+@app.post('/events/batch')
+def post_event_batch():
+    topic = request.query.get('topic')
+    if not topic:
+        return create_error(status_code=400,
+                            message='A topic is required')
+
+    batch_format = request.query.get('format')
+    if not batch_format:
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type == 'application/octet-stream':
+            batch_format = 'length-prefixed'
+        else:
+            batch_format = 'ndjson'
+    if batch_format not in BATCH_READERS:
+        return create_error(status_code=400,
+                            message='Unknown batch format %s' % batch_format)
+
+    if request.content_length > max_batch_bytes:
+        return batch_too_large_error()
+
+    # The body is read twice: once to check it, so that a malformed or
+    # oversized batch is rejected before anything reaches the inbox, and once
+    # to stream its records into the inbox
+    reader = BATCH_READERS[batch_format]
+    count = 0
+    size = 0
+    try:
+        for record in reader(request.body):
+            count += 1
+            size += len(record)
+            if count > max_batch_records or size > max_batch_bytes:
+                return batch_too_large_error()
+    except ValueError as ex:
+        return create_error(status_code=400, message=str(ex))
+
+    if count == 0:
+        return {"accepted": 0}
+
+    if ingest_queue is not None:
+        return queue_batch(topic, reader(request.body))
+
+    written, first, last, complete = write_batch(topic, reader(request.body))
+    if not complete:
+        # The events written so far will be processed; a client retrying
+        # should only send the ones after them
+        return create_error(status_code=500,
+                            message=('Could not write the whole batch to the '
+                                     'inbox; the first %d events were '
+                                     'accepted') % written,
+                            fields={"accepted": written, "first": first,
+                                    "last": last})
+    response.status = 201
+    return {"accepted": count, "first": first, "last": last}
 
 # Accepts a multipart form
 # Field 'topic' -> The topic for the attached file(s)
@@ -54,10 +358,36 @@ def post_event():
     # Bottle default way of accessing files doesn't seem to like multiple files
     # which use the same form name (which is standard practice). So let's
     # access them manually. Muwhahahahaha.
-    for name, item in request.POST.allitems():
-        if isinstance(item, FileUpload):
-            inbox.add_file_by_bytes(topic, item.file.read())
+    uploads = [item for name, item in request.POST.allitems()
+               if isinstance(item, FileUpload)]
+    if ingest_queue is not None:
+        return queue_event(topic, uploads)
+
+    try:
+        for item in uploads:
+            # Stream the upload to disk rather than reading it into memory.
+            # This returns once the event is durable (if durability is on).
+            if inbox.add_file_by_stream(topic, item.file,
+                                        notify=False) is None:
+                return create_error(status_code=500,
+                                    message=('Could not write %s to the '
+                                             'inbox') % item.filename)
             successfully_queued.append(item.filename)
             response.status = 201
+    finally:
+        # One notification covers every file in the request
+        if len(successfully_queued) > 0:
+            inbox.notify_received(topic)
 
     return {"results": successfully_queued}
+
+# Reports how much work is waiting: the container launch queue, the metric
+# writer and, in async ingest mode, the ingest queue
+@app.get('/event/status')
+def get_event_status():
+    status = {"launch_queue": orchestrator.launch_queue.status(),
+              "writer": writer.status(),
+              "docker": docker_agent.client_status()}
+    if ingest_queue is not None:
+        status["ingest_queue"] = {"depth": ingest_queue.depth()}
+    return status
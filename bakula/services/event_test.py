@@ -17,7 +17,11 @@
 import unittest
 import shutil
 import os
+import struct
+import tempfile
 from bakula.services import event
+from bakula.events.inboxer import Inboxer
+from bakula.events.ingestqueue import IngestQueue
 from webtest import TestApp
 from bakula import models
 from bakula.security import tokenutils, iam
@@ -38,7 +42,16 @@ class EventTest(unittest.TestCase):
                 120)
         }
 
+    def setUp(self):
+        # Keep the events the tests post out of the working directory
+        self.inbox_dir = tempfile.mkdtemp()
+        self.default_inbox = event.inbox
+        event.inbox = Inboxer(os.path.join(self.inbox_dir, "master_inbox"),
+                              os.path.join(self.inbox_dir, "container_inboxes"))
+
     def tearDown(self):
+        event.inbox = self.default_inbox
+        shutil.rmtree(self.inbox_dir, ignore_errors=True)
         shutil.rmtree(".tmp", ignore_errors=True)
 
     def test_post_event(self):
@@ -54,5 +67,142 @@ class EventTest(unittest.TestCase):
 
         self.assertEqual(response.status_int, 201)
 
+    def test_post_event_async(self):
+        os.makedirs(".tmp")
+        testfile = os.path.join(".tmp", "testFile.json")
+        with open(testfile, "w+") as fout:
+            fout.write("stuff")
+
+        # A queue without writers fills up after one request
+        event.ingest_queue = IngestQueue(event.inbox, max_size=1, writers=0)
+        try:
+            response = test_app.post("/event", {
+                "topic": "MyTopic"
+            }, upload_files=[("data[]", testfile)], headers=EventTest.auth_header)
+            self.assertEqual(response.status_int, 202)
+
+            response = test_app.post("/event", {
+                "topic": "MyTopic"
+            }, upload_files=[("data[]", testfile)], expect_errors=True,
+                headers=EventTest.auth_header)
+            self.assertEqual(response.status_int, 429)
+            self.assertEqual(response.headers['Retry-After'], '1')
+        finally:
+            event.ingest_queue = None
+
+    def test_post_event_batch_ndjson(self):
+        body = '{"id": 1}\n{"id": 2}\n\n{"id": 3}\n'
+        response = test_app.post("/events/batch?topic=MyBatchTopic", body,
+                                 content_type="application/x-ndjson",
+                                 headers=EventTest.auth_header)
+
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(response.json["accepted"], 3)
+        self.assertEqual(response.json["last"] - response.json["first"], 2)
+
+    def test_post_event_batch_length_prefixed(self):
+        records = ["one", "two", ""]
+        body = "".join(struct.pack(">I", len(record)) + record
+                       for record in records)
+        response = test_app.post("/events/batch?topic=MyBatchTopic", body,
+                                 content_type="application/octet-stream",
+                                 headers=EventTest.auth_header)
+
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(response.json["accepted"], 3)
+
+    def test_post_event_batch_truncated(self):
+        body = struct.pack(">I", 10) + "short"
+        response = test_app.post(
+            "/events/batch?topic=MyBatchTopic&format=length-prefixed", body,
+            expect_errors=True, headers=EventTest.auth_header)
+        self.assertEqual(response.status_int, 400)
+
+    def test_post_event_batch_not_json(self):
+        body = '{"id": 1}\nnot json\n'
+        response = test_app.post("/events/batch?topic=MyBatchTopic", body,
+                                 expect_errors=True,
+                                 headers=EventTest.auth_header)
+        self.assertEqual(response.status_int, 400)
+        self.assertEqual(event.inbox.get_inbox_count("MyBatchTopic"), 0)
+
+    def test_post_event_batch_too_many_bytes(self):
+        limit = event.max_batch_bytes
+        event.max_batch_bytes = 8
+        try:
+            response = test_app.post("/events/batch?topic=MyBatchTopic",
+                                     '{"id": 1}\n', expect_errors=True,
+                                     headers=EventTest.auth_header)
+            self.assertEqual(response.status_int, 413)
+        finally:
+            event.max_batch_bytes = limit
+
+    def test_post_event_batch_streamed(self):
+        write_size = event.BATCH_WRITE_SIZE
+        event.BATCH_WRITE_SIZE = 2
+        try:
+            body = "".join('{"id": %d}\n' % i for i in range(5))
+            response = test_app.post("/events/batch?topic=MyBatchTopic", body,
+                                     headers=EventTest.auth_header)
+            self.assertEqual(response.status_int, 201)
+            self.assertEqual(response.json["accepted"], 5)
+            self.assertEqual(response.json["last"] - response.json["first"], 4)
+            self.assertEqual(event.inbox.get_inbox_count("MyBatchTopic"), 5)
+        finally:
+            event.BATCH_WRITE_SIZE = write_size
+
+    def test_post_event_batch_partly_written(self):
+        write_size = event.BATCH_WRITE_SIZE
+        event.BATCH_WRITE_SIZE = 2
+        add_batch = event.inbox.add_batch
+        writes = []
+
+        # The second write fails
+        def failing_add_batch(topic, records, notify=True):
+            writes.append(records)
+            if len(writes) == 2:
+                return None
+            return add_batch(topic, records, notify)
+        event.inbox.add_batch = failing_add_batch
+        try:
+            body = "".join('{"id": %d}\n' % i for i in range(5))
+            response = test_app.post("/events/batch?topic=MyBatchTopic", body,
+                                     expect_errors=True,
+                                     headers=EventTest.auth_header)
+            self.assertEqual(response.status_int, 500)
+            # The client is told which events it needn't send again
+            self.assertEqual(response.json["accepted"], 2)
+            self.assertEqual(response.json["last"] - response.json["first"], 1)
+            self.assertEqual(event.inbox.get_inbox_count("MyBatchTopic"), 2)
+        finally:
+            event.BATCH_WRITE_SIZE = write_size
+
+    def test_post_event_batch_async(self):
+        event.ingest_queue = IngestQueue(event.inbox)
+        try:
+            response = test_app.post("/events/batch?topic=MyBatchTopic",
+                                     '{"id": 1}\n{"id": 2}\n',
+                                     headers=EventTest.auth_header)
+            self.assertEqual(response.status_int, 202)
+            self.assertEqual(response.json["accepted"], 2)
+            event.ingest_queue.join()
+            self.assertEqual(event.inbox.get_inbox_count("MyBatchTopic"), 2)
+        finally:
+            event.ingest_queue = None
+
+    def test_post_event_batch_no_topic(self):
+        response = test_app.post("/events/batch", '{"id": 1}\n',
+                                 expect_errors=True,
+                                 headers=EventTest.auth_header)
+        self.assertEqual(response.status_int, 400)
+
+    def test_get_event_status(self):
+        response = test_app.get("/event/status", headers=EventTest.auth_header)
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json["launch_queue"]["depth"], 0)
+        self.assertIn("launch", response.json["docker"])
+        self.assertNotIn("ingest_queue", response.json)
+
 if __name__ == '__main__':
     unittest.main()
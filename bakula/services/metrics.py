@@ -18,7 +18,8 @@
 from bottle import Bottle, request
 from bakula.bottle import configuration
 from bakula.docker import dockeragent
-from bakula.models import Metric, Registration, Event, resolve_query
+from bakula.models import Registration, Event, resolve_query
+from bakula.rollups import metric_averages
 from bakula.bottle.errorutils import create_error
 from bakula.security.tokenauthplugin import TokenAuthorizationPlugin
 from peewee import fn
@@ -39,7 +40,7 @@ app.install(auth_plugin)
 docker_agent = dockeragent.DockerAgent(registry_host=app.config.get("registry.host", None),
     username=app.config.get("registry.username", None),
     password=app.config.get("registry.password", None),
-    docker_timeout=app.config.get("docker.timeout", 2),
+    docker_timeout=app.config.get("docker.timeout", dockeragent.DEFAULT_DOCKER_TIMEOUT),
     monitor_thread=False)
 
 MILLISECONDS_IN_DAY = 86400000
@@ -55,17 +56,8 @@ def get_metrics(registration_id):
     result = {}
     registration = Registration.get(Registration.id == registration_id)
 
-    stats = Metric.select(
-        Metric.name,
-        fn.AVG(Metric.value).alias('average')
-    ).where(
-        Metric.topic == registration.topic,
-        Metric.container == registration.container
-    ).group_by(Metric.name)
-
     # Add to the result object
-    for stat in stats:
-        result[stat.name] = stat.average
+    result.update(metric_averages(registration.topic, registration.container))
 
     # Use the beginning of the day as a starting point (for full
     # days)
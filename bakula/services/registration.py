@@ -19,6 +19,8 @@ from bottle import Bottle, request
 from bakula.bottle import configuration
 from bakula.models import Registration, User, resolve_query
 from bakula.bottle.errorutils import create_error
+from bakula.events.routing import routing_table
+from bakula.runtime.runtime import RUNTIME_DOCKER, RUNTIME_PROCESS
 from bakula.security.tokenauthplugin import TokenAuthorizationPlugin
 from peewee import IntegrityError
 
@@ -31,6 +33,11 @@ token_secret = app.config.get('token_secret', 'password')
 auth_plugin = TokenAuthorizationPlugin(token_secret)
 app.install(auth_plugin)
 
+# Registrations may only run commands on this host when it's allowed
+runtimes = [RUNTIME_DOCKER]
+if app.config.get('runtime.process.enabled', False):
+    runtimes.append(RUNTIME_PROCESS)
+
 @app.get('/registration')
 def get_registrations():
     query = Registration.select()
@@ -53,9 +60,20 @@ def create_registration(user):
     registration_dict = request.json
     registration_dict['creator'] = user
 
+    # Refuse what the orchestrator couldn't run rather than failing once
+    # events arrive
+    runtime = registration_dict.get('runtime') or RUNTIME_DOCKER
+    if runtime not in runtimes:
+        return create_error(status_code=400,
+                            message='Runtime %s is not available' % runtime)
+    if runtime == RUNTIME_PROCESS and not registration_dict.get('command'):
+        return create_error(status_code=400,
+                            message='The process runtime needs a command')
+
     new_registration = Registration(**registration_dict)
     try:
         new_registration.save()
+        routing_table.added(dict(new_registration._data))
         return {'id': new_registration.id}
     except IntegrityError:
         return create_error(status_code=400,
@@ -71,6 +89,7 @@ def delete_registration(registration_id, user):
                                         Registration.creator == user)
         id = registration.id
         registration.delete_instance()
+        routing_table.removed(dict(registration._data))
         return {'id': id}
     except Registration.DoesNotExist:
         return create_error(status_code=404,
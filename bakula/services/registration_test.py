@@ -18,6 +18,7 @@
 import unittest
 from bakula import models
 from bakula.services import registration
+from bakula.events import routing
 from bakula.security import tokenutils, iam
 from webtest import TestApp
 
@@ -59,6 +60,62 @@ class RegistrationTest(unittest.TestCase):
         self.assertEquals(from_db.timeout, 0)
         self.assertFalse(from_db.privileged)
 
+    def test_create_registration_updates_routing(self):
+        routing.routing_table.get('routed_topic')
+        response = test_app.post_json('/registration', {
+            'topic': 'routed_topic',
+            'container': 'not_a_real_container'
+        }, headers=RegistrationTest.auth_header)
+
+        routes = routing.routing_table.get('routed_topic')
+        self.assertEquals([r['id'] for r in routes], [response.json['id']])
+
+        test_app.delete('/registration/%s' % response.json['id'],
+                        headers=RegistrationTest.auth_header)
+        self.assertEquals(routing.routing_table.get('routed_topic'), [])
+
+    def test_create_registration_unknown_runtime(self):
+        response = test_app.post_json('/registration', {
+            'topic': 'test',
+            'container': 'some_container',
+            'runtime': 'vm'
+        }, expect_errors=True, headers=RegistrationTest.auth_header)
+
+        self.assertEquals(response.status_int, 400)
+        self.assertEquals(models.Registration.select().count(), 0)
+
+    def test_create_registration_process_runtime(self):
+        runtimes = registration.runtimes
+        registration.runtimes = ['docker']
+        try:
+            response = test_app.post_json('/registration', {
+                'topic': 'test',
+                'container': 'some_handler',
+                'runtime': 'process',
+                'command': 'cat'
+            }, expect_errors=True, headers=RegistrationTest.auth_header)
+            # Not enabled
+            self.assertEquals(response.status_int, 400)
+
+            registration.runtimes = ['docker', 'process']
+            response = test_app.post_json('/registration', {
+                'topic': 'test',
+                'container': 'some_handler',
+                'runtime': 'process'
+            }, expect_errors=True, headers=RegistrationTest.auth_header)
+            # No command
+            self.assertEquals(response.status_int, 400)
+
+            response = test_app.post_json('/registration', {
+                'topic': 'test',
+                'container': 'some_handler',
+                'runtime': 'process',
+                'command': 'cat'
+            }, headers=RegistrationTest.auth_header)
+            self.assertEquals(response.status_int, 200)
+        finally:
+            registration.runtimes = runtimes
+
     def test_create_registration_already_exists(self):
         topic = 'test'
         container = 'some_container'